@@ -1,5 +1,9 @@
-from flask import Flask, request, render_template, jsonify, send_from_directory
+from flask import Flask, Response, g, request, render_template, jsonify, send_file, stream_with_context, has_request_context
+from werkzeug.exceptions import HTTPException
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NEED_DATA
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from urllib.parse import quote
 from pydub import AudioSegment
 from pydub.utils import mediainfo
 import os
@@ -7,17 +11,71 @@ import uuid
 import time
 import threading
 import logging
+import atexit
 import hashlib
+import hmac
 import json
-import fcntl
-from datetime import datetime, timedelta
+import random
+import shutil
+import functools
+
+import converter
+import metrics
+import resumable
+import tracing
+from archive import iter_zip
+from cache import ConversionCache, link_or_copy
+from expiry import ExpiryScheduler
+from job_queue import LeaseDispatcher, SqliteJobQueue
+from scheduler import ConversionScheduler, ProcessPool, QueueFull, QuotaExceeded
+from task_store import ProgressTracker, TaskNotifier, create_task_store
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # Limit uploads to 100MB
-app.config['UPLOAD_FOLDER'] = 'temp_uploads'
-app.config['CONVERTED_FOLDER'] = 'temp_converted'
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'temp_uploads')
+app.config['CONVERTED_FOLDER'] = os.environ.get('CONVERTED_FOLDER', 'temp_converted')
 app.config['TASKS_FILE'] = 'conversion_tasks.json'
+app.config['TASK_DB'] = os.environ.get('TASK_DB', 'conversion_tasks.db')
+app.config['TASK_STORE_BACKEND'] = os.environ.get('TASK_STORE_BACKEND', 'sqlite')  # 'sqlite' or 'json'
 app.config['FILE_RETENTION_MINUTES'] = 30
+app.config['DOWNLOAD_RETENTION_SECONDS'] = 300  # Tasks and files expire this long after a download
+app.config['EXPIRY_BATCH_SECONDS'] = 5  # Expiries due this close together are removed in one batch
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('DOWNLOAD_OFFLOAD', '')  # '', 'x-sendfile' or 'x-accel-redirect'
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-downloads/')
+app.config['DELETE_AFTER_DOWNLOAD'] = os.environ.get('DELETE_AFTER_DOWNLOAD', 'false').lower() == 'true'
+app.config['CONVERSION_WORKERS'] = int(os.environ.get('CONVERSION_WORKERS', 2))
+app.config['CONVERSION_QUEUE_SIZE'] = int(os.environ.get('CONVERSION_QUEUE_SIZE', 20))
+app.config['CONVERSION_MODE'] = os.environ.get('CONVERSION_MODE', 'thread')  # 'thread' or 'process'
+app.config['CLIENT_MAX_JOBS'] = int(os.environ.get('CLIENT_MAX_JOBS', 10))  # Queued and running jobs per client; 0 disables
+app.config['CLIENT_MAX_COST'] = float(os.environ.get('CLIENT_MAX_COST', 1000))  # Millions of input samples (duration x channels x rate) in flight per client; 0 disables
+app.config['CLIENT_MAX_ACTIVE'] = int(os.environ.get('CLIENT_MAX_ACTIVE', 0))  # Running jobs per client while others wait; 0 means all workers but one
+app.config['CLIENT_ID_HEADER'] = os.environ.get('CLIENT_ID_HEADER', '')  # e.g. X-Forwarded-For behind a proxy; defaults to the remote address
+app.config['JOB_QUEUE'] = os.environ.get('JOB_QUEUE', 'local')  # 'local' or 'lease' (shared; needs the sqlite store)
+app.config['LEASE_SECONDS'] = float(os.environ.get('LEASE_SECONDS', 60))  # Unrenewed jobs are re-queued after this
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', 1))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+app.config['ASYNC_MAX_SUBPROCESSES'] = int(os.environ.get('ASYNC_MAX_SUBPROCESSES', os.cpu_count() or 1))  # Concurrent conversions under asgi.py
+app.config['ASYNC_WSGI_THREADS'] = int(os.environ.get('ASYNC_WSGI_THREADS', 32))  # Threads running the other routes under asgi.py
+app.config['CONVERSION_PROCESSES'] = int(os.environ.get('CONVERSION_PROCESSES', os.cpu_count() or 1))
+app.config['CONVERSION_ENGINE'] = os.environ.get('CONVERSION_ENGINE', 'stream')  # 'stream' or 'pydub'
+app.config['NUMPY_ENGINE'] = os.environ.get('NUMPY_ENGINE', 'true').lower() == 'true'  # PCM WAV input, if NumPy is installed
+app.config['SEGMENTED_MIN_DURATION'] = float(os.environ.get('SEGMENTED_MIN_DURATION', 600))  # Inputs at least this many seconds long are converted in parallel segments
+app.config['SEGMENT_WORKERS'] = int(os.environ.get('SEGMENT_WORKERS', os.cpu_count() or 1))  # ffmpeg runs per segmented conversion; 1 disables it
+app.config['PROGRESS_FLUSH_SECONDS'] = float(os.environ.get('PROGRESS_FLUSH_SECONDS', 2.0))
+app.config['STATUS_MAX_WAITERS'] = int(os.environ.get('STATUS_MAX_WAITERS', 24))  # Long-poll/SSE clients per process
+app.config['STATUS_MAX_WAIT_SECONDS'] = 30  # Longest single long-poll
+app.config['STATUS_STREAM_SECONDS'] = 300  # SSE streams end after this; browsers reconnect
+app.config['STATUS_HEARTBEAT_SECONDS'] = 15
+app.config['STATUS_RECHECK_SECONDS'] = 2  # Catches changes made by other processes
+app.config['STREAMING_INGEST'] = os.environ.get('STREAMING_INGEST', 'false').lower() == 'true'
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', 50))
+app.config['RESUMABLE_MAX_MB'] = float(os.environ.get('RESUMABLE_MAX_MB', 4096))  # Largest resumable upload; each chunk is still capped by MAX_CONTENT_LENGTH
+app.config['VERIFY_MODE'] = os.environ.get('VERIFY_MODE', 'header')  # 'off', 'header' or 'full'
+app.config['CACHE_FOLDER'] = os.environ.get('CACHE_FOLDER')  # Defaults to CONVERTED_FOLDER/.cache
+app.config['CACHE_MAX_MB'] = float(os.environ.get('CACHE_MAX_MB', 512))  # 0 disables the cache
+app.config['TRACE_TASKS'] = os.environ.get('TRACE_TASKS', 'false').lower() == 'true'  # Or per upload with X-Trace: 1
+app.config['TRACE_PROFILE_SAMPLE_RATE'] = float(os.environ.get('TRACE_PROFILE_SAMPLE_RATE', 0))  # Traced tasks run under cProfile
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')  # Bearer token for admin endpoints; unset disables them
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
@@ -34,69 +92,400 @@ for folder in [app.config['UPLOAD_FOLDER'], app.config['CONVERTED_FOLDER']]:
     except Exception as e:
         logger.warning(f"Couldn't set permissions on {folder}: {e}")
 
-# Initialize tasks file if it doesn't exist
-if not os.path.exists(app.config['TASKS_FILE']):
-    try:
-        with open(app.config['TASKS_FILE'], 'w') as f:
-            json.dump({}, f)
-        os.chmod(app.config['TASKS_FILE'], 0o666)  # Make writable by all users
-        logger.info(f"Created tasks file: {app.config['TASKS_FILE']}")
-    except Exception as e:
-        logger.error(f"Failed to create tasks file: {e}")
+_task_store = None
+_task_store_key = None
+_task_store_lock = threading.Lock()
+
+def get_task_store():
+    """Return the task store for the configured backend, creating it on first use"""
+    global _task_store, _task_store_key
+    backend = app.config['TASK_STORE_BACKEND']
+    path = app.config['TASKS_FILE'] if backend == 'json' else app.config['TASK_DB']
+    key = (backend, path)
+    with _task_store_lock:
+        if _task_store_key != key:
+            if _task_store is not None:
+                _task_store.close()
+            _task_store = create_task_store(backend, path)
+            _task_store_key = key
+            logger.info(f"Using {backend} task store: {path}")
+        return _task_store
+
+# Initialize the task store so permission problems show up at startup
+try:
+    get_task_store()
+except Exception as e:
+    logger.error(f"Failed to initialize task store: {e}")
+
+def store_timer(operation):
+    """Time a task store operation for metrics and the current task's trace"""
+    return metrics.timed(metrics.STORE_SECONDS.labels(operation), f"store.{operation}")
 
 def get_tasks():
-    """Get all tasks from the tasks file with file locking to prevent race conditions"""
+    """Get all tasks from the task store"""
     try:
-        with open(app.config['TASKS_FILE'], 'r') as f:
-            fcntl.flock(f, fcntl.LOCK_SH)  # Shared lock for reading
-            try:
-                tasks = json.load(f)
-            except json.JSONDecodeError:
-                logger.error("Invalid JSON in tasks file, resetting")
-                tasks = {}
-            finally:
-                fcntl.flock(f, fcntl.LOCK_UN)  # Release lock
-        return tasks
+        with store_timer('read_all'):
+            return get_task_store().all()
     except Exception as e:
         logger.error(f"Error reading tasks: {e}")
         return {}
 
+def get_task(task_id):
+    """Get a single task from the task store, or None if it doesn't exist"""
+    try:
+        with store_timer('read'):
+            return get_task_store().get(task_id)
+    except Exception as e:
+        logger.error(f"Error reading task {task_id}: {e}")
+        return None
+
+task_notifier = TaskNotifier()
+
 def save_task(task_id, task_data):
-    """Save a task to the tasks file with file locking"""
+    """Save a task to the task store"""
     try:
-        tasks = get_tasks()
-        tasks[task_id] = task_data
-        
-        with open(app.config['TASKS_FILE'], 'w') as f:
-            fcntl.flock(f, fcntl.LOCK_EX)  # Exclusive lock for writing
-            try:
-                json.dump(tasks, f)
-            finally:
-                fcntl.flock(f, fcntl.LOCK_UN)  # Release lock
-        
+        with store_timer('write'):
+            get_task_store().put(task_id, task_data)
+        task_notifier.notify(task_id)
         return True
     except Exception as e:
         logger.error(f"Error saving task {task_id}: {e}")
         return False
 
+def update_task(task_id, fn):
+    """Atomically read-modify-write a task; fn gets the current data (or None)"""
+    try:
+        with store_timer('update'):
+            task_data = get_task_store().update(task_id, fn)
+        task_notifier.notify(task_id)
+        return task_data
+    except Exception as e:
+        logger.error(f"Error updating task {task_id}: {e}")
+        return None
+
+_progress_tracker = None
+
+def save_progress(task_id, task_data):
+    """Write progress through to the store, unless the task has already finished
+
+    An update still in flight when a conversion ends (the asyncio engine
+    reports from executor threads) mustn't turn a finished task back into
+    a processing one.
+    """
+    update_task(task_id, lambda current: task_data if current is not None
+                and current.get('status') not in ('complete', 'error') else current)
+
+def get_progress_tracker():
+    """Return the in-memory progress tracker for running conversions"""
+    global _progress_tracker
+    with _task_store_lock:
+        if _progress_tracker is None:
+            _progress_tracker = ProgressTracker(save_progress, app.config['PROGRESS_FLUSH_SECONDS'])
+        return _progress_tracker
+
+def report_progress(task_id, progress, **details):
+    """Record conversion progress; it reaches the task store at a limited rate"""
+    get_progress_tracker().update(task_id, dict({
+        'status': 'processing',
+        'progress': progress,
+        'timestamp': time.time()
+    }, **details))
+    task_notifier.notify(task_id)
+
 def delete_task(task_id):
-    """Delete a task from the tasks file"""
+    """Delete a task from the task store"""
+    return delete_tasks([task_id])
+
+def delete_tasks(task_ids):
+    """Delete several tasks from the task store in one operation"""
     try:
-        tasks = get_tasks()
-        if task_id in tasks:
-            del tasks[task_id]
-            
-            with open(app.config['TASKS_FILE'], 'w') as f:
-                fcntl.flock(f, fcntl.LOCK_EX)  # Exclusive lock for writing
-                try:
-                    json.dump(tasks, f)
-                finally:
-                    fcntl.flock(f, fcntl.LOCK_UN)  # Release lock
-        
+        with store_timer('delete'):
+            get_task_store().delete_many(task_ids)
+        for task_id in task_ids:
+            task_notifier.forget(task_id)
         return True
     except Exception as e:
-        logger.error(f"Error deleting task {task_id}: {e}")
+        logger.error(f"Error deleting tasks {list(task_ids)}: {e}")
+        return False
+
+def delete_expired_tasks(task_ids, now):
+    """Delete those of task_ids whose stored deadline has passed; returns the tasks kept"""
+    try:
+        with store_timer('delete'):
+            kept = get_task_store().delete_many(task_ids, where=lambda task: expiry_deadline(task) <= now)
+        for task_id in task_ids:
+            if task_id not in kept:
+                task_notifier.forget(task_id)
+        return kept
+    except Exception as e:
+        logger.error(f"Error deleting tasks {list(task_ids)}: {e}")
+        return {}
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Return the conversion scheduler, starting its workers on first use"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ConversionScheduler(workers=app.config['CONVERSION_WORKERS'],
+                                             max_queue=app.config['CONVERSION_QUEUE_SIZE'],
+                                             **client_limits(app.config['CONVERSION_WORKERS']))
+            _scheduler.start()
+            logger.info(f"Started {_scheduler.workers} conversion workers "
+                        f"(queue size {_scheduler.max_queue})")
+        return _scheduler
+
+def client_limits(workers):
+    """Per-client scheduler quotas from the config, for a pool of ``workers``"""
+    return {
+        'client_max_jobs': app.config['CLIENT_MAX_JOBS'],
+        'client_max_cost': app.config['CLIENT_MAX_COST'] * 1e6,
+        'client_max_active': app.config['CLIENT_MAX_ACTIVE'] or max(1, workers - 1),
+    }
+
+def client_key(headers, remote_addr):
+    """Who a request is from, for fair queuing and quotas"""
+    header = app.config['CLIENT_ID_HEADER']
+    value = headers.get(header, '') if header else ''
+    # X-Forwarded-For lists the original client first
+    return value.split(',')[0].strip() or remote_addr or 'unknown'
+
+def request_client():
+    """``client_key`` of the current request, or None outside one"""
+    if not has_request_context():
+        return None
+    return client_key(request.headers, request.remote_addr)
+
+def rejection(e):
+    """Message for a ``QueueFull`` (or ``QuotaExceeded``) rejection"""
+    if isinstance(e, QuotaExceeded):
+        return 'You have too many conversions in progress, please wait for them to finish'
+    return 'Server is busy, please try again shortly'
+
+_async_scheduler = None
+
+def use_async_scheduler(scheduler):
+    """Register the ``AsyncScheduler`` asgi.py converts uploads on, for status and metrics"""
+    global _async_scheduler
+    _async_scheduler = scheduler
+
+def collect_queue_metrics():
+    """Set the queue gauges from this process's schedulers, if they have started"""
+    schedulers = [scheduler for scheduler in (_scheduler, _async_scheduler) if scheduler is not None]
+    if schedulers:
+        stats = [scheduler.stats() for scheduler in schedulers]
+        metrics.QUEUE_DEPTH.set(sum(s['queued'] for s in stats))
+        metrics.ACTIVE_CONVERSIONS.set(sum(s['active'] for s in stats))
+
+metrics.REGISTRY.add_collector(collect_queue_metrics)
+
+_job_queue = None
+_job_queue_path = None
+_dispatcher = None
+
+def leased_jobs():
+    """Whether conversion jobs go through the shared lease queue"""
+    return app.config['JOB_QUEUE'] == 'lease' and app.config['TASK_STORE_BACKEND'] == 'sqlite'
+
+def get_job_queue():
+    """Return the shared job queue, kept in the SQLite task database"""
+    global _job_queue, _job_queue_path
+    with _scheduler_lock:
+        if _job_queue_path != app.config['TASK_DB']:
+            if _job_queue is not None:
+                _job_queue.close()
+            _job_queue = SqliteJobQueue(app.config['TASK_DB'])
+            _job_queue_path = app.config['TASK_DB']
+        return _job_queue
+
+def get_dispatcher():
+    """Return this process's lease dispatcher, starting it on first use"""
+    global _dispatcher
+    queue = get_job_queue()
+    with _scheduler_lock:
+        if _dispatcher is None:
+            _dispatcher = LeaseDispatcher(queue, start_claimed_job, worker_idle,
+                                          on_failed=fail_abandoned_job,
+                                          lease_seconds=app.config['LEASE_SECONDS'],
+                                          poll_seconds=app.config['JOB_POLL_SECONDS'],
+                                          max_attempts=app.config['JOB_MAX_ATTEMPTS'])
+            _dispatcher.start()
+            # Hand running jobs back on a clean exit rather than waiting out their leases
+            atexit.register(_dispatcher.stop)
+        return _dispatcher
+
+def worker_idle():
+    """Whether a local worker could start a claimed job straight away"""
+    stats = get_scheduler().stats()
+    return stats['queued'] == 0 and stats['active'] < stats['workers']
+
+def start_claimed_job(task_id, payload, attempts):
+    """Hand a job claimed from the shared queue to a local worker"""
+    try:
+        # Claimed jobs carry no client, so the per-client limits don't apply to them
+        get_scheduler().submit(task_id, run_claimed_job, task_id, payload)
+    except QueueFull:
+        return False
+    return True
+
+def run_claimed_job(task_id, payload, source=None):
+    """Convert a leased job, then remove it from the shared queue"""
+    args = (payload['input_path'], app.config['CONVERTED_FOLDER'], task_id, source,
+            payload.get('input_sha256'), payload.get('profiles'))
+    kwargs = {'lease': lambda: get_dispatcher().renew(task_id),
+              'hash_input': payload.get('hash_input', False)}
+    try:
+        if source is None and upload_incomplete(payload):
+            # The process receiving it died part way through the upload
+            logger.error(f"Upload for task {task_id} did not complete")
+            metrics.ERRORS.labels('upload_incomplete').inc()
+            save_task(task_id, {
+                'status': 'error',
+                'error': "Upload did not complete",
+                'timestamp': time.time()
+            })
+        elif tracing.get(task_id) is not None:
+            # Only the process that took the upload has its trace
+            queued = time.perf_counter() - (time.time() - payload['enqueued'])
+            traced_convert_audio(task_id, queued, *args, **kwargs)
+        else:
+            convert_audio(*args, **kwargs)
+    finally:
+        get_dispatcher().done(task_id)
+
+def fail_abandoned_job(task_id):
+    """Mark a task failed after its workers kept dying part way through"""
+    metrics.ERRORS.labels('abandoned').inc()
+    save_task(task_id, {
+        'status': 'error',
+        'error': 'Conversion was interrupted too many times',
+        'timestamp': time.time()
+    })
+
+_process_pool = None
+
+def get_process_pool():
+    """Return the process pool used when CONVERSION_MODE is 'process'"""
+    global _process_pool
+    with _scheduler_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPool(processes=app.config['CONVERSION_PROCESSES'])
+            logger.info(f"Using {_process_pool.processes} conversion processes")
+        return _process_pool
+
+_cache = None
+_cache_key = None
+
+def get_cache():
+    """Return the conversion cache, or None when caching is disabled"""
+    global _cache, _cache_key
+    max_bytes = int(app.config['CACHE_MAX_MB'] * 1024 * 1024)
+    if max_bytes <= 0:
+        return None
+    # Keep the cache on the same volume as converted files so hits can be hardlinked
+    folder = app.config['CACHE_FOLDER'] or os.path.join(app.config['CONVERTED_FOLDER'], '.cache')
+    with _scheduler_lock:
+        if _cache_key != (folder, max_bytes):
+            _cache = ConversionCache(folder, max_bytes)
+            _cache_key = (folder, max_bytes)
+        return _cache
+
+def cache_key(input_sha256, profile=converter.DEFAULT_PROFILE):
+    """Cache key for an input hash and an output profile"""
+    return f"{input_sha256}_{converter.PROFILES[profile]['label']}"
+
+def converted_filename(input_path, profile=converter.DEFAULT_PROFILE):
+    """Download filename for the converted version of input_path"""
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    return secure_filename(f"{base_name}_{converter.PROFILES[profile]['label']}.wav")
+
+def parse_profiles(values):
+    """Output profiles requested by an upload, the first being the primary one
+
+    ``values`` holds profile names, each possibly a comma-separated list.
+    Raises ValueError for unknown names.
+    """
+    profiles = []
+    for value in values:
+        for name in value.split(','):
+            name = name.strip()
+            if not name or name in profiles:
+                continue
+            if name not in converter.PROFILES:
+                raise ValueError(f"Unknown output profile: {name}")
+            profiles.append(name)
+    return profiles or [converter.DEFAULT_PROFILE]
+
+def completed_outputs(task):
+    """Map of profile name to output details for a completed task"""
+    if 'outputs' in task:
+        return task['outputs']
+    # Tasks recorded before profiles existed have a single output
+    return {converter.DEFAULT_PROFILE: {'output_path': task['output_path'],
+                                        'filename': task['filename'],
+                                        'converted_size': task.get('converted_size')}}
+
+def save_upload(file, path):
+    """Write an uploaded file to path in chunks, returning its size and SHA-256"""
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as out:
+        while True:
+            chunk = file.stream.read(converter.STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            hasher.update(chunk)
+            size += len(chunk)
+    return size, hasher.hexdigest()
+
+def complete_from_cache(task_id, input_path, input_sha256, profiles=None):
+    """Finish a task from cached conversions of identical input; returns True on a hit
+
+    Every requested profile has to be cached, otherwise the input is decoded anyway.
+    """
+    cache = get_cache()
+    if cache is None:
         return False
+    profiles = profiles or [converter.DEFAULT_PROFILE]
+    hits = []
+    for profile in profiles:
+        hit = cache.lookup(cache_key(input_sha256, profile))
+        if hit is None:
+            return False
+        hits.append(hit)
+    
+    outputs = {}
+    for profile, (cached_path, metadata) in zip(profiles, hits):
+        filename = converted_filename(input_path, profile)
+        output_path = os.path.join(app.config['CONVERTED_FOLDER'], f"{task_id}_{filename}")
+        link_or_copy(cached_path, output_path)
+        outputs[profile] = {'output_path': output_path, 'filename': filename,
+                            'converted_size': os.path.getsize(output_path)}
+    input_size = os.path.getsize(input_path)
+    os.remove(input_path)
+    
+    primary = outputs[profiles[0]]
+    save_task(task_id, {
+        'status': 'complete',
+        'progress': 100,
+        'output_path': primary['output_path'],
+        'filename': primary['filename'],
+        'profile': profiles[0],
+        'outputs': outputs,
+        'original_size': input_size,
+        'converted_size': primary['converted_size'],
+        'original_format': metadata['original_format'],
+        'input_sha256': input_sha256,
+        'cached': True,
+        'timestamp': time.time()
+    })
+    schedule_expiry(task_id, output_files(outputs))
+    metrics.CONVERSIONS.labels('cache').inc()
+    logger.info(f"Task {task_id} served from conversion cache")
+    return True
 
 def get_file_md5(filepath):
     """Calculate MD5 hash of a file"""
@@ -106,246 +495,986 @@ def get_file_md5(filepath):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
-def cleanup_old_files():
-    """Remove files older than the retention period"""
-    while True:
-        try:
-            now = datetime.now()
-            retention_delta = timedelta(minutes=app.config['FILE_RETENTION_MINUTES'])
-            
-            # Check both directories
-            for folder in [app.config['UPLOAD_FOLDER'], app.config['CONVERTED_FOLDER']]:
-                for filename in os.listdir(folder):
-                    file_path = os.path.join(folder, filename)
-                    file_modified = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    if now - file_modified > retention_delta:
-                        try:
-                            os.remove(file_path)
-                            logger.info(f"Cleaned up old file: {file_path}")
-                        except Exception as e:
-                            logger.error(f"Failed to remove {file_path}: {e}")
-            
-            # Also clean up old tasks
-            tasks = get_tasks()
-            current_time = time.time()
-            tasks_to_delete = []
-            
-            for task_id, task_data in tasks.items():
-                # Check if task is older than retention period
-                if 'timestamp' in task_data:
-                    task_age = current_time - task_data['timestamp']
-                    if task_age > (app.config['FILE_RETENTION_MINUTES'] * 60):
-                        tasks_to_delete.append(task_id)
-            
-            # Delete old tasks
-            for task_id in tasks_to_delete:
-                delete_task(task_id)
-                logger.info(f"Cleaned up old task: {task_id}")
-                
-        except Exception as e:
-            logger.error(f"Error in cleanup thread: {e}")
-            
-        # Run every 5 minutes
-        time.sleep(300)
+def expected_frame_count(info, sample_rate=converter.TARGET_SAMPLE_RATE):
+    """Estimate the converted frame count from the probed input duration"""
+    duration = converter.probe_duration(info)
+    return round(duration * sample_rate) if duration else None
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-cleanup_thread.start()
+def verify_output(input_path, output_path, input_size, output_size, original_format,
+                  expected_frames=None, exact=False, profile=converter.DEFAULT_PROFILE):
+    """Check the converted file according to VERIFY_MODE; raises if it's wrong
 
-def convert_audio(input_path, output_dir, task_id):
-    """Convert audio to mono 8kHz 16-bit WAV with verification"""
-    try:
-        # Update task status to processing
-        save_task(task_id, {
-            'status': 'processing',
-            'progress': 0,
-            'timestamp': time.time()
-        })
-        
-        # Generate output path
-        original_filename = os.path.basename(input_path)
-        base_name = os.path.splitext(original_filename)[0]
-        output_filename = f"{base_name}_mono_8khz_16bit.wav"
-        sanitized_output_filename = secure_filename(output_filename)
-        output_path = os.path.join(output_dir, f"{task_id}_{sanitized_output_filename}")
-        
-        # First verify the input file is actually an audio file
-        save_task(task_id, {
-            'status': 'processing',
-            'progress': 5,
-            'timestamp': time.time()
-        })
+    The output must match ``profile``. ``header`` parses only the
+    RIFF/fmt/data headers and checks that the data size matches the expected
+    frame count (exactly when ``exact`` is set).
+    Input and output can only be identical when their sizes match, so the
+    files are hashed only in that case. ``full`` decodes the output and
+    hashes both files.
+    """
+    mode = app.config['VERIFY_MODE']
+    settings = converter.PROFILES[profile]
+    target_rate = settings['sample_rate']
+    target_width = settings['sample_width']
+    if mode == 'off':
+        if output_size == 0:
+            raise Exception("Converted file is empty")
+        return
+    
+    if mode == 'full':
+        converted_sound = AudioSegment.from_file(output_path)
+        converted_channels = converted_sound.channels
+        converted_frame_rate = converted_sound.frame_rate
+        converted_sample_width = converted_sound.sample_width
+        if settings['format_tag'] != 1:
+            # Companded audio is decoded back to linear PCM before pydub sees it
+            target_width = converted_sample_width
+    else:
+        try:
+            header = converter.read_wav_header(output_path)
+        except converter.WavFormatError as e:
+            raise Exception(f"Converted file is not a valid WAV file: {e}")
+        if header['format_tag'] != settings['format_tag']:
+            raise Exception(f"Converted file has format tag {header['format_tag']}, "
+                            f"expected {settings['format_tag']}")
+        converted_channels = header['channels']
+        converted_frame_rate = header['sample_rate']
+        converted_sample_width = header['bits_per_sample'] // 8
+    
+    # Verify properties
+    if (converted_channels != 1 or abs(converted_frame_rate - target_rate) > 10
+            or converted_sample_width != target_width):
+        logger.error(f"Conversion validation failed - wrong properties: channels={converted_channels}, rate={converted_frame_rate}, width={converted_sample_width}")
+        raise Exception("Converted file has incorrect audio properties")
+    
+    if mode != 'full':
+        data_size = header['data_size']
+        if header['data_offset'] + data_size > header['file_size']:
+            raise Exception("Converted file is truncated")
+        if data_size % header['block_align']:
+            raise Exception("Converted file ends with a partial frame")
+        frames = data_size // header['block_align']
+        if expected_frames:
+            # Decoder padding and resampler delay shift the length slightly
+            tolerance = 0 if exact else max(expected_frames // 100, target_rate // 4)
+            if abs(frames - expected_frames) > tolerance:
+                raise Exception(f"Converted file has {frames} frames, expected {expected_frames}")
+    
+    original_channels = original_format['channels']
+    original_frame_rate = original_format['sample_rate']
+    original_sample_width = original_format['sample_width']
+    
+    # Log size differences for debugging
+    logger.info(f"Original size: {input_size} bytes, Converted size: {output_size} bytes")
+    logger.info(f"Original: channels={original_channels}, rate={original_frame_rate}, width={original_sample_width}")
+    logger.info(f"Converted: channels=1, rate={target_rate}, width={target_width}")
+    
+    # Files of different sizes can't be identical, so header mode only hashes on a size match
+    if mode == 'full' or input_size == output_size:
+        input_md5 = get_file_md5(input_path)
+        output_md5 = get_file_md5(output_path)
+        logger.info(f"Input MD5: {input_md5}")
+        logger.info(f"Output MD5: {output_md5}")
         
+        # If input and output are identical, that's a problem
+        if input_md5 == output_md5:
+            logger.error("Input and output files have identical MD5 hashes - conversion failed")
+            raise Exception("Conversion did not change the audio file")
+    
+    # If MP3 and WAV are very close in size and conversion appears to have no effect,
+    # it might indicate a problem (unless the source was already in the target format)
+    if abs(input_size - output_size) < (input_size * 0.05):
+        if (original_channels == 1 and abs(original_frame_rate - target_rate) < 10
+                and original_sample_width == target_width):
+            logger.info("Input was already in target format, minimal changes expected")
+        else:
+            logger.warning("Suspicious: input and output files are very similar in size but should be different")
+            # We'll continue but log this warning
+
+ORPHAN_PREFIX = 'orphan:'
+
+def expiry_deadline(task):
+    """When a stored task expires: its ``expires`` time, else the retention period after its last write"""
+    return task.get('expires', task.get('timestamp', 0) + app.config['FILE_RETENTION_MINUTES'] * 60)
+
+def expire_items(items):
+    """Delete the expired tasks in one store operation, then remove their files
+
+    Each process only knows the deadlines it scheduled itself, and with
+    ``JOB_QUEUE=lease`` another process may have finished (and so extended)
+    a task since. The deadline stored with the task is checked again, and a
+    task that isn't due yet is rescheduled along with its files instead.
+    """
+    now = time.time()
+    task_ids = [key for key, _ in items if not key.startswith(ORPHAN_PREFIX)]
+    kept = delete_expired_tasks(task_ids, now) if task_ids else {}
+    
+    removed = 0
+    for key, files in items:
+        if key in kept:
+            get_expiry().schedule(key, expiry_deadline(kept[key]), files)
+            continue
+        for path in files:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Failed to remove {path}: {e}")
+    logger.info(f"Expired {len(task_ids) - len(kept)} tasks and removed {removed} files")
+    if kept:
+        logger.info(f"Rescheduled {len(kept)} tasks extended by another process")
+    
+    cache = get_cache()
+    if cache is not None:
+        cache.trim()
+
+def rebuild_expiry(expiry):
+    """Schedule every stored task, and any file left without one, for expiry
+
+    Runs once per process. The single directory listing here attaches uploads
+    to their tasks by the task ID prefix of their names and catches files
+    orphaned by a restart.
+    """
+    retention = app.config['FILE_RETENTION_MINUTES'] * 60
+    tasks = get_tasks()
+    files = {task_id: [] for task_id in tasks}
+    for task_id, task in tasks.items():
+        if task.get('status') == 'complete' and 'output_path' in task:
+            files[task_id].extend(output['output_path'] for output in completed_outputs(task).values())
+    
+    for folder in [app.config['UPLOAD_FOLDER'], app.config['CONVERTED_FOLDER']]:
         try:
-            # Just try to get file info without loading whole file
-            info = mediainfo(input_path)
-            if not info or 'sample_rate' not in info:
-                raise Exception("Input file does not appear to be a valid audio file")
-            
-            logger.info(f"Input file format: {info.get('format_name', 'unknown')}")
-            logger.info(f"Input sample rate: {info.get('sample_rate', 'unknown')}")
-            logger.info(f"Input bit depth: {info.get('bit_depth', 'unknown')}")
-            logger.info(f"Input channels: {info.get('channels', 'unknown')}")
+            entries = list(os.scandir(folder))
+        except OSError as e:
+            logger.error(f"Failed to list {folder}: {e}")
+            continue
+        for entry in entries:
+            # The conversion cache lives in a subfolder and manages its own size
+            if not entry.is_file():
+                continue
+            task_id = entry.name[:36]
+            if task_id in files:
+                files[task_id].append(entry.path)
+            else:
+                expiry.schedule(f"{ORPHAN_PREFIX}{entry.path}", entry.stat().st_mtime + retention,
+                                [entry.path])
+    
+    for task_id, task in tasks.items():
+        expiry.schedule(task_id, expiry_deadline(task), files[task_id])
+    logger.info(f"Scheduled {expiry.pending()} items for expiry")
+
+_expiry = None
+
+def get_expiry():
+    """Return the process-wide expiry scheduler, rebuilding it on first use"""
+    global _expiry
+    with _scheduler_lock:
+        if _expiry is None:
+            _expiry = ExpiryScheduler(expire_items, batch_window=app.config['EXPIRY_BATCH_SECONDS'])
+            try:
+                rebuild_expiry(_expiry)
+            except Exception as e:
+                logger.error(f"Failed to rebuild expiry schedule: {e}")
+            _expiry.start()
+        return _expiry
+
+def schedule_expiry(task_id, files=(), delay=None, shorten_only=False):
+    """Expire task_id and its files after ``delay`` seconds (default: the retention period)
+
+    The deadline is also stored with the task, so a process whose own
+    schedule says the task is due can tell that it has since been extended.
+    """
+    if delay is None:
+        delay = app.config['FILE_RETENTION_MINUTES'] * 60
+    deadline = time.time() + delay
+    get_expiry().schedule(task_id, deadline, files, shorten_only=shorten_only)
+    update_task(task_id, lambda task: None if task is None else dict(
+        task, expires=min(deadline, task.get('expires', deadline)) if shorten_only else deadline))
+
+def output_files(outputs):
+    return [output['output_path'] for output in outputs.values()]
+
+# Rebuild the expiry schedule (but not when re-imported by a spawned conversion process)
+if __name__ != '__mp_main__':
+    get_expiry()
+
+def write_without_conversion(input_path, profiles, output_paths, link=True):
+    """Write the outputs of an input already in every requested profile's format
+
+    Detection reads only the WAV header. An exact match is hardlinked (or
+    copied, always if ``link`` is false) to the output; a match needing a new
+    header has its data copied under one. Returns ``'unchanged'`` or ``'header_rewritten'``, or None
+    (writing nothing) if the input needs converting.
+    """
+    modes = [converter.passthrough_mode(input_path, name) for name in profiles]
+    if not all(modes):
+        return None
+    for name, mode in zip(profiles, modes):
+        if mode == 'link' and link:
+            link_or_copy(input_path, output_paths[name])
+        elif mode == 'link':
+            shutil.copyfile(input_path, output_paths[name])
+        else:
+            converter.rewrite_header(input_path, output_paths[name], name)
+    return 'unchanged' if all(mode == 'link' for mode in modes) else 'header_rewritten'
+
+def complete_without_conversion(task_id, input_path, input_sha256, profiles, filenames, output_paths):
+    """Finish a task whose input is already in every requested profile's format
+
+    Returns True if the task was completed this way.
+    """
+    fast_path = write_without_conversion(input_path, profiles, output_paths)
+    if fast_path is None:
+        return False
+    
+    header = converter.read_wav_header(input_path)
+    outputs = {name: {'output_path': output_paths[name], 'filename': filenames[name],
+                      'converted_size': os.path.getsize(output_paths[name])}
+               for name in profiles}
+    
+    primary = outputs[profiles[0]]
+    save_task(task_id, {
+        'status': 'complete',
+        'progress': 100,
+        'output_path': primary['output_path'],
+        'filename': primary['filename'],
+        'profile': profiles[0],
+        'outputs': outputs,
+        'original_size': os.path.getsize(input_path),
+        'converted_size': primary['converted_size'],
+        'original_format': {
+            'channels': header['channels'],
+            'sample_rate': header['sample_rate'],
+            'bit_depth': header['bits_per_sample']
+        },
+        'input_sha256': input_sha256,
+        'fast_path': fast_path,
+        'timestamp': time.time()
+    })
+    schedule_expiry(task_id, output_files(outputs))
+    logger.info(f"Task {task_id} input already in target format ({fast_path}), skipped conversion")
+    return True
+
+def stream_progress(task_id, duration, profile=converter.DEFAULT_PROFILE):
+    """Progress callback for the streaming engine, measured in converted audio
+
+    Maps processed audio against the probed ``duration`` onto 10-95% (probing
+    is below, verification above) and estimates the time remaining.
+    """
+    started = time.monotonic()
+    settings = converter.PROFILES[profile]
+    bytes_per_second = settings['sample_rate'] * settings['sample_width'] * converter.TARGET_CHANNELS
+    
+    def progress(bytes_written):
+        processed = bytes_written / bytes_per_second
+        details = {'bytes_processed': bytes_written, 'processed_seconds': round(processed, 2)}
+        percent = 10
+        if duration:
+            fraction = min(processed / duration, 1.0)
+            percent = 10 + int(fraction * 85)
+            details['duration'] = duration
+            if fraction > 0:
+                elapsed = time.monotonic() - started
+                details['eta_seconds'] = round(elapsed * (1 - fraction) / fraction, 1)
+        report_progress(task_id, percent, **details)
+    
+    return progress
+
+def conversion_segments(duration):
+    """How many time segments to convert an input of ``duration`` seconds in"""
+    if not duration or duration < app.config['SEGMENTED_MIN_DURATION']:
+        return 1
+    return max(1, app.config['SEGMENT_WORKERS'])
+
+def output_targets(input_path, output_dir, task_id, profiles):
+    """Download filenames and output paths of task_id's conversion, by profile"""
+    filenames = {name: converted_filename(input_path, name) for name in profiles}
+    output_paths = {name: os.path.join(output_dir, f"{task_id}_{filenames[name]}")
+                    for name in profiles}
+    return filenames, output_paths
+
+def verify_outputs(input_path, profiles, output_paths, original_format, expected_frames,
+                   exact=False):
+    """``verify_output`` for every profile's output; returns the output sizes by profile
+
+    ``expected_frames`` is the first profile's frame count. The other profiles
+    come from the same decode, so their length follows it, scaled by sample
+    rate; only the first is held to ``exact``.
+    """
+    primary_rate = converter.PROFILES[profiles[0]]['sample_rate']
+    input_size = os.path.getsize(input_path)
+    output_sizes = {name: os.path.getsize(output_paths[name]) for name in profiles}
+    for name in profiles:
+        frames = expected_frames
+        if name != profiles[0] and expected_frames:
+            frames = round(expected_frames * converter.PROFILES[name]['sample_rate'] / primary_rate)
+        verify_output(input_path, output_paths[name], input_size, output_sizes[name],
+                      original_format, frames, exact=exact and name == profiles[0], profile=name)
+    return output_sizes
+
+def finish_conversion(task_id, input_path, profiles, filenames, output_paths, original_format,
+                      expected_frames, started, engine, exact=False, duration=None,
+                      input_sha256=None):
+    """Verify the converted outputs and mark the task complete; returns the primary output path
+
+    ``original_format`` describes the input and ``expected_frames`` is the
+    frame count of the first profile's output; ``exact`` requires that count
+    exactly. ``started`` is the ``perf_counter`` time the conversion began.
+    Failures are recorded on the task and return None.
+    """
+    profile = profiles[0]
+    output_path = output_paths[profile]
+    sanitized_output_filename = filenames[profile]
+    
+    # Store original properties for verification
+    original_channels = original_format['channels']
+    original_frame_rate = original_format['sample_rate']
+    original_sample_width = original_format['sample_width']
+    
+    # Verify the conversion
+    report_progress(task_id, 95)
+    
+    missing = [name for name in profiles if not os.path.exists(output_paths[name])]
+    if not missing:
+        input_size = os.path.getsize(input_path)
+        try:
+            with metrics.stage(engine, 'verify'):
+                output_sizes = verify_outputs(input_path, profiles, output_paths, original_format,
+                                              expected_frames, exact)
+            output_size = output_sizes[profile]
         except Exception as e:
-            logger.error(f"Input validation failed: {e}")
+            logger.error(f"Output validation failed: {e}")
+            metrics.ERRORS.labels('verification').inc()
             save_task(task_id, {
                 'status': 'error',
-                'error': "Invalid audio file format",
+                'error': f"Conversion validation failed: {str(e)}",
                 'timestamp': time.time()
             })
             return None
-        
-        # Load the audio file - this may take time for large files
+    else:
+        logger.error(f"Output file was not created for profiles: {', '.join(missing)}")
+        metrics.ERRORS.labels('no_output').inc()
         save_task(task_id, {
-            'status': 'processing',
-            'progress': 10,
-            'timestamp': time.time()
-        })
-        
-        sound = AudioSegment.from_file(input_path)
-        
-        # Store original properties for verification
-        original_channels = sound.channels
-        original_frame_rate = sound.frame_rate
-        original_sample_width = sound.sample_width
-        
-        # Update progress
-        save_task(task_id, {
-            'status': 'processing',
-            'progress': 30,
-            'timestamp': time.time()
-        })
-        
-        # Make mono if not already
-        if sound.channels > 1:
-            sound = sound.set_channels(1)
-        
-        save_task(task_id, {
-            'status': 'processing',
-            'progress': 50,
+            'status': 'error',
+            'error': "Conversion failed - no output file",
             'timestamp': time.time()
         })
+        return None
         
-        # Set sample rate if not already 8kHz
-        if sound.frame_rate != 8000:
-            sound = sound.set_frame_rate(8000)
-            
-        save_task(task_id, {
-            'status': 'processing',
-            'progress': 70,
-            'timestamp': time.time()
-        })
+    # Successful conversion - update status
+    outputs = {name: {'output_path': output_paths[name], 'filename': filenames[name],
+                      'converted_size': output_sizes[name]} for name in profiles}
+    save_task(task_id, {
+        'status': 'complete',
+        'progress': 100,
+        'output_path': output_path,
+        'filename': sanitized_output_filename,
+        'profile': profile,
+        'outputs': outputs,
+        'original_size': input_size,
+        'converted_size': output_size,
+        'original_format': {
+            'channels': original_channels,
+            'sample_rate': original_frame_rate,
+            'bit_depth': original_sample_width * 8
+        },
+        'input_sha256': input_sha256,
+        'timestamp': time.time()
+    })
+    schedule_expiry(task_id, output_files(outputs))
+    
+    metrics.CONVERSIONS.labels('converted').inc()
+    metrics.CONVERSION_SECONDS.labels('converted').observe(time.perf_counter() - started)
+    metrics.INPUT_BYTES.inc(input_size)
+    for name in profiles:
+        metrics.OUTPUT_BYTES.labels(name).inc(output_sizes[name])
+    metrics.AUDIO_SECONDS.inc(duration or 0)
+    
+    cache = get_cache()
+    if cache is not None and input_sha256:
+        try:
+            for name in profiles:
+                with tracing.span('cache.store', profile=name):
+                    cache.store(cache_key(input_sha256, name), output_paths[name], {
+                        'original_format': {
+                            'channels': original_channels,
+                            'sample_rate': original_frame_rate,
+                            'bit_depth': original_sample_width * 8
+                        }
+                    })
+        except Exception as e:
+            logger.warning(f"Failed to cache conversion for task {task_id}: {e}")
+    
+    return output_path
+
+class InvalidAudio(Exception):
+    """Raised when an input doesn't probe as an audio file"""
+
+def transcode_input(input_path, output_paths, profiles, task_id=None, streamed_frames=None):
+    """Convert input_path into each profile's output path with the configured engine
+
+    The conversion itself, without the task bookkeeping of ``convert_audio``:
+    progress goes to ``task_id`` if one is given. ``streamed_frames`` is the
+    frame count of outputs already written from a streamed upload, which then
+    only needs probing. Returns ``(original_format, expected_frames, engine,
+    exact, duration)``; ``exact`` means expected_frames is the exact count.
+    Raises InvalidAudio if the input can't be probed.
+    """
+    profile = profiles[0]
+    output_path = output_paths[profile]
+    extra_outputs = [(name, output_paths[name]) for name in profiles[1:]]
+    streamed = streamed_frames is not None
+    
+    # PCM WAV input is converted in-process, and its header stands in for ffprobe
+    wav_input = None
+    if not streamed and app.config['NUMPY_ENGINE']:
+        wav_input = converter.numpy_wav_input(input_path, profiles)
+    use_stream_engine = (streamed or wav_input is not None
+                         or app.config['CONVERSION_ENGINE'] == 'stream')
+    engine = ('numpy' if wav_input is not None
+              else 'ffmpeg' if use_stream_engine else 'pydub')
+    
+    try:
+        # Just try to get file info without loading whole file
+        with metrics.stage(engine, 'probe'):
+            if wav_input is not None:
+                info = converter.probe_from_wav_header(wav_input)
+            else:
+                info = mediainfo(input_path)
+        if not info or 'sample_rate' not in info:
+            raise Exception("Input file does not appear to be a valid audio file")
         
-        # Set sample width if not already 16-bit
-        if sound.sample_width != 2:  # 2 bytes = 16-bit
-            sound = sound.set_sample_width(2)
-            
+        logger.info(f"Input file format: {info.get('format_name', 'unknown')}")
+        logger.info(f"Input sample rate: {info.get('sample_rate', 'unknown')}")
+        logger.info(f"Input bit depth: {info.get('bit_depth', 'unknown')}")
+        logger.info(f"Input channels: {info.get('channels', 'unknown')}")
+    except Exception as e:
+        logger.error(f"Input validation failed: {e}")
+        raise InvalidAudio(str(e))
+    
+    # Load the audio file - this may take time for large files
+    if task_id is not None:
+        report_progress(task_id, 10)
+    
+    # The streaming and NumPy engines report exactly how many frames they wrote
+    primary_rate = converter.PROFILES[profile]['sample_rate']
+    expected_frames = (streamed_frames if streamed
+                       else expected_frame_count(info, primary_rate))
+    duration = converter.probe_duration(info)
+    progress = stream_progress(task_id, duration, profile) if task_id is not None else None
+    segments = conversion_segments(duration) if use_stream_engine and not streamed else 1
+    if streamed:
+        original_format = converter.format_from_probe(info)
+    elif segments > 1:
+        # Long inputs are split in time and converted by several ffmpeg runs at once.
+        # The work happens in those children, so this runs in-thread in either mode.
+        engine = 'ffmpeg'
+        original_format = converter.format_from_probe(info)
+        logger.info(f"Converting {duration:.0f}s of audio from {input_path} in {segments} segments")
+        expected_frames = converter.transcode_segmented(
+            input_path, output_path, duration, segments,
+            progress=progress, profile=profile, extra_outputs=extra_outputs)
+    elif wav_input is not None:
+        original_format = converter.format_from_probe(info)
+        if app.config['CONVERSION_MODE'] == 'process':
+            expected_frames = get_process_pool().run(
+                converter.transcode_numpy, input_path, output_path,
+                None, profile, extra_outputs)
+        else:
+            expected_frames = converter.transcode_numpy(
+                input_path, output_path,
+                progress=progress, profile=profile, extra_outputs=extra_outputs)
+    elif use_stream_engine:
+        # ffmpeg converts in a single pass, so the probe describes the input
+        original_format = converter.format_from_probe(info)
+        if app.config['CONVERSION_MODE'] == 'process':
+            expected_frames = get_process_pool().run(
+                converter.transcode_streaming, input_path, output_path,
+                converter.STREAM_CHUNK_SIZE, None, profile, extra_outputs)
+        else:
+            expected_frames = converter.transcode_streaming(
+                input_path, output_path,
+                progress=progress, profile=profile, extra_outputs=extra_outputs)
+    elif app.config['CONVERSION_MODE'] == 'process':
+        # Only paths cross the process boundary; progress resumes after the child finishes
+        original_format = get_process_pool().run(converter.transcode, input_path, output_path,
+                                                 None, profile, extra_outputs)
+    else:
+        original_format = converter.transcode(
+            input_path, output_path,
+            progress=(lambda percent: report_progress(task_id, percent)) if task_id is not None else None,
+            profile=profile, extra_outputs=extra_outputs)
+    
+    return original_format, expected_frames, engine, use_stream_engine, duration
+
+def lease_held(task_id, lease):
+    """Whether a conversion run under ``lease`` (see ``convert_audio``) may publish its results"""
+    if lease is None or lease():
+        return True
+    logger.warning(f"Lease on task {task_id} was lost, leaving it to the worker that took it over")
+    metrics.ERRORS.labels('lease_lost').inc()
+    return False
+
+def convert_audio(input_path, output_dir, task_id, source=None, input_sha256=None, profiles=None,
+                  lease=None, hash_input=False):
+    """Convert audio to WAV in each requested output profile, with verification
+
+    ``profiles`` lists output profile names (default mono 8kHz 16-bit only);
+    the input is decoded once and every profile is encoded from that decode.
+    ``source`` is an optional ``converter.GrowingFile`` for an upload that is
+    still arriving; conversion then starts before ``input_path`` is complete.
+    ``input_sha256`` keys the results in the conversion cache. ``lease``
+    renews a shared-queue job's lease and returns False once it's lost; the
+    outputs are then written to this attempt's own files and only moved into
+    place, and the task completed, while the lease is still held.
+    ``hash_input`` hashes an input that arrived without a digest (a resumable
+    upload) and tries the conversion cache before converting it.
+    """
+    started = time.perf_counter()
+    part_paths = []
+    try:
+        # Update task status to processing
         save_task(task_id, {
             'status': 'processing',
-            'progress': 85,
+            'progress': 0,
             'timestamp': time.time()
         })
         
-        # Export as WAV using explicit parameters to ensure proper WAV encoding
-        sound.export(output_path, format="wav", 
-                    parameters=["-acodec", "pcm_s16le", "-ac", "1", "-ar", "8000"])
-        
-        # Verify the conversion
-        save_task(task_id, {
-            'status': 'processing',
-            'progress': 95,
-            'timestamp': time.time()
-        })
+        # Generate output paths; the first profile is the primary download
+        profiles = profiles or [converter.DEFAULT_PROFILE]
+        profile = profiles[0]
+        filenames, published_paths = output_targets(input_path, output_dir, task_id, profiles)
+        output_paths = published_paths
+        if lease is not None:
+            attempt = uuid.uuid4().hex[:8]
+            output_paths = {}
+            for name, path in published_paths.items():
+                root, ext = os.path.splitext(path)
+                output_paths[name] = f"{root}.{attempt}.part{ext}"
+            part_paths = list(output_paths.values())
+            schedule_expiry(task_id, part_paths, shorten_only=True)
+        output_path = output_paths[profile]
+        extra_outputs = [(name, output_paths[name]) for name in profiles[1:]]
         
-        if os.path.exists(output_path):
-            # Calculate input and output file sizes
-            input_size = os.path.getsize(input_path)
-            output_size = os.path.getsize(output_path)
-            
-            # Validate output file
+        # Convert from the incoming upload while it arrives, then probe the finished file
+        streamed = False
+        if source is not None:
             try:
-                converted_sound = AudioSegment.from_file(output_path)
-                
-                # Verify properties
-                if converted_sound.channels != 1 or abs(converted_sound.frame_rate - 8000) > 10 or converted_sound.sample_width != 2:
-                    logger.error(f"Conversion validation failed - wrong properties: channels={converted_sound.channels}, rate={converted_sound.frame_rate}, width={converted_sound.sample_width}")
-                    raise Exception("Converted file has incorrect audio properties")
-                    
-                # Log size differences for debugging
-                logger.info(f"Original size: {input_size} bytes, Converted size: {output_size} bytes")
-                logger.info(f"Original: channels={original_channels}, rate={original_frame_rate}, width={original_sample_width}")
-                logger.info(f"Converted: channels=1, rate=8000, width=2")
-                
-                # Calculate and log MD5 hashes for comparison
-                input_md5 = get_file_md5(input_path)
-                output_md5 = get_file_md5(output_path)
-                logger.info(f"Input MD5: {input_md5}")
-                logger.info(f"Output MD5: {output_md5}")
-                
-                # If input and output are identical, that's a problem
-                if input_md5 == output_md5:
-                    logger.error("Input and output files have identical MD5 hashes - conversion failed")
-                    raise Exception("Conversion did not change the audio file")
-                
-                # If MP3 and WAV are very close in size and conversion appears to have no effect,
-                # it might indicate a problem (unless the source was already mono/8kHz/16-bit)
-                if abs(input_size - output_size) < (input_size * 0.05):
-                    if original_channels == 1 and abs(original_frame_rate - 8000) < 10 and original_sample_width == 2:
-                        logger.info("Input was already in target format, minimal changes expected")
-                    else:
-                        logger.warning("Suspicious: input and output files are very similar in size but should be different")
-                        # We'll continue but log this warning
-                
+                # The duration isn't known until the upload can be probed
+                streamed_frames = converter.transcode_streaming(
+                    source, output_path, progress=stream_progress(task_id, None, profile),
+                    profile=profile, extra_outputs=extra_outputs)
+                streamed = True
+            except converter.UploadAborted:
+                pass
             except Exception as e:
-                logger.error(f"Output validation failed: {e}")
+                # Some containers can't be decoded from a pipe; convert from the file instead
+                logger.warning(f"Streaming conversion failed for task {task_id}, "
+                               f"retrying from the saved upload: {e}")
+            finally:
+                source.close()
+            
+            upload_complete = source.wait()
+            input_sha256 = input_sha256 or source.digest
+            if not upload_complete:
+                logger.error(f"Upload for task {task_id} did not complete")
+                metrics.ERRORS.labels('upload_incomplete').inc()
                 save_task(task_id, {
                     'status': 'error',
-                    'error': f"Conversion validation failed: {str(e)}",
+                    'error': "Upload did not complete",
                     'timestamp': time.time()
                 })
                 return None
-        else:
-            logger.error("Output file was not created")
+        
+        # Hashing a large upload is left to the worker rather than the request that finished it
+        if hash_input:
+            with tracing.span('upload.hash'):
+                input_sha256 = resumable.sha256_file(input_path)
+            if not lease_held(task_id, lease):
+                return None
+            with tracing.span('upload.cache_lookup'):
+                if complete_from_cache(task_id, input_path, input_sha256, profiles):
+                    return published_paths[profile]
+        
+        # Input that is already in the target format needs at most a new header
+        if not streamed and not lease_held(task_id, lease):
+            return None
+        with tracing.span('fast_path_check'):
+            skipped = not streamed and complete_without_conversion(
+                task_id, input_path, input_sha256, profiles, filenames, published_paths)
+        if skipped:
+            metrics.CONVERSIONS.labels('fast_path').inc()
+            metrics.CONVERSION_SECONDS.labels('fast_path').observe(time.perf_counter() - started)
+            return published_paths[profile]
+        
+        # First verify the input file is actually an audio file
+        report_progress(task_id, 5)
+        try:
+            original_format, expected_frames, engine, exact, duration = transcode_input(
+                input_path, output_paths, profiles, task_id,
+                streamed_frames=streamed_frames if streamed else None)
+        except InvalidAudio:
+            metrics.ERRORS.labels('invalid_input').inc()
             save_task(task_id, {
                 'status': 'error',
-                'error': "Conversion failed - no output file",
+                'error': "Invalid audio file format",
                 'timestamp': time.time()
             })
             return None
-            
-        # Successful conversion - update status
-        save_task(task_id, {
-            'status': 'complete',
-            'progress': 100,
-            'output_path': output_path,
-            'filename': sanitized_output_filename,
-            'original_size': input_size,
-            'converted_size': output_size,
-            'original_format': {
-                'channels': original_channels,
-                'sample_rate': original_frame_rate,
-                'bit_depth': original_sample_width * 8
-            },
-            'timestamp': time.time()
-        })
         
-        return output_path
+        if lease is not None:
+            if not lease_held(task_id, lease):
+                return None
+            for name in profiles:
+                if os.path.exists(output_paths[name]):
+                    os.replace(output_paths[name], published_paths[name])
+        
+        return finish_conversion(task_id, input_path, profiles, filenames, published_paths,
+                                 original_format, expected_frames, started, engine,
+                                 exact=exact, duration=duration, input_sha256=input_sha256)
         
     except Exception as e:
         logger.error(f"Error converting {input_path}: {e}")
+        metrics.ERRORS.labels('conversion').inc()
         save_task(task_id, {
             'status': 'error',
             'error': str(e),
             'timestamp': time.time()
         })
         return None
+    finally:
+        # A lost lease, or a failure, leaves this attempt's files unpublished
+        for path in part_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        get_progress_tracker().clear(task_id)
+
+def trace_requested():
+    """Whether the current upload should be traced (TRACE_TASKS or an X-Trace header)"""
+    return app.config['TRACE_TASKS'] or request.headers.get('X-Trace', '').lower() in ('1', 'true')
+
+def trace_path(task_id):
+    return os.path.join(app.config['CONVERTED_FOLDER'], f"{task_id}_trace.json")
+
+def profile_path(task_id):
+    return os.path.join(app.config['CONVERTED_FOLDER'], f"{task_id}_profile.pstats")
+
+def start_trace(task_id):
+    """Start tracing task_id from the beginning of the current request"""
+    trace = tracing.start(task_id, started=g.get('request_started'))
+    if g.get('request_started') is not None:
+        # The request body was received and parsed before the task existed
+        trace.add('upload.receive', start=g.request_started,
+                  duration=time.perf_counter() - g.request_started)
+    return trace
+
+def finish_trace(task_id):
+    """Write task_id's trace record; it expires along with the task"""
+    try:
+        record = tracing.finish(task_id, trace_path(task_id))
+    except Exception as e:
+        logger.warning(f"Failed to write trace for task {task_id}: {e}")
+        return
+    if record is not None:
+        files = [trace_path(task_id)]
+        if record['profile']:
+            files.append(profile_path(task_id))
+        schedule_expiry(task_id, files, shorten_only=True)
+
+def traced_convert_audio(task_id, queued, *args, **kwargs):
+    """Run convert_audio for a traced task, under cProfile if it is sampled"""
+    with tracing.activate(task_id):
+        tracing.add('queue_wait', start=queued, duration=time.perf_counter() - queued)
+        try:
+            if random.random() < app.config['TRACE_PROFILE_SAMPLE_RATE']:
+                with tracing.profiled(profile_path(task_id)):
+                    return convert_audio(*args, **kwargs)
+            return convert_audio(*args, **kwargs)
+        finally:
+            finish_trace(task_id)
+
+@app.before_request
+def mark_request_start():
+    g.request_started = time.perf_counter()
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def queue_conversion(task_id, temp_path, source=None, input_sha256=None, profiles=None,
+                     hash_input=False):
+    """Queue a conversion job; returns an error response if the queue or the client's quota is full
+
+    Jobs are fair-queued by client and weighted by their estimated cost; an
+    upload still streaming in (``source``) has no header to estimate from
+    yet, so it counts as an average job. ``hash_input`` is passed on to
+    ``convert_audio``.
+    """
+    args = (temp_path, app.config['CONVERTED_FOLDER'], task_id, source, input_sha256, profiles)
+    client = request_client()
+    cost = converter.estimate_cost(temp_path) if source is None else None
+    # The scheduler passes jobs positional arguments only
+    convert, traced = convert_audio, traced_convert_audio
+    if hash_input:
+        convert = functools.partial(convert_audio, hash_input=True)
+        traced = functools.partial(traced_convert_audio, hash_input=True)
+    try:
+        if leased_jobs():
+            position = enqueue_leased_job(task_id, temp_path, source, input_sha256, profiles,
+                                          hash_input)
+        elif tracing.get(task_id) is not None:
+            position = get_scheduler().submit(task_id, traced,
+                                              task_id, time.perf_counter(), *args,
+                                              client=client, cost=cost)
+        else:
+            position = get_scheduler().submit(task_id, convert, *args,
+                                              client=client, cost=cost)
+    except QueueFull as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        delete_task(task_id)
+        tracing.discard(task_id)
+        logger.warning(f"Conversion rejected ({e.reason}) for upload {task_id} from {client}")
+        metrics.ERRORS.labels(e.reason).inc()
+        response = jsonify({'error': rejection(e), 'reason': e.reason,
+                            'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    
+    # Only mark as queued if a worker hasn't already picked the job up
+    update_task(task_id, lambda current: dict(current, status='queued', position=position)
+                if current and current.get('status') == 'pending' else current)
+    
+    logger.info(f"Queued conversion for task {task_id} at position {position}")
+    return None
+
+def enqueue_leased_job(task_id, temp_path, source, input_sha256, profiles, hash_input=False):
+    """Put a job in the shared queue for any process to claim; returns its position
+
+    An upload that is still streaming in can only be converted here, so it is
+    queued already leased to this process, with no ``size`` until
+    ``finish_streamed_job`` records it. If this process dies, another one
+    converts the saved file once the lease runs out, or fails the task if
+    the upload hadn't all arrived.
+    """
+    queue = get_job_queue()
+    dispatcher = get_dispatcher()
+    payload = {'input_path': temp_path, 'input_sha256': input_sha256, 'profiles': profiles,
+               'hash_input': hash_input, 'enqueued': time.time()}
+    if source is not None:
+        payload['size'] = None
+        queue.enqueue(task_id, payload, owner=dispatcher.owner,
+                      lease_seconds=app.config['LEASE_SECONDS'])
+        dispatcher.hold(task_id)
+        try:
+            return get_scheduler().submit(task_id, run_claimed_job, task_id, payload, source)
+        except QueueFull:
+            dispatcher.done(task_id)
+            raise
+    
+    position = queue.enqueue(task_id, payload, limit=app.config['CONVERSION_QUEUE_SIZE'])
+    if position is None:
+        raise QueueFull(get_scheduler().retry_after())
+    dispatcher.wake()
+    return position
+
+def finish_streamed_job(task_id, size, input_sha256):
+    """Record that a streamed upload queued in the shared queue has all arrived"""
+    if leased_jobs():
+        get_job_queue().update(task_id, {'size': size, 'input_sha256': input_sha256})
+
+def upload_incomplete(payload):
+    """Whether a claimed job's input is a streamed upload that never finished arriving"""
+    if 'size' not in payload:
+        return False
+    if payload['size'] is None:
+        return True
+    try:
+        return os.path.getsize(payload['input_path']) < payload['size']
+    except OSError:
+        return True
+
+def ingest_upload_stream():
+    """Read a multipart upload incrementally so conversion overlaps the transfer
+
+    The file part is written to the upload folder chunk by chunk and hashed on
+    the fly. The conversion job is queued as soon as the part starts and reads
+    the file through a ``GrowingFile`` while the rest of the body arrives.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if not boundary:
+        return jsonify({'error': 'No file part'}), 400
+    
+    # The body is consumed as it streams, so profiles come from the query string
+    try:
+        profiles = parse_profiles(request.args.getlist('profiles'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not os.access(app.config['UPLOAD_FOLDER'], os.W_OK):
+        logger.error(f"Upload directory {app.config['UPLOAD_FOLDER']} is not writable")
+        return jsonify({'error': 'Server configuration error: upload directory not writable'}), 500
+    
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=500 * 1024)
+    stream = request.stream
+    task_id = temp_path = out = source = None
+    hasher = hashlib.sha256()
+    size = 0
+    in_audio_part = False
+    
+    try:
+        while True:
+            event = decoder.next_event()
+            if event is NEED_DATA:
+                chunk = stream.read(converter.STREAM_CHUNK_SIZE)
+                decoder.receive_data(chunk or None)
+            elif isinstance(event, File) and event.name == 'audiofile' and task_id is None:
+                if event.filename == '':
+                    return jsonify({'error': 'No selected file'}), 400
+                
+                # Generate a unique ID for this conversion task
+                task_id = str(uuid.uuid4())
+                filename = secure_filename(event.filename)
+                temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{task_id}_{filename}")
+                
+                save_task(task_id, {
+                    'status': 'pending',
+                    'progress': 0,
+                    'timestamp': time.time()
+                })
+                schedule_expiry(task_id, [temp_path])
+                if trace_requested():
+                    start_trace(task_id)
+                out = open(temp_path, 'wb')
+                source = converter.GrowingFile(temp_path)
+                
+                error_response = queue_conversion(task_id, temp_path, source, profiles=profiles)
+                if error_response:
+                    out.close()
+                    out = None
+                    return error_response
+                in_audio_part = True
+            elif isinstance(event, (Field, File)):
+                in_audio_part = False
+            elif isinstance(event, Data) and in_audio_part:
+                out.write(event.data)
+                out.flush()
+                hasher.update(event.data)
+                size += len(event.data)
+                source.extend(size)
+                if not event.more_data:
+                    in_audio_part = False
+            elif isinstance(event, Epilogue):
+                break
+    except Exception as e:
+        if source is not None:
+            source.abort()
+            if out is not None:
+                out.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            save_task(task_id, {
+                'status': 'error',
+                'error': 'Upload did not complete',
+                'timestamp': time.time()
+            })
+        if isinstance(e, HTTPException):
+            raise
+        logger.error(f"Exception during streaming upload: {e}")
+        return jsonify({'error': 'An internal error occurred.'}), 500
+    
+    if task_id is None:
+        return jsonify({'error': 'No file part'}), 400
+    
+    out.close()
+    if size == 0:
+        source.abort()
+        os.remove(temp_path)
+        save_task(task_id, {
+            'status': 'error',
+            'error': 'Uploaded file is empty',
+            'timestamp': time.time()
+        })
+        return jsonify({'error': 'Uploaded file is empty'}), 400
+    
+    finish_streamed_job(task_id, size, hasher.hexdigest())
+    source.finish(hasher.hexdigest())
+    logger.info(f"Received {size} bytes for task {task_id} while converting")
+    return jsonify({'task_id': task_id})
+
+def accept_upload(file, profiles=None, traced=False):
+    """Save one uploaded file and queue its conversion to each of ``profiles``
+
+    Returns ``(task_id, error_response)``; ``error_response`` is None when the
+    file was queued or served from the cache. ``traced`` records a trace of
+    the task (see ``tracing``).
+    """
+    # Generate a unique ID for this conversion task
+    task_id = str(uuid.uuid4())
+    if traced:
+        start_trace(task_id)
+    with tracing.activate(task_id):
+        return save_and_queue(task_id, file, profiles)
+
+def save_and_queue(task_id, file, profiles):
+    """The body of ``accept_upload``, run with the task's trace active"""
+    # Save uploaded file
+    filename = secure_filename(file.filename)
+    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{task_id}_{filename}")
+    
+    # Save the task as pending
+    save_task(task_id, {
+        'status': 'pending',
+        'progress': 0,
+        'timestamp': time.time()
+    })
+    schedule_expiry(task_id, [temp_path])
+    
+    with tracing.span('upload.save'):
+        size, input_sha256 = save_upload(file, temp_path)
+    
+    # Check if file is empty
+    if size == 0:
+        tracing.discard(task_id)
+        os.remove(temp_path)
+        save_task(task_id, {
+            'status': 'error',
+            'error': 'Uploaded file is empty',
+            'timestamp': time.time()
+        })
+        return task_id, (jsonify({'error': 'Uploaded file is empty'}), 400)
+    
+    return task_id, queue_saved_upload(task_id, temp_path, input_sha256, profiles)
+
+def queue_saved_upload(task_id, temp_path, input_sha256, profiles):
+    """Convert a fully saved upload; returns an error response if the queue is full"""
+    # Identical input was converted before - reuse the result
+    with tracing.span('upload.cache_lookup'):
+        cached = complete_from_cache(task_id, temp_path, input_sha256, profiles)
+    if cached:
+        finish_trace(task_id)
+        return None
+    
+    # Queue the conversion; shed load when every worker and queue slot is busy
+    with tracing.span('upload.queue'):
+        return queue_conversion(task_id, temp_path, input_sha256=input_sha256, profiles=profiles)
+
+def requested_profiles():
+    """Profiles named by the ``profiles`` form field or query parameter"""
+    return parse_profiles(request.form.getlist('profiles') + request.args.getlist('profiles'))
+
+def upload_folder_writable():
+    if os.access(app.config['UPLOAD_FOLDER'], os.W_OK):
+        return True
+    logger.error(f"Upload directory {app.config['UPLOAD_FOLDER']} is not writable")
+    return False
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    if app.config['STREAMING_INGEST'] and request.mimetype == 'multipart/form-data':
+        return ingest_upload_stream()
+    
     if 'audiofile' not in request.files:
         return jsonify({'error': 'No file part'}), 400
         
@@ -353,75 +1482,577 @@ def upload_file():
     
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
+    
+    try:
+        profiles = requested_profiles()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
         
     if file:
         try:
-            # Generate a unique ID for this conversion task
-            task_id = str(uuid.uuid4())
-            
-            # Save uploaded file
-            filename = secure_filename(file.filename)
-            temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{task_id}_{filename}")
-            
             # Test directory permissions before saving
-            if not os.access(app.config['UPLOAD_FOLDER'], os.W_OK):
-                logger.error(f"Upload directory {app.config['UPLOAD_FOLDER']} is not writable")
+            if not upload_folder_writable():
                 return jsonify({'error': 'Server configuration error: upload directory not writable'}), 500
             
-            # Save the task as pending
-            save_task(task_id, {
-                'status': 'pending',
-                'progress': 0,
-                'timestamp': time.time()
-            })
-            
-            file.save(temp_path)
-            
-            # Check if file is empty
-            if os.path.getsize(temp_path) == 0:
-                os.remove(temp_path)
-                save_task(task_id, {
-                    'status': 'error',
-                    'error': 'Uploaded file is empty',
-                    'timestamp': time.time()
-                })
-                return jsonify({'error': 'Uploaded file is empty'}), 400
-            
-            # Start conversion in a background thread
-            conversion_thread = threading.Thread(
-                target=convert_audio,
-                args=(temp_path, app.config['CONVERTED_FOLDER'], task_id)
-            )
-            conversion_thread.daemon = True
-            conversion_thread.start()
-            
-            logger.info(f"Started conversion for task {task_id}")
+            task_id, error_response = accept_upload(file, profiles, traced=trace_requested())
+            if error_response:
+                return error_response
             
             return jsonify({'task_id': task_id})
         except Exception as e:
             logger.error(f"Exception during file upload: {e}")
             return jsonify({'error': 'An internal error occurred.'}), 500
 
+def batch_key(batch_id):
+    """Task store key for a batch record"""
+    return f"batch:{batch_id}"
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Accept several files in one request and queue a conversion for each"""
+    files = [file for file in request.files.getlist('audiofiles') if file.filename]
+    
+    if not files:
+        return jsonify({'error': 'No selected files'}), 400
+    
+    if len(files) > app.config['BATCH_MAX_FILES']:
+        return jsonify({'error': f"Too many files, the limit is {app.config['BATCH_MAX_FILES']}"}), 400
+    
+    try:
+        profiles = requested_profiles()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not upload_folder_writable():
+        return jsonify({'error': 'Server configuration error: upload directory not writable'}), 500
+    
+    # Take the whole batch or none of it, rather than converting half of it
+    scheduler = get_scheduler()
+    client = request_client()
+    try:
+        if not leased_jobs():
+            scheduler.check_quota(client, [converter.estimate_cost(file.stream) for file in files])
+        if scheduler.free_slots() < len(files):
+            raise QueueFull(scheduler.retry_after())
+    except QueueFull as e:
+        logger.warning(f"Batch of {len(files)} files rejected ({e.reason}) from {client}")
+        metrics.ERRORS.labels(e.reason).inc()
+        response = jsonify({'error': rejection(e), 'reason': e.reason,
+                            'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    
+    batch_id = str(uuid.uuid4())
+    entries = []
+    try:
+        for file in files:
+            task_id, error_response = accept_upload(file, profiles, traced=trace_requested())
+            entry = {'task_id': task_id, 'filename': secure_filename(file.filename)}
+            if error_response:
+                entry['error'] = error_response[0].get_json()['error']
+            entries.append(entry)
+        save_task(batch_key(batch_id), {'tasks': entries, 'timestamp': time.time()})
+        schedule_expiry(batch_key(batch_id))
+    except Exception as e:
+        logger.error(f"Exception during batch upload: {e}")
+        return jsonify({'error': 'An internal error occurred.'}), 500
+    
+    logger.info(f"Accepted batch {batch_id} with {len(entries)} files")
+    return jsonify({'batch_id': batch_id, 'tasks': entries})
+
+def upload_key(task_id):
+    """Task store key for the record of a resumable upload"""
+    return f"upload:{task_id}"
+
+def tus_response(status=204, headers=None, body=None):
+    """A response to a resumable upload request, carrying the protocol version"""
+    response = jsonify(body) if body is not None else Response(status=status)
+    response.status_code = status
+    response.headers['Tus-Resumable'] = resumable.TUS_VERSION
+    response.headers.update(headers or {})
+    return response
+
+def tus_error(message, status):
+    return tus_response(status, body={'error': message})
+
+def tus_version_error():
+    """A 412 response if the client speaks another protocol version, else None"""
+    if request.headers.get('Tus-Resumable') == resumable.TUS_VERSION:
+        return None
+    return tus_response(412, {'Tus-Version': resumable.TUS_VERSION},
+                        body={'error': f"Tus-Resumable {resumable.TUS_VERSION} is required"})
+
+def upload_offset(upload):
+    """The gap-free prefix of an upload received so far"""
+    return upload['length'] if upload['complete'] else resumable.contiguous(upload['ranges'])
+
+def upload_offset_headers(upload):
+    """Upload-Offset is the gap-free prefix; Upload-Ranges lists every range received"""
+    return {'Upload-Offset': str(upload_offset(upload)), 'Upload-Length': str(upload['length']),
+            'Upload-Ranges': resumable.format_ranges(upload['ranges']), 'Cache-Control': 'no-store'}
+
+@app.route('/uploads', methods=['OPTIONS'])
+def resumable_options():
+    """Advertise the resumable upload protocol and its limits"""
+    return tus_response(headers={
+        'Tus-Version': resumable.TUS_VERSION,
+        'Tus-Extension': 'creation,checksum,termination',
+        'Tus-Max-Size': str(int(app.config['RESUMABLE_MAX_MB'] * 1024 * 1024)),
+        'Tus-Checksum-Algorithm': ','.join(resumable.CHECKSUM_ALGORITHMS),
+    })
+
+@app.route('/uploads', methods=['POST'])
+def create_resumable_upload():
+    """Start a resumable upload; its ID is the ID of the conversion task"""
+    error = tus_version_error()
+    if error:
+        return error
+    
+    length = request.headers.get('Upload-Length', type=int)
+    if length is None or length < 0:
+        return tus_error('Upload-Length is required', 400)
+    if length == 0:
+        return tus_error('Uploaded file is empty', 400)
+    if length > app.config['RESUMABLE_MAX_MB'] * 1024 * 1024:
+        return tus_error(f"File size exceeds {app.config['RESUMABLE_MAX_MB']:g}MB limit", 413)
+    
+    try:
+        metadata = resumable.parse_metadata(request.headers.get('Upload-Metadata'))
+        profiles = parse_profiles([metadata.get('profiles', '')])
+    except ValueError as e:
+        return tus_error(str(e), 400)
+    filename = secure_filename(metadata.get('filename', ''))
+    if not filename:
+        return tus_error('No selected file', 400)
+    
+    if not upload_folder_writable():
+        return tus_error('Server configuration error: upload directory not writable', 500)
+    
+    # Space is used as chunks arrive, so this is only a check, not a reservation
+    if shutil.disk_usage(app.config['UPLOAD_FOLDER']).free < length:
+        logger.error(f"Not enough free space for a resumable upload of {length} bytes")
+        return tus_error('Not enough space for this upload', 507)
+    
+    task_id = str(uuid.uuid4())
+    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{task_id}_{filename}")
+    try:
+        resumable.create_upload_file(temp_path, length)
+    except OSError as e:
+        logger.error(f"Failed to create the file for upload {task_id}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return tus_error('Not enough space for this upload', 507)
+    
+    now = time.time()
+    save_task(upload_key(task_id), {'length': length, 'filename': filename, 'profiles': profiles,
+                                    'path': temp_path, 'ranges': [], 'complete': False,
+                                    'timestamp': now})
+    save_task(task_id, {'status': 'uploading', 'progress': 0, 'timestamp': now})
+    schedule_expiry(task_id, [temp_path])
+    schedule_expiry(upload_key(task_id))
+    
+    logger.info(f"Created resumable upload {task_id} for {length} bytes")
+    return tus_response(201, {'Location': f"/uploads/{task_id}", 'Upload-Offset': '0'},
+                        body={'task_id': task_id})
+
+@app.route('/uploads/<task_id>', methods=['HEAD'])
+def resumable_upload_offset(task_id):
+    """Report how much of an upload the server has, so the client can resume"""
+    error = tus_version_error()
+    if error:
+        return error
+    upload = get_task(upload_key(task_id))
+    if upload is None:
+        return tus_response(404, {'Cache-Control': 'no-store'})
+    return tus_response(200, upload_offset_headers(upload))
+
+@app.route('/uploads/<task_id>', methods=['PATCH'])
+def patch_resumable_upload(task_id):
+    """Write one chunk of an upload at its Upload-Offset
+
+    Chunks may arrive in any order and in parallel. The request that completes
+    the file queues its conversion.
+    """
+    error = tus_version_error()
+    if error:
+        return error
+    if request.mimetype != 'application/offset+octet-stream':
+        return tus_error('Content-Type must be application/offset+octet-stream', 415)
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None or offset < 0:
+        return tus_error('Upload-Offset is required', 400)
+    try:
+        checksum = resumable.parse_checksum(request.headers.get('Upload-Checksum'))
+    except ValueError as e:
+        return tus_error(str(e), 400)
+    
+    upload = get_task(upload_key(task_id))
+    if upload is None:
+        return tus_error('Upload not found', 404)
+    if upload['complete']:
+        # A retried chunk that already landed
+        return tus_response(204, upload_offset_headers(upload))
+    
+    remaining = upload['length'] - offset
+    chunk_length = request.content_length if request.content_length is not None else remaining
+    if offset >= upload['length'] or chunk_length > remaining:
+        return tus_error('Chunk runs past the end of the upload', 400)
+    
+    try:
+        written = resumable.write_chunk(request.stream, upload['path'], offset, chunk_length, checksum,
+                                        received=upload['ranges'])
+    except resumable.ChecksumMismatch as e:
+        logger.warning(f"Rejected chunk of upload {task_id}: {e}")
+        return tus_error('Checksum mismatch', 460)
+    except FileNotFoundError:
+        return tus_error('Upload not found', 404)
+    except OSError as e:
+        # The disk filled up since the upload was created; the chunk can be retried later
+        logger.error(f"Failed to write chunk of upload {task_id}: {e}")
+        return tus_error('Not enough space for this upload', 507)
+    
+    finished = False
+    
+    def record_chunk(current):
+        nonlocal finished
+        if current is None or current['complete'] or not written:
+            return current
+        ranges = resumable.add_range(current['ranges'], offset, offset + written)
+        finished = ranges == [[0, current['length']]]
+        return dict(current, ranges=ranges, complete=finished, timestamp=time.time())
+    
+    upload = update_task(upload_key(task_id), record_chunk)
+    if upload is None:
+        return tus_error('Upload not found', 404)
+    schedule_expiry(task_id, [upload['path']])
+    schedule_expiry(upload_key(task_id))
+    
+    if finished:
+        error_response = finish_resumable_upload(task_id, upload)
+        if error_response:
+            # The queue was full and the file is gone; the client starts over
+            delete_task(upload_key(task_id))
+            return error_response
+    return tus_response(204, upload_offset_headers(upload))
+
+def finish_resumable_upload(task_id, upload):
+    """Queue the conversion of a completed upload; returns an error response if the queue is full
+
+    The worker hashes the file and checks the cache, so the request carrying
+    the last chunk doesn't read the whole upload back.
+    """
+    save_task(task_id, {'status': 'pending', 'progress': 0, 'timestamp': time.time()})
+    logger.info(f"Received all {upload['length']} bytes of resumable upload {task_id}")
+    return queue_conversion(task_id, upload['path'], profiles=upload['profiles'], hash_input=True)
+
+@app.route('/uploads/<task_id>', methods=['DELETE'])
+def delete_resumable_upload(task_id):
+    """Abandon an upload that hasn't finished"""
+    error = tus_version_error()
+    if error:
+        return error
+    upload = get_task(upload_key(task_id))
+    if upload is None:
+        return tus_error('Upload not found', 404)
+    if upload['complete']:
+        return tus_error('Upload already finished', 409)
+    try:
+        os.remove(upload['path'])
+    except FileNotFoundError:
+        pass
+    delete_tasks([task_id, upload_key(task_id)])
+    logger.info(f"Deleted resumable upload {task_id}")
+    return tus_response(204)
+
+def current_status(task_id):
+    """The status payload for task_id, including live in-memory details"""
+    task = get_task(task_id)
+    
+    if task is None:
+        return {'status': 'unknown'}
+    
+    if task_id.startswith('upload:'):
+        # The record holds server-side paths; report only what HEAD /uploads/<id> does
+        return {'status': 'complete' if task['complete'] else 'uploading',
+                'offset': upload_offset(task), 'length': task['length'], 'ranges': task['ranges']}
+    if 'status' not in task:
+        # Some other record kept in the task store, such as a batch
+        return {'status': 'unknown'}
+    
+    if task.get('status') == 'processing':
+        # Progress between store flushes lives in memory
+        live = get_progress_tracker().get(task_id)
+        if live is not None:
+            task = live
+    
+    if task.get('status') == 'queued':
+        # Queue positions move as jobs start, so report the live value
+        if leased_jobs():
+            position = get_job_queue().position(task_id)
+        else:
+            # Under asgi.py single uploads wait on its event loop, batches in the thread pool
+            position = None
+            for scheduler in (_async_scheduler, get_scheduler()):
+                position = scheduler.position(task_id) if scheduler is not None else None
+                if position is not None:
+                    # Waiting for the same client's other jobs rather than for a free worker
+                    if scheduler.deferred(task_id):
+                        task['deferred'] = True
+                    break
+        if position is not None:
+            task['position'] = position
+    
+    return task
+
+def status_version(task):
+    """Short content hash of a status payload, used as its version"""
+    return hashlib.sha1(json.dumps(task, sort_keys=True).encode()).hexdigest()[:16]
+
+def wait_for_status_change(task_id, since, timeout):
+    """Return (payload, version) once the status differs from ``since`` or timeout expires
+
+    Waiters sleep on in-process notifications. They also re-read the store every
+    STATUS_RECHECK_SECONDS to catch changes made by other worker processes.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        seen = task_notifier.version(task_id)
+        task = current_status(task_id)
+        version = status_version(task)
+        remaining = deadline - time.monotonic()
+        if version != since or remaining <= 0 or task['status'] == 'unknown':
+            return task, version
+        task_notifier.wait(task_id, seen, min(remaining, app.config['STATUS_RECHECK_SECONDS']))
+
+_status_waiters = None
+
+def acquire_status_waiter():
+    """Reserve one of the limited long-poll/SSE slots; returns False if none are free"""
+    global _status_waiters
+    with _task_store_lock:
+        if _status_waiters is None:
+            _status_waiters = threading.BoundedSemaphore(app.config['STATUS_MAX_WAITERS'])
+    return _status_waiters.acquire(blocking=False)
+
+def release_status_waiter():
+    _status_waiters.release()
+
 @app.route('/status/<task_id>')
 def check_status(task_id):
-    # Get task from file
-    tasks = get_tasks()
+    since = request.args.get('since')
     
-    if task_id not in tasks:
+    if since is not None and acquire_status_waiter():
+        # Long-poll: hold the request until the status changes
+        try:
+            wait = min(request.args.get('wait', app.config['STATUS_MAX_WAIT_SECONDS'], type=float),
+                       app.config['STATUS_MAX_WAIT_SECONDS'])
+            task, version = wait_for_status_change(task_id, since, max(wait, 0))
+        finally:
+            release_status_waiter()
+    else:
+        task = current_status(task_id)
+        version = status_version(task)
+    
+    if task['status'] == 'unknown':
         logger.warning(f"Task ID not found: {task_id}")
+    
+    return jsonify(dict(task, version=version))
+
+def is_admin():
+    """Whether the request carries the ADMIN_TOKEN as a bearer token"""
+    token = app.config['ADMIN_TOKEN']
+    supplied = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+
+@app.route('/status/<task_id>/trace')
+def task_trace(task_id):
+    """Admin only: the task's trace, or its cProfile stats with ?profile=text|raw"""
+    if not app.config['ADMIN_TOKEN']:
+        return jsonify({'error': 'Not found'}), 404
+    if not is_admin():
+        return jsonify({'error': 'Admin token required'}), 403
+    
+    profile = request.args.get('profile')
+    if profile:
+        path = profile_path(task_id)
+        if not os.path.exists(path):
+            return jsonify({'error': 'No profile for this task'}), 404
+        if profile == 'raw':
+            return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                             download_name=os.path.basename(path))
+        return Response(tracing.profile_summary(path), mimetype='text/plain')
+    
+    # A running task's trace is still in memory; finished ones are on disk
+    trace = tracing.get(task_id)
+    record = trace.to_dict() if trace is not None else tracing.read(trace_path(task_id))
+    if record is None:
+        return jsonify({'error': 'No trace for this task'}), 404
+    return jsonify(record)
+
+@app.route('/status/batch/<batch_id>')
+def check_batch_status(batch_id):
+    batch = get_task(batch_key(batch_id))
+    
+    if batch is None:
+        logger.warning(f"Batch ID not found: {batch_id}")
         return jsonify({'status': 'unknown'})
     
-    return jsonify(tasks[task_id])
+    tasks = []
+    for entry in batch['tasks']:
+        task = current_status(entry['task_id']) if 'error' not in entry else {
+            'status': 'error', 'error': entry['error']}
+        tasks.append(dict(task, task_id=entry['task_id'], original_filename=entry['filename']))
+    
+    completed = sum(1 for task in tasks if task['status'] == 'complete')
+    finished = sum(1 for task in tasks if task['status'] in ('complete', 'error', 'unknown'))
+    progress = sum(100 if task['status'] in ('complete', 'error', 'unknown')
+                   else task.get('progress', 0) for task in tasks) / len(tasks)
+    
+    return jsonify({
+        'status': 'complete' if finished == len(tasks) else 'processing',
+        'progress': int(progress),
+        'total': len(tasks),
+        'completed': completed,
+        'failed': finished - completed,
+        'tasks': tasks
+    })
+
+@app.route('/status/<task_id>/events')
+def status_events(task_id):
+    """Server-Sent Events stream of status changes for one task"""
+    if not acquire_status_waiter():
+        # Too many open streams; the client falls back to polling
+        return jsonify({'error': 'Too many status streams, poll /status instead'}), 503
+    
+    since = request.headers.get('Last-Event-ID')
+    
+    def generate():
+        version = since
+        deadline = time.monotonic() + app.config['STATUS_STREAM_SECONDS']
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            timeout = min(remaining, app.config['STATUS_HEARTBEAT_SECONDS'])
+            task, new_version = wait_for_status_change(task_id, version, timeout)
+            if new_version == version:
+                yield ": keepalive\n\n"
+                continue
+            version = new_version
+            yield f"id: {version}\nevent: status\ndata: {json.dumps(dict(task, version=version))}\n\n"
+            if task['status'] in ('complete', 'error', 'unknown'):
+                return
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    # Closing the response frees the slot even if the stream was never started
+    response.call_on_close(release_status_waiter)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stop proxies from buffering the stream
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics, merged across every worker process"""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats')
+def cache_stats():
+    cache = get_cache()
+    if cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(cache.stats(), enabled=True))
+
+class CompletionTracker:
+    """Download file object that calls ``on_complete`` if every byte was sent
+
+    WSGI servers close the body whether or not the client received all of
+    it, so how far the transfer got is tracked on the file itself. The
+    server's file wrapper (and so its sendfile) still sends it: reads move
+    the file position as bytes go out, and ``socket.sendfile`` seeks it past
+    the bytes it sent.
+    """
+
+    def __init__(self, file, expected, on_complete):
+        self.file = file
+        self.expected = expected
+        self.on_complete = on_complete
+        self.sent = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sent = max(self.sent, self.file.tell())
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        position = self.file.seek(offset, whence)
+        self.sent = max(self.sent, position)
+        return position
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        if self.sent == self.expected:
+            self.on_complete()
+
+def offload_response(file_path, download_name, etag):
+    """Empty response telling the front proxy to send file_path itself
+
+    The proxy serves the bytes (with sendfile and its own Range handling), so
+    no app worker is tied up for the transfer.
+    """
+    response = Response(mimetype='audio/wav')
+    if app.config['DOWNLOAD_OFFLOAD'] == 'x-accel-redirect':
+        # nginx maps this internal location onto CONVERTED_FOLDER
+        response.headers['X-Accel-Redirect'] = (app.config['DOWNLOAD_ACCEL_PREFIX']
+                                                + quote(os.path.basename(file_path)))
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(file_path)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+def delete_downloaded(task_id, file_path):
+    """Remove a fully downloaded output, and expire its task once no outputs are left"""
+    try:
+        os.remove(file_path)
+        logger.info(f"Deleted {file_path} after download")
+    except FileNotFoundError:
+        pass
+    task = get_task(task_id)
+    if task is None or not any(os.path.exists(path) for path in output_files(completed_outputs(task))):
+        schedule_expiry(task_id, delay=0, shorten_only=True)
+
+def download_etag(task_id, task, profile, file_path):
+    """ETag of a task's output in profile"""
+    # Output bytes are determined by the input and profile, so the cache key makes a strong ETag
+    if task.get('input_sha256'):
+        return cache_key(task['input_sha256'], profile)
+    stat = os.stat(file_path)
+    return f"{task_id}-{profile}-{stat.st_size}-{int(stat.st_mtime)}"
 
 @app.route('/download/<task_id>')
 def download_file(task_id):
-    # Get task from file
-    tasks = get_tasks()
+    task = get_task(task_id)
     
-    if task_id not in tasks or tasks[task_id]['status'] != 'complete':
+    if task is None or task.get('status') != 'complete':
         return jsonify({'error': 'File not found or conversion not complete'}), 404
+    
+    outputs = completed_outputs(task)
+    profile = request.args.get('profile', task.get('profile', converter.DEFAULT_PROFILE))
+    if profile not in outputs:
+        return jsonify({'error': f"Profile {profile} was not converted for this task"}), 404
         
-    file_path = tasks[task_id]['output_path']
+    file_path = outputs[profile]['output_path']
+    download_name = outputs[profile]['filename']
     
     if not os.path.exists(file_path):
         logger.error(f"Output file does not exist: {file_path}")
@@ -432,18 +2063,75 @@ def download_file(task_id):
         })
         return jsonify({'error': 'Output file not found on server'}), 404
     
-    directory = os.path.dirname(file_path)
-    filename = os.path.basename(file_path)
+    # Expire the task and its files shortly after the download, unless that's already sooner
+    schedule_expiry(task_id, output_files(outputs), delay=app.config['DOWNLOAD_RETENTION_SECONDS'],
+                    shorten_only=True)
     
-    # Schedule cleanup of the task (but keep the file for now)
-    def cleanup_status():
-        time.sleep(300)  # 5 minutes
-        delete_task(task_id)
+    etag = download_etag(task_id, task, profile, file_path)
     
-    threading.Thread(target=cleanup_status, daemon=True).start()
+    if app.config['DOWNLOAD_OFFLOAD']:
+        return offload_response(file_path, download_name, etag)
     
-    return send_from_directory(directory, filename, as_attachment=True, 
-                              download_name=tasks[task_id]['filename'])
+    # Conditional and Range requests get 304/206 responses from send_file. Relative
+    # paths are relative to the working directory, not Flask's root path
+    response = send_file(os.path.abspath(file_path), mimetype='audio/wav', as_attachment=True,
+                         download_name=download_name, etag=etag, conditional=True)
+    
+    # Only a full transfer finishes the download; the end of a range may be a
+    # resumed download's last piece or just a player seeking to the end
+    if app.config['DELETE_AFTER_DOWNLOAD'] and response.status_code == 200:
+        response.response.close()
+        response.response = wrap_file(request.environ, CompletionTracker(
+            open(file_path, 'rb'), response.content_length, lambda: delete_downloaded(task_id, file_path)))
+    
+    return response
+
+def batch_members(batch):
+    """(arcname, path) pairs for a batch's converted files, with unique names"""
+    members = []
+    used = set()
+    for entry in batch['tasks']:
+        task = get_task(entry['task_id'])
+        if task is None or task['status'] != 'complete':
+            continue
+        for output in completed_outputs(task).values():
+            if not os.path.exists(output['output_path']):
+                continue
+            base_name, ext = os.path.splitext(output['filename'])
+            arcname = output['filename']
+            suffix = 1
+            while arcname in used:
+                suffix += 1
+                arcname = f"{base_name}_{suffix}{ext}"
+            used.add(arcname)
+            members.append((arcname, output['output_path']))
+    return members
+
+@app.route('/download/batch/<batch_id>')
+def download_batch(batch_id):
+    """Stream a ZIP of every converted file in a batch"""
+    batch = get_task(batch_key(batch_id))
+    
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    pending = [entry['task_id'] for entry in batch['tasks'] if 'error' not in entry
+               and (get_task(entry['task_id']) or {}).get('status') not in ('complete', 'error', None)]
+    if pending:
+        return jsonify({'error': 'Batch conversion not complete', 'pending': len(pending)}), 409
+    
+    members = batch_members(batch)
+    if not members:
+        return jsonify({'error': 'No converted files in batch'}), 404
+    
+    logger.info(f"Streaming {len(members)} files for batch {batch_id}")
+    response = Response(stream_with_context(iter_zip(members)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="wav-maker-{batch_id[:8]}.zip"'
+    return response
+
+# Start claiming shared jobs (but not in a spawned conversion process)
+if __name__ != '__mp_main__' and leased_jobs():
+    get_dispatcher()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=False)
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""
+Streamed ZIP archives.
+
+``iter_zip`` yields a ZIP file piece by piece while reading its members from
+disk in fixed-size chunks, so a download of many converted files never builds
+the archive in memory or in a temporary file.
+"""
+import io
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _StreamBuffer(io.RawIOBase):
+    """Non-seekable sink that hands written bytes back to the generator"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(members, chunk_size=CHUNK_SIZE):
+    """Yield the bytes of a ZIP archive containing ``members``.
+
+    ``members`` is an iterable of ``(arcname, path)`` pairs. Entries are stored
+    uncompressed; PCM audio gains little from deflate and it would cost CPU
+    on every download. Because the output isn't seekable, zipfile writes sizes
+    and CRCs in data descriptors after each entry.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for arcname, path in members:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as source, archive.open(info, 'w') as dest:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    # Closing the archive writes the central directory
+    data = buffer.drain()
+    if data:
+        yield data
@@ -0,0 +1,576 @@
+"""
+asyncio serving mode.
+
+``asgi:app`` serves the same routes as the Flask app to an ASGI server::
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Uploads and downloads are handled on the event loop as non-blocking streams,
+so a client sending or receiving slowly holds a coroutine and a socket rather
+than a worker thread. An upload is converted once it has arrived, by
+``app.convert_audio`` in a thread: at most ASYNC_MAX_SUBPROCESSES at a time,
+with up to CONVERSION_QUEUE_SIZE more waiting in an ``AsyncScheduler``.
+
+Every other route (the page, status polling and events, batches, metrics) is
+run by the Flask app in a pool of ASYNC_WSGI_THREADS threads, so the Flask
+app itself is unchanged and can still be served by gunicorn.
+"""
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import http_date, parse_if_range_header, parse_options_header, parse_range_header, quote_etag
+from werkzeug.sansio.http import is_resource_modified
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NEED_DATA
+from werkzeug.utils import secure_filename
+
+import app as web
+import converter
+import metrics
+import tracing
+from scheduler import AsyncScheduler, QueueFull
+
+logger = logging.getLogger(__name__)
+flask_app = web.app
+
+DOWNLOAD_ROUTE = re.compile(r'/download/([^/]+)')
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+_END = object()
+
+
+class RequestTooLarge(Exception):
+    """The request body is larger than MAX_CONTENT_LENGTH"""
+
+
+class ClientDisconnected(Exception):
+    """The client went away before its request body arrived"""
+
+
+def run_sync(fn, *args, executor=None, context=None):
+    """Await a blocking call run in a thread, in a copy of the caller's context (and so its trace)"""
+    context = context or contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(context.run, fn, *args))
+
+
+def request_headers(scope):
+    return Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                    for name, value in scope['headers']])
+
+
+def query_params(scope):
+    return parse_qs(scope['query_string'].decode('latin-1'))
+
+
+async def send_response(send, status, headers=(), body=b''):
+    """Send a complete response"""
+    headers = Headers(headers)
+    if body or 'Content-Length' not in headers:
+        headers['Content-Length'] = str(len(body))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers.items()]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, status, data, headers=()):
+    headers = Headers(headers)
+    headers['Content-Type'] = 'application/json'
+    await send_response(send, status, headers, json.dumps(data).encode() + b'\n')
+
+
+async def watch_disconnect(receive, disconnected):
+    """Set ``disconnected`` once the client goes away (after its body has been read)"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+
+
+def wsgi_environ(scope, body, content_length):
+    """PEP 3333 environ for an ASGI HTTP request whose body has been read into ``body``"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(content_length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ[name] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """ASGI application for a Flask app, with uploads and downloads served on the event loop"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.scheduler = None
+        self.executor = None
+        self.conversion_executor = None
+
+    def get_scheduler(self):
+        """Return the scheduler for conversions run on the event loop"""
+        if self.scheduler is None:
+            workers = flask_app.config['ASYNC_MAX_SUBPROCESSES']
+            self.scheduler = AsyncScheduler(workers=workers,
+                                            max_queue=flask_app.config['CONVERSION_QUEUE_SIZE'],
+                                            **web.client_limits(workers))
+            web.use_async_scheduler(self.scheduler)
+            logger.info(f"Running up to {self.scheduler.workers} conversions on the event loop "
+                        f"(queue size {self.scheduler.max_queue})")
+        return self.scheduler
+
+    def get_conversion_executor(self):
+        """Return the thread pool conversions run in, one thread per scheduler worker"""
+        if self.conversion_executor is None:
+            self.conversion_executor = ThreadPoolExecutor(max_workers=self.get_scheduler().workers,
+                                                thread_name_prefix='convert')
+        return self.conversion_executor
+
+    def get_executor(self):
+        """Return the thread pool the Flask routes run in"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=flask_app.config['ASYNC_WSGI_THREADS'],
+                                               thread_name_prefix='wsgi')
+        return self.executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+
+        method, path = scope['method'], scope['path']
+        download = DOWNLOAD_ROUTE.fullmatch(path)
+        if method == 'POST' and path == '/upload':
+            await self.upload(scope, receive, send)
+        elif download and method in ('GET', 'HEAD') and not flask_app.config['DOWNLOAD_OFFLOAD']:
+            await self.download(scope, receive, send, download.group(1))
+        else:
+            await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Unfinished tasks are left to expire, as when a threaded worker exits
+                if self.scheduler is not None:
+                    await self.scheduler.shutdown(wait=False)
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                if self.conversion_executor is not None:
+                    self.conversion_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def call_wsgi(self, scope, receive, send):
+        """Run the request through the Flask app in a thread, streaming its response"""
+        max_length = flask_app.config['MAX_CONTENT_LENGTH']
+        # Small bodies stay in memory; a batch upload spills to disk
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as body:
+            size = 0
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if max_length and size > max_length:
+                    await send_json(send, 413, {'error': 'Request is too large'})
+                    return
+                body.write(chunk)
+                more_body = message.get('more_body', False)
+            body.seek(0)
+
+            disconnected = asyncio.Event()
+            watcher = asyncio.ensure_future(watch_disconnect(receive, disconnected))
+            try:
+                await self.stream_wsgi(wsgi_environ(scope, body, size), send, disconnected)
+            finally:
+                watcher.cancel()
+
+    async def stream_wsgi(self, environ, send, disconnected):
+        executor = self.get_executor()
+        # One context for the whole response, so Flask's context survives between chunks
+        context = contextvars.copy_context()
+        response = {}
+        pending = []
+
+        def write(data):
+            # Legacy apps may write before (or while) returning their iterable; it goes out first
+            pending.append(data)
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return write
+
+        result = await run_sync(self.wsgi_app, environ, start_response,
+                                executor=executor, context=context)
+        try:
+            chunks = iter(result)
+            chunk = await run_sync(next, chunks, _END, executor=executor, context=context)
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in response['headers']]})
+            # Event streams end when the client goes; the next heartbeat notices
+            while not disconnected.is_set():
+                while pending:
+                    await send({'type': 'http.response.body', 'body': pending.pop(0), 'more_body': True})
+                if chunk is _END:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await run_sync(next, chunks, _END, executor=executor, context=context)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await run_sync(result.close, executor=executor, context=context)
+
+    async def upload(self, scope, receive, send):
+        """``POST /upload``: stream the file to disk, then queue its conversion on the event loop"""
+        request_started = time.perf_counter()
+        headers = request_headers(scope)
+        mimetype, options = parse_options_header(headers.get('Content-Type', ''))
+        if mimetype != 'multipart/form-data' or not options.get('boundary'):
+            await send_json(send, 400, {'error': 'No file part'})
+            return
+
+        max_length = flask_app.config['MAX_CONTENT_LENGTH']
+        content_length = headers.get('Content-Length', type=int)
+        if max_length and content_length is not None and content_length > max_length:
+            await send_json(send, 413, {'error': 'Request is too large'})
+            return
+
+        if not web.upload_folder_writable():
+            await send_json(send, 500, {'error': 'Server configuration error: upload directory not writable'})
+            return
+
+        upload = {'task_id': None, 'temp_path': None, 'filename': None, 'size': 0, 'sha256': None}
+        fields = {}
+        try:
+            await self.receive_upload(receive, options['boundary'], upload, fields)
+        except Exception as e:
+            if upload['temp_path'] and os.path.exists(upload['temp_path']):
+                os.remove(upload['temp_path'])
+            if upload['task_id']:
+                await run_sync(web.save_task, upload['task_id'], {
+                    'status': 'error',
+                    'error': 'Upload did not complete',
+                    'timestamp': time.time()
+                })
+            if isinstance(e, ClientDisconnected):
+                return
+            if isinstance(e, RequestTooLarge):
+                await send_json(send, 413, {'error': 'Request is too large'})
+            elif isinstance(e, ValueError):
+                await send_json(send, 400, {'error': 'Upload did not complete'})
+            else:
+                logger.error(f"Exception during file upload: {e}")
+                await send_json(send, 500, {'error': 'An internal error occurred.'})
+            return
+
+        task_id, temp_path = upload['task_id'], upload['temp_path']
+        if task_id is None:
+            error = 'No selected file' if upload['filename'] == '' else 'No file part'
+            await send_json(send, 400, {'error': error})
+            return
+
+        try:
+            profiles = web.parse_profiles(fields.get('profiles', []) + query_params(scope).get('profiles', []))
+        except ValueError as e:
+            os.remove(temp_path)
+            await run_sync(web.delete_task, task_id)
+            await send_json(send, 400, {'error': str(e)})
+            return
+
+        if upload['size'] == 0:
+            os.remove(temp_path)
+            await run_sync(web.save_task, task_id, {
+                'status': 'error',
+                'error': 'Uploaded file is empty',
+                'timestamp': time.time()
+            })
+            await send_json(send, 400, {'error': 'Uploaded file is empty'})
+            return
+
+        if flask_app.config['TRACE_TASKS'] or headers.get('X-Trace', '').lower() in ('1', 'true'):
+            trace = tracing.start(task_id, started=request_started)
+            trace.add('upload.receive', start=request_started,
+                      duration=time.perf_counter() - request_started)
+        try:
+            with tracing.activate(task_id):
+                client = web.client_key(headers, (scope.get('client') or (None,))[0])
+                status, data, response_headers = await self.queue_upload(
+                    task_id, temp_path, upload['sha256'], profiles, client)
+        except Exception as e:
+            logger.error(f"Exception during file upload: {e}")
+            status, data, response_headers = 500, {'error': 'An internal error occurred.'}, ()
+        await send_json(send, status, data, response_headers)
+
+    async def receive_upload(self, receive, boundary, upload, fields):
+        """Read the multipart body, writing the ``audiofile`` part to the upload folder
+
+        The part is hashed as it arrives and written from a thread, so a slow
+        disk doesn't stall the event loop. Other form fields are collected into
+        ``fields``; ``upload`` is filled in as the file part is seen.
+        """
+        decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=500 * 1024)
+        max_length = flask_app.config['MAX_CONTENT_LENGTH']
+        hasher = hashlib.sha256()
+        received = 0
+        pending = b''
+        more_body = True
+        out = None
+        in_audio_part = False
+        field_name = None
+        field = bytearray()
+        try:
+            while True:
+                event = decoder.next_event()
+                if event is NEED_DATA:
+                    if not pending and more_body:
+                        message = await receive()
+                        if message['type'] == 'http.disconnect':
+                            raise ClientDisconnected()
+                        pending = message.get('body', b'')
+                        more_body = message.get('more_body', False)
+                        received += len(pending)
+                        if max_length and received > max_length:
+                            raise RequestTooLarge()
+                    # Feed the decoder in small pieces, whatever size the server's messages are
+                    if pending:
+                        decoder.receive_data(pending[:converter.STREAM_CHUNK_SIZE])
+                        pending = pending[converter.STREAM_CHUNK_SIZE:]
+                    elif not more_body:
+                        decoder.receive_data(None)
+                elif isinstance(event, File) and event.name == 'audiofile' and upload['task_id'] is None:
+                    upload['filename'] = event.filename
+                    if event.filename == '':
+                        continue
+                    task_id = str(uuid.uuid4())
+                    temp_path = os.path.join(flask_app.config['UPLOAD_FOLDER'],
+                                             f"{task_id}_{secure_filename(event.filename)}")
+                    await run_sync(web.save_task, task_id, {
+                        'status': 'pending',
+                        'progress': 0,
+                        'timestamp': time.time()
+                    })
+                    await run_sync(web.schedule_expiry, task_id, [temp_path])
+                    upload['task_id'], upload['temp_path'] = task_id, temp_path
+                    out = await run_sync(open, temp_path, 'wb')
+                    in_audio_part = True
+                elif isinstance(event, (Field, File)):
+                    in_audio_part = False
+                    field_name = event.name if isinstance(event, Field) else None
+                    field.clear()
+                elif isinstance(event, Data):
+                    if in_audio_part:
+                        await run_sync(out.write, event.data)
+                        hasher.update(event.data)
+                        upload['size'] += len(event.data)
+                    elif field_name is not None:
+                        field.extend(event.data)
+                    if not event.more_data:
+                        if field_name is not None:
+                            fields.setdefault(field_name, []).append(field.decode('utf-8', 'replace'))
+                        in_audio_part = False
+                        field_name = None
+                elif isinstance(event, Epilogue):
+                    break
+        finally:
+            if out is not None:
+                await run_sync(out.close)
+        upload['sha256'] = hasher.hexdigest()
+
+    async def queue_upload(self, task_id, temp_path, input_sha256, profiles, client=None):
+        """Complete a received upload from the cache or queue its conversion
+
+        Returns the response as ``(status, data, headers)``.
+        """
+        with tracing.span('upload.cache_lookup'):
+            cached = await run_sync(web.complete_from_cache, task_id, temp_path, input_sha256, profiles)
+        if cached:
+            await run_sync(web.finish_trace, task_id)
+            return 200, {'task_id': task_id}, ()
+
+        try:
+            with tracing.span('upload.queue'):
+                if web.leased_jobs():
+                    # The shared queue's jobs are claimed by the threaded workers
+                    position = await run_sync(web.enqueue_leased_job, task_id, temp_path, None,
+                                              input_sha256, profiles)
+                else:
+                    cost = await run_sync(converter.estimate_cost, temp_path)
+                    position = self.get_scheduler().submit(task_id, self.convert, task_id, temp_path,
+                                                           input_sha256, profiles, time.perf_counter(),
+                                                           client=client, cost=cost)
+        except QueueFull as e:
+            os.remove(temp_path)
+            await run_sync(web.delete_task, task_id)
+            tracing.discard(task_id)
+            logger.warning(f"Conversion rejected ({e.reason}) for upload {task_id} from {client}")
+            metrics.ERRORS.labels(e.reason).inc()
+            return (429, {'error': web.rejection(e), 'reason': e.reason, 'retry_after': e.retry_after},
+                    {'Retry-After': str(e.retry_after)})
+
+        # Only mark as queued if the job hasn't already started
+        await run_sync(web.update_task, task_id,
+                       lambda current: dict(current, status='queued', position=position)
+                       if current and current.get('status') == 'pending' else current)
+        logger.info(f"Queued conversion for task {task_id} at position {position}")
+        return 200, {'task_id': task_id}, ()
+
+    async def convert(self, task_id, input_path, input_sha256, profiles, queued):
+        """Conversion job for the event loop: ``app.convert_audio`` in a conversion thread"""
+        args = (input_path, flask_app.config['CONVERTED_FOLDER'], task_id, None, input_sha256, profiles)
+        if tracing.get(task_id) is not None:
+            await run_sync(web.traced_convert_audio, task_id, queued, *args,
+                           executor=self.get_conversion_executor())
+        else:
+            await run_sync(web.convert_audio, *args, executor=self.get_conversion_executor())
+
+    async def download(self, scope, receive, send, task_id):
+        """``GET /download/<task_id>``: send the file from the event loop, with Range and ETag support"""
+        query = query_params(scope)
+        headers = request_headers(scope)
+        task = await run_sync(web.get_task, task_id)
+
+        if task is None or task.get('status') != 'complete':
+            await send_json(send, 404, {'error': 'File not found or conversion not complete'})
+            return
+
+        outputs = web.completed_outputs(task)
+        profile = query.get('profile', [task.get('profile', converter.DEFAULT_PROFILE)])[0]
+        if profile not in outputs:
+            await send_json(send, 404, {'error': f"Profile {profile} was not converted for this task"})
+            return
+
+        file_path = outputs[profile]['output_path']
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            logger.error(f"Output file does not exist: {file_path}")
+            await run_sync(web.save_task, task_id, {
+                'status': 'error',
+                'error': 'Output file not found on server',
+                'timestamp': time.time()
+            })
+            await send_json(send, 404, {'error': 'Output file not found on server'})
+            return
+
+        # Expire the task and its files shortly after the download, unless that's already sooner
+        await run_sync(functools.partial(web.schedule_expiry, task_id, web.output_files(outputs),
+                                         delay=flask_app.config['DOWNLOAD_RETENTION_SECONDS'],
+                                         shorten_only=True))
+
+        etag = await run_sync(web.download_etag, task_id, task, profile, file_path)
+        last_modified = http_date(stat.st_mtime)
+        response_headers = Headers()
+        response_headers['Content-Type'] = 'audio/wav'
+        response_headers.set('Content-Disposition', 'attachment', filename=outputs[profile]['filename'])
+        response_headers['ETag'] = quote_etag(etag)
+        response_headers['Last-Modified'] = last_modified
+        response_headers['Cache-Control'] = 'no-cache'
+        response_headers['Accept-Ranges'] = 'bytes'
+
+        if not is_resource_modified(http_if_modified_since=headers.get('If-Modified-Since'),
+                                    http_if_none_match=headers.get('If-None-Match'),
+                                    etag=etag, last_modified=last_modified):
+            await send_response(send, 304, response_headers)
+            return
+
+        size = stat.st_size
+        start, stop, status = 0, size, 200
+        byte_range = parse_range_header(headers.get('Range'))
+        if byte_range is not None and headers.get('If-Range'):
+            # A stale If-Range gets the whole file
+            if parse_if_range_header(headers['If-Range']).etag != etag:
+                byte_range = None
+        if byte_range is not None:
+            bounds = byte_range.range_for_length(size)
+            if bounds is None:
+                response_headers['Content-Range'] = f"bytes */{size}"
+                await send_response(send, 416, response_headers)
+                return
+            (start, stop), status = bounds, 206
+            response_headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+        response_headers['Content-Length'] = str(stop - start)
+
+        if scope['method'] == 'HEAD':
+            await send_response(send, status, response_headers)
+            return
+
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(watch_disconnect(receive, disconnected))
+        sent = 0
+        try:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in response_headers.items()]})
+            with open(file_path, 'rb') as f:
+                f.seek(start)
+                while sent < stop - start and not disconnected.is_set():
+                    chunk = await run_sync(f.read, min(DOWNLOAD_CHUNK_SIZE, stop - start - sent))
+                    if not chunk:
+                        break
+                    # Waits while the client is slow to read; no thread is held meanwhile
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    sent += len(chunk)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            # The server reports sends to a closed connection this way
+            return
+        finally:
+            watcher.cancel()
+
+        # Only a full transfer finishes the download, not a range ending at the end of the file
+        if (flask_app.config['DELETE_AFTER_DOWNLOAD'] and status == 200 and sent == size
+                and not disconnected.is_set()):
+            await run_sync(web.delete_downloaded, task_id, file_path)
+
+
+app = AsgiApp(flask_app)
@@ -0,0 +1,274 @@
+"""
+End-to-end conversion benchmark suite with a regression gate.
+
+Generates a synthetic corpus (a tone plus seeded noise, so every run gets the
+same input) in WAV, FLAC and MP3, mono and stereo, from 8kHz to 96kHz and from
+seconds to an hour long. Each file is then converted with ``app.convert_audio``
+exactly as a queued upload would be, including probing and verification.
+
+Each conversion runs in a fresh child process so its peak RSS can be measured.
+Wall time, CPU time (including ffmpeg child processes), peak RSS and
+audio-seconds converted per second are recorded per case; the median of
+``--repeat`` runs is kept. Results are written as a JSON baseline, and
+``compare`` fails with exit status 1 when a case regresses beyond a threshold.
+
+MP3 and FLAC inputs are encoded with ffmpeg, so those cases are skipped when it
+isn't installed. The generated corpus is kept in ``--corpus-dir`` between runs.
+Set ``CONVERSION_ENGINE``, ``NUMPY_ENGINE`` or ``VERIFY_MODE`` in the
+environment to benchmark other configurations; they are recorded in the results.
+
+Usage:
+    python benchmarks/bench_convert.py run --suite quick --output baseline.json
+    python benchmarks/bench_convert.py run --suite quick --output current.json --compare baseline.json
+    python benchmarks/bench_convert.py compare baseline.json current.json --threshold 0.15
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+import zlib
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_DIR)
+
+CONFIG_VARIABLES = ('CONVERSION_ENGINE', 'NUMPY_ENGINE', 'VERIFY_MODE')
+BLOCK_FRAMES = 1 << 20
+
+# (format, sample rate, channels, seconds)
+SUITES = {
+    'quick': [
+        ('wav', 8000, 1, 5),
+        ('wav', 44100, 2, 60),
+        ('wav', 96000, 2, 60),
+        ('flac', 48000, 2, 60),
+        ('mp3', 44100, 2, 60),
+        ('mp3', 22050, 1, 600),
+    ],
+    'full': sorted(
+        # Every format, channel count and rate at one minute...
+        {(fmt, rate, channels, 60)
+         for fmt in ('wav', 'flac', 'mp3')
+         for rate in (8000, 16000, 22050, 44100, 48000, 96000)
+         for channels in (1, 2)
+         if not (fmt == 'mp3' and rate > 48000)}
+        # ...and lengths from 5 seconds to an hour
+        | {(fmt, 44100, 2, seconds)
+           for fmt in ('wav', 'flac', 'mp3')
+           for seconds in (5, 60, 600, 3600)}),
+}
+METRICS = ('wall_seconds', 'cpu_seconds', 'peak_rss_mb')
+# Changes smaller than these are noise, whatever the percentage
+MIN_CHANGE = {'wall_seconds': 0.05, 'cpu_seconds': 0.05, 'peak_rss_mb': 10}
+
+
+def case_name(fmt, rate, channels, seconds):
+    return f"{fmt}-{rate}hz-{channels}ch-{seconds}s"
+
+
+def write_wav(path, rate, channels, seconds, seed):
+    """Write a 16-bit WAV of a 440Hz tone plus seeded noise, in blocks"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    frames = int(rate * seconds)
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        for start in range(0, frames, BLOCK_FRAMES):
+            t = np.arange(start, min(start + BLOCK_FRAMES, frames)) / rate
+            tone = 0.4 * np.sin(2 * np.pi * 440 * t)
+            signal = tone[:, None] + 0.05 * rng.standard_normal((len(t), channels))
+            wav.writeframes((np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes())
+
+
+def corpus_file(corpus_dir, case):
+    """Return the corpus file for ``case``, generating it if needed (None if it can't be)"""
+    fmt, rate, channels, seconds = case
+    name = case_name(*case)
+    path = os.path.join(corpus_dir, f"{name}.{fmt}")
+    if os.path.exists(path):
+        return path
+    if fmt != 'wav' and shutil.which('ffmpeg') is None:
+        return None
+    os.makedirs(corpus_dir, exist_ok=True)
+    wav_path = path if fmt == 'wav' else os.path.join(corpus_dir, f"{name}.source.wav")
+    write_wav(wav_path + '.tmp', rate, channels, seconds, zlib.crc32(name.encode()))
+    os.replace(wav_path + '.tmp', wav_path)
+    if fmt != 'wav':
+        temp_path = f"{path}.tmp.{fmt}"
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', wav_path, '-bitexact', temp_path], check=True)
+        os.replace(temp_path, path)
+        os.remove(wav_path)
+    return path
+
+
+def run_case(input_path):
+    """Convert input_path in this process and print its measurements as JSON"""
+    workdir = tempfile.mkdtemp()
+    # Measure the conversion alone: no cache, no shared metrics files
+    os.environ['CACHE_MAX_MB'] = '0'
+    os.environ['METRICS_DIR'] = ''
+    os.environ['TASK_DB'] = os.path.join(workdir, 'tasks.db')
+    os.chdir(workdir)  # The app creates its temp folders in the working directory
+    import logging
+    logging.disable(logging.INFO)
+    import app
+    app.app.config['CONVERTED_FOLDER'] = workdir
+    upload_path = os.path.join(workdir, os.path.basename(input_path))
+    shutil.copyfile(input_path, upload_path)
+    os.chdir(REPO_DIR)
+
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    app.convert_audio(upload_path, workdir, 'bench-task')
+    wall = time.perf_counter() - start
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    task = app.get_task('bench-task')
+    cpu = sum(getattr(after, field) - getattr(before, field)
+              for before, after in ((before_self, after_self), (before_children, after_children))
+              for field in ('ru_utime', 'ru_stime'))
+    # ru_maxrss is in kilobytes on Linux; the children figure is the largest ffmpeg
+    peak_rss = max(after_self.ru_maxrss, after_children.ru_maxrss) / 1024
+    json.dump({'status': task['status'], 'error': task.get('error'), 'wall_seconds': wall,
+               'cpu_seconds': cpu, 'peak_rss_mb': peak_rss}, sys.stdout)
+    shutil.rmtree(workdir)
+
+
+def measure(input_path, seconds, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), 'run-case', input_path],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        if result['status'] != 'complete':
+            raise RuntimeError(f"Conversion of {input_path} failed: {result['error']}")
+        runs.append(result)
+    wall = statistics.median(run['wall_seconds'] for run in runs)
+    return {
+        'audio_seconds': seconds,
+        'wall_seconds': round(wall, 4),
+        'cpu_seconds': round(statistics.median(run['cpu_seconds'] for run in runs), 4),
+        'peak_rss_mb': round(max(run['peak_rss_mb'] for run in runs), 1),
+        'audio_seconds_per_second': round(seconds / wall, 1),
+    }
+
+
+def environment():
+    ffmpeg = None
+    if shutil.which('ffmpeg'):
+        version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout
+        ffmpeg = version.splitlines()[0] if version else None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'ffmpeg': ffmpeg,
+        'config': {name: os.environ[name] for name in CONFIG_VARIABLES if name in os.environ},
+    }
+
+
+def compare(baseline, current, threshold, rss_threshold):
+    """Return a list of regressions of current against baseline.
+
+    Time metrics regress when they grow by more than ``threshold`` (a
+    fraction), peak RSS when it grows by more than ``rss_threshold``, and
+    either way by more than ``MIN_CHANGE``. Cases missing from either side
+    are ignored.
+    """
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for metric in METRICS:
+            limit = rss_threshold if metric == 'peak_rss_mb' else threshold
+            if (result[metric] > base[metric] * (1 + limit)
+                    and result[metric] - base[metric] > MIN_CHANGE[metric]):
+                regressions.append(f"{name}: {metric} {base[metric]:g} -> {result[metric]:g} "
+                                   f"(+{(result[metric] / max(base[metric], 1e-9) - 1) * 100:.0f}%)")
+    return regressions
+
+
+def report_comparison(baseline_path, current, threshold, rss_threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get('environment', {}).get('config') != current.get('environment', {}).get('config'):
+        print("Warning: baseline was recorded with a different engine configuration")
+    regressions = compare(baseline, current, threshold, rss_threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        return 1
+    print(f"No regressions against {baseline_path}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='generate the corpus and benchmark it')
+    run_parser.add_argument('--suite', choices=sorted(SUITES), default='quick')
+    run_parser.add_argument('--cases', nargs='+', help='only run cases whose name contains one of these')
+    run_parser.add_argument('--repeat', type=int, default=3, help='runs per case (the median is kept)')
+    run_parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'wav-maker-bench-corpus'))
+    run_parser.add_argument('--output', help='write results to this JSON file')
+    run_parser.add_argument('--compare', metavar='BASELINE', help='fail on regressions against this baseline')
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--threshold', type=float, default=0.15,
+                         help='allowed fractional increase in wall and CPU time')
+        sub.add_argument('--rss-threshold', type=float, default=0.25,
+                         help='allowed fractional increase in peak RSS')
+    run_case_parser = commands.add_parser('run-case')
+    run_case_parser.add_argument('input_path')
+    args = parser.parse_args()
+
+    if args.command == 'run-case':
+        run_case(args.input_path)
+        return
+    if args.command == 'compare':
+        with open(args.current) as f:
+            current = json.load(f)
+        sys.exit(report_comparison(args.baseline, current, args.threshold, args.rss_threshold))
+
+    import converter
+    if converter.np is None:
+        sys.exit("NumPy is needed to generate the corpus")
+    cases = [case for case in SUITES[args.suite]
+             if not args.cases or any(part in case_name(*case) for part in args.cases)]
+    results = {}
+    print(f"{'case':<28} {'wall':>9} {'cpu':>9} {'rss':>8} {'audio s/s':>10}")
+    for case in cases:
+        name = case_name(*case)
+        input_path = corpus_file(args.corpus_dir, case)
+        if input_path is None:
+            print(f"{name:<28} skipped (ffmpeg not found)")
+            continue
+        result = results[name] = measure(input_path, case[3], args.repeat)
+        print(f"{name:<28} {result['wall_seconds']:>8.3f}s {result['cpu_seconds']:>8.3f}s "
+              f"{result['peak_rss_mb']:>6.1f}MB {result['audio_seconds_per_second']:>10.1f}")
+
+    current = {'suite': args.suite, 'repeat': args.repeat, 'created': time.time(),
+               'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.compare:
+        sys.exit(report_comparison(args.compare, current, args.threshold, args.rss_threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark per-file conversion latency of the NumPy and ffmpeg engines.
+
+Writes a 44.1kHz stereo 16-bit PCM WAV of each length, then times a complete
+conversion to mono 8kHz 16-bit with each engine. The ffmpeg timing includes
+the ``mediainfo`` probe the app runs first, since the NumPy engine replaces
+both subprocesses.
+
+Usage:
+    python benchmarks/bench_engines.py --seconds 2 10 60 600
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from pydub.utils import mediainfo
+
+import converter
+
+
+def write_input(path, seconds, rate=44100):
+    np = converter.np
+    t = np.arange(int(seconds * rate)) / rate
+    signal = 0.4 * np.sin(2 * np.pi * 440 * t) + 0.1 * np.sin(2 * np.pi * 7000 * t)
+    pcm = np.repeat((signal * 32767).astype('<i2')[:, None], 2, axis=1)
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+
+
+def run_numpy(input_path, output_path):
+    converter.transcode_numpy(input_path, output_path)
+
+
+def run_ffmpeg(input_path, output_path):
+    mediainfo(input_path)
+    converter.transcode_streaming(input_path, output_path)
+
+
+def best_time(fn, input_path, output_path, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(input_path, output_path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, nargs='+', default=[2, 10, 60, 600],
+                        help='input lengths to test, in seconds of audio')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per engine (best is reported)')
+    args = parser.parse_args()
+
+    if converter.np is None:
+        sys.exit("NumPy is not installed")
+    have_ffmpeg = shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None
+    if not have_ffmpeg:
+        print("ffmpeg/ffprobe not found; timing the NumPy engine only")
+
+    workdir = tempfile.mkdtemp()
+    input_path = os.path.join(workdir, 'in.wav')
+    output_path = os.path.join(workdir, 'out.wav')
+    print(f"{'seconds':>8} {'numpy':>10} {'ffmpeg':>10} {'speedup':>8}")
+    for seconds in args.seconds:
+        write_input(input_path, seconds)
+        numpy_time = best_time(run_numpy, input_path, output_path, args.repeat)
+        if have_ffmpeg:
+            ffmpeg_time = best_time(run_ffmpeg, input_path, output_path, args.repeat)
+            print(f"{seconds:>8g} {numpy_time * 1000:>8.1f}ms {ffmpeg_time * 1000:>8.1f}ms "
+                  f"{ffmpeg_time / numpy_time:>7.1f}x")
+        else:
+            print(f"{seconds:>8g} {numpy_time * 1000:>8.1f}ms {'-':>10} {'-':>8}")
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
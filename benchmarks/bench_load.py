@@ -0,0 +1,362 @@
+"""
+Load test of a locally started instance: uploads, status polls and downloads together.
+
+Starts the app the way the Dockerfile does (gunicorn, or uvicorn with
+``--server asgi``) on a local port in a scratch directory, then runs
+``--clients`` simulated users for ``--duration`` seconds. Each user uploads a
+file picked from ``--mix``, polls ``/status/<task_id>`` every
+``--poll-interval`` seconds until it finishes, downloads the result and starts
+over. Inputs are the synthetic ``bench_convert`` corpus, so nothing leaves the
+machine; MP3 and FLAC entries need ffmpeg.
+
+Reported:
+
+* p50/p95/p99 latency and error count per endpoint (upload, status, download)
+* conversions per minute and the overall error rate; uploads turned away with
+  HTTP 429 are counted separately and retried after ``Retry-After``
+* time spent waiting for the task store lock, from the server's ``/metrics``
+* peak memory of the server's process tree (gunicorn, its workers and their
+  ffmpeg children) and of the container's cgroup when it can be read. The
+  cgroup includes this load generator.
+
+Usage:
+    python benchmarks/bench_load.py
+    python benchmarks/bench_load.py --clients 16 --duration 120 --mix wav:44100:2:10=3 mp3:44100:2:60=1
+    python benchmarks/bench_load.py --workers 4 --output load.json
+"""
+import argparse
+import asyncio
+import collections
+import importlib.util
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from bench_convert import case_name, corpus_file
+from bench_slow_clients import (BOUNDARY, REPO_DIR, free_port, http_request, multipart_head,
+                                server_command, wait_until_ready)
+
+ENDPOINTS = ('upload', 'status', 'download')
+LOCK_WAIT_METRIC = 'wavmaker_task_store_lock_wait_seconds'
+CGROUP_MEMORY_FILES = ('/sys/fs/cgroup/memory.current',  # cgroup v2
+                       '/sys/fs/cgroup/memory/memory.usage_in_bytes')  # cgroup v1
+
+
+def parse_mix(entries):
+    """``format:rate:channels:seconds[=weight]`` entries as ``(case, weight)`` pairs"""
+    mix = []
+    for entry in entries:
+        spec, _, weight = entry.partition('=')
+        fmt, rate, channels, seconds = spec.split(':')
+        mix.append(((fmt, int(rate), int(channels), int(seconds)), float(weight or 1)))
+    return mix
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class Stats:
+    """Latencies and outcomes collected by every simulated user"""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.failure_reasons = collections.Counter()
+
+    async def request(self, endpoint, port, method, path, body=b'', headers=None, timeout=60):
+        """Time one request; returns (status, body), status 0 if it didn't complete"""
+        started = time.perf_counter()
+        try:
+            status, payload = await http_request(port, method, path, body, headers, timeout=timeout)
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            status, payload = 0, b''
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        if status != 200 and not (endpoint == 'upload' and status == 429):
+            self.errors[endpoint] += 1
+        return status, payload
+
+    def requests(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+
+async def user(port, bodies, weights, rng, stats, deadline, poll_interval):
+    """Upload, poll and download in a loop until the deadline passes"""
+    headers = {'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'}
+    while time.monotonic() < deadline:
+        body = rng.choices(bodies, weights)[0]
+        status, payload = await stats.request('upload', port, 'POST', '/upload', body, headers)
+        if status == 429:
+            stats.rejected += 1
+            retry_after = json.loads(payload).get('retry_after', 1)
+            await asyncio.sleep(min(retry_after, max(deadline - time.monotonic(), 0)))
+            continue
+        if status != 200:
+            continue
+        task_id = json.loads(payload)['task_id']
+
+        while True:
+            await asyncio.sleep(poll_interval)
+            status, payload = await stats.request('status', port, 'GET', f'/status/{task_id}', timeout=10)
+            if status != 200:
+                continue
+            task = json.loads(payload)
+            if task['status'] in ('complete', 'error', 'unknown'):
+                break
+        if task['status'] != 'complete':
+            stats.failed += 1
+            stats.failure_reasons[task.get('error', task['status'])] += 1
+            continue
+        stats.completed += 1
+        await stats.request('download', port, 'GET', f'/download/{task_id}')
+
+
+def read_lock_wait(text):
+    """Total seconds and acquisitions of the task store lock, summed over backends"""
+    totals = {'sum': 0.0, 'count': 0.0}
+    for line in text.splitlines():
+        for suffix in totals:
+            if line.startswith(f"{LOCK_WAIT_METRIC}_{suffix}"):
+                totals[suffix] += float(line.rsplit(' ', 1)[1])
+    return totals
+
+
+async def scrape_lock_wait(port):
+    status, payload = await http_request(port, 'GET', '/metrics')
+    return read_lock_wait(payload.decode()) if status == 200 else None
+
+
+def process_tree(pid):
+    """pid and every process descended from it"""
+    children = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name is in parentheses and may contain spaces
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[parent].append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children[current])
+    return tree
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def cgroup_memory():
+    for path in CGROUP_MEMORY_FILES:
+        try:
+            with open(path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """Records the peak memory of a process tree and of the cgroup while running"""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_tree = 0
+        self.peak_cgroup = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_tree = max(self.peak_tree, sum(rss_bytes(pid) for pid in process_tree(self.pid)))
+            current = cgroup_memory()
+            if current is not None:
+                self.peak_cgroup = max(self.peak_cgroup or 0, current)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def megabytes(value):
+    return None if value is None else round(value / (1024 * 1024), 1)
+
+
+def milliseconds(value):
+    return None if value is None else round(value * 1000, 1)
+
+
+def upload_bodies(mix, corpus_dir):
+    """The multipart body of each mix entry, skipping formats that can't be generated"""
+    bodies, weights = [], []
+    for case, weight in mix:
+        path = corpus_file(corpus_dir, case)
+        if path is None:
+            print(f"{case_name(*case)}: skipped (ffmpeg is not installed)")
+            continue
+        with open(path, 'rb') as f:
+            bodies.append(multipart_head(os.path.basename(path)) + f.read()
+                          + f'\r\n--{BOUNDARY}--\r\n'.encode())
+        weights.append(weight)
+    if not bodies:
+        raise SystemExit("No input in the mix can be generated")
+    return bodies, weights
+
+
+async def run_load(port, process, bodies, weights, args):
+    await wait_until_ready(port, process)
+    before = await scrape_lock_wait(port)
+    stats = Stats()
+    sampler = MemorySampler(process.pid)
+    sampler.start()
+    started = time.monotonic()
+    deadline = started + args.duration
+    rng = random.Random(args.seed)
+    users = [user(port, bodies, weights, random.Random(rng.random()), stats, deadline, args.poll_interval)
+             for _ in range(args.clients)]
+    try:
+        # Users finish the task they are on after the deadline, within --drain seconds
+        await asyncio.wait_for(asyncio.gather(*users), args.duration + args.drain)
+    except asyncio.TimeoutError:
+        print(f"Some tasks were still running {args.drain}s after the deadline")
+    elapsed = time.monotonic() - started
+    sampler.stop()
+
+    # Each worker writes its metrics every METRICS_FLUSH_SECONDS
+    await asyncio.sleep(1.5)
+    after = await scrape_lock_wait(port)
+    return report(stats, elapsed, before, after, sampler)
+
+
+def report(stats, elapsed, before, after, sampler):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        latencies = stats.latencies[endpoint]
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'errors': stats.errors[endpoint],
+            'p50_ms': milliseconds(percentile(latencies, 50)),
+            'p95_ms': milliseconds(percentile(latencies, 95)),
+            'p99_ms': milliseconds(percentile(latencies, 99)),
+        }
+    failures = sum(stats.errors.values()) + stats.failed
+    result = {
+        'elapsed_seconds': round(elapsed, 1),
+        'endpoints': endpoints,
+        'conversions': stats.completed,
+        'conversions_per_minute': round(stats.completed / elapsed * 60, 1),
+        'failed_conversions': stats.failed,
+        'failure_reasons': dict(stats.failure_reasons),
+        'rejected_uploads': stats.rejected,
+        'error_rate': round(failures / max(stats.requests() + stats.failed, 1), 4),
+        'peak_tree_rss_mb': megabytes(sampler.peak_tree),
+        'peak_cgroup_mb': megabytes(sampler.peak_cgroup),
+    }
+    if before is not None and after is not None:
+        waits = after['count'] - before['count']
+        waited = after['sum'] - before['sum']
+        result['lock_wait'] = {
+            'acquisitions': int(waits),
+            'total_seconds': round(waited, 3),
+            'mean_ms': milliseconds(waited / waits) if waits else None,
+        }
+    return result
+
+
+def print_report(result):
+    print(f"{'endpoint':<10} {'requests':>8} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for endpoint, row in result['endpoints'].items():
+        print(f"{endpoint:<10} {row['requests']:>8} {row['errors']:>6} "
+              + ' '.join(f"{'-' if row[key] is None else str(row[key]) + 'ms':>9}"
+                         for key in ('p50_ms', 'p95_ms', 'p99_ms')))
+    print(f"\n{result['conversions']} conversions in {result['elapsed_seconds']}s "
+          f"({result['conversions_per_minute']}/min), {result['failed_conversions']} failed, "
+          f"{result['rejected_uploads']} uploads rejected with 429")
+    for reason, count in result['failure_reasons'].items():
+        print(f"  {count} x {reason}")
+    print(f"Error rate: {result['error_rate'] * 100:.2f}%")
+    lock_wait = result.get('lock_wait')
+    if lock_wait:
+        print(f"Task store lock wait: {lock_wait['total_seconds']}s over {lock_wait['acquisitions']} "
+              f"acquisitions (mean {lock_wait['mean_ms']}ms)")
+    cgroup = result['peak_cgroup_mb']
+    print(f"Peak memory: server processes {result['peak_tree_rss_mb']}MB, "
+          f"container {'-' if cgroup is None else f'{cgroup}MB'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to start new uploads for')
+    parser.add_argument('--drain', type=float, default=120,
+                        help='seconds allowed after --duration for running tasks to finish')
+    parser.add_argument('--mix', nargs='+', default=['wav:44100:2:10=4', 'mp3:44100:2:30=2', 'wav:8000:1:5=2',
+                                                     'flac:48000:2:60=1'],
+                        help='inputs as format:rate:channels:seconds=weight')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='gunicorn worker processes; more than 1 uses JOB_QUEUE=lease')
+    parser.add_argument('--threads', type=int, default=32, help='gunicorn threads (the Dockerfile default)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'wav-maker-corpus'))
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    if args.server == 'asgi' and importlib.util.find_spec('uvicorn') is None:
+        raise SystemExit("uvicorn is not installed")
+    bodies, weights = upload_bodies(parse_mix(args.mix), args.corpus_dir)
+
+    workdir = tempfile.mkdtemp()
+    port = free_port()
+    # The server's own environment (CONVERSION_WORKERS and so on) passes through.
+    # The cache is off so repeated inputs are converted every time
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, CACHE_MAX_MB='0', WEB_CONCURRENCY=str(args.workers),
+               TASK_DB=os.path.join(workdir, 'tasks.db'), METRICS_DIR=os.path.join(workdir, 'metrics'),
+               METRICS_FLUSH_SECONDS='1')
+    if args.workers > 1:
+        env['JOB_QUEUE'] = 'lease'
+    print(f"{args.server}: {args.clients} clients for {args.duration:g}s, {args.workers} worker(s)")
+    process = subprocess.Popen(server_command(args.server, port, args.threads), cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        result = asyncio.run(run_load(port, process, bodies, weights, args))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(result, server=args.server, clients=args.clients, workers=args.workers,
+                           mix=args.mix, duration=args.duration), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""
+Slow-client load comparison of the threaded (gunicorn) and asyncio (uvicorn) modes.
+
+Starts each server on a local port, then opens more and more clients that
+upload or download very slowly, the way phones on bad connections do. While
+they are connected, quick status requests are timed. A level is held when
+every slow client is still connected and every status request was answered
+within ``--probe-timeout``; the report shows the highest level each mode held.
+
+The threaded server is started the way the Dockerfile starts it (gunicorn with
+``--threads``); a slow client there occupies one of its threads for as long as
+it is connected. The asyncio server is ``uvicorn asgi:app``, where a slow
+client is a coroutine. The asyncio mode is skipped when uvicorn isn't
+installed.
+
+Usage:
+    python benchmarks/bench_slow_clients.py
+    python benchmarks/bench_slow_clients.py --modes wsgi asgi --kind download --levels 16 64 256
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BOUNDARY = 'benchboundary'
+
+
+def server_command(mode, port, threads):
+    if mode == 'wsgi':
+        return [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+                '--threads', str(threads), '--timeout', '120', 'app:app']
+    return [sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1', '--port', str(port),
+            '--log-level', 'warning', 'asgi:app']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_download(path, seconds):
+    """A WAV already in the default profile, so the server stores it without converting"""
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(os.urandom(8000 * 2 * seconds))
+
+
+async def http_request(port, method, path, body=b'', headers=None, timeout=10.0):
+    """Minimal HTTP/1.1 request; returns (status, body)"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        lines = [f"{method} {path} HTTP/1.1", "Host: localhost", "Connection: close",
+                 f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1]) if head else 0
+    if b'transfer-encoding: chunked' in head.lower():
+        payload = dechunk(payload)
+    return status, payload
+
+
+def dechunk(data):
+    body = b''
+    while data:
+        size_line, _, data = data.partition(b'\r\n')
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            break
+        body, data = body + data[:size], data[size + 2:]
+    return body
+
+
+def multipart_head(filename):
+    return (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="audiofile"; '
+            f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+
+
+async def upload_file(port, path):
+    with open(path, 'rb') as f:
+        body = multipart_head(os.path.basename(path)) + f.read() + f'\r\n--{BOUNDARY}--\r\n'.encode()
+    status, payload = await http_request(
+        port, 'POST', '/upload', body,
+        {'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'}, timeout=60)
+    if status != 200:
+        raise RuntimeError(f"Upload failed with status {status}: {payload[:200]!r}")
+    task_id = json.loads(payload)['task_id']
+    for _ in range(600):
+        status, payload = await http_request(port, 'GET', f'/status/{task_id}')
+        if json.loads(payload)['status'] in ('complete', 'error'):
+            return task_id
+        await asyncio.sleep(0.1)
+    raise RuntimeError("Upload was not converted in time")
+
+
+async def slow_upload(port, stop, chunk_size, interval):
+    """Upload a never-ending file a few bytes at a time; returns True if it stayed connected"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        head = multipart_head('slow.mp3')
+        writer.write((f"POST /upload HTTP/1.1\r\nHost: localhost\r\n"
+                      f"Content-Type: multipart/form-data; boundary={BOUNDARY}\r\n"
+                      f"Content-Length: {len(head) + 100 * 1024 * 1024}\r\n\r\n").encode() + head)
+        while not stop.is_set():
+            writer.write(b'\0' * chunk_size)
+            await writer.drain()
+            if reader.at_eof():
+                return False
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+        return True
+    except OSError:
+        return False
+    finally:
+        writer.close()
+
+
+async def slow_download(port, task_id, stop, chunk_size, interval):
+    """Read a download a little at a time through a small receive buffer"""
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+    reader, writer = await asyncio.open_connection(sock=sock, limit=chunk_size)
+    try:
+        writer.write(f"GET /download/{task_id} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        await writer.drain()
+        while not stop.is_set():
+            if not await reader.read(chunk_size):
+                return False
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+        return True
+    except OSError:
+        return False
+    finally:
+        writer.close()
+
+
+async def probe(port, task_id, timeout):
+    """Time one quick status request; None if it wasn't answered in time"""
+    started = time.perf_counter()
+    try:
+        status, _ = await http_request(port, 'GET', f'/status/{task_id}', timeout=timeout)
+    except (asyncio.TimeoutError, OSError):
+        return None
+    return time.perf_counter() - started if status == 200 else None
+
+
+async def run_level(port, task_id, args, clients):
+    stop = asyncio.Event()
+    if args.kind == 'upload':
+        slow = [asyncio.ensure_future(slow_upload(port, stop, args.chunk_size, args.interval))
+                for _ in range(clients)]
+    else:
+        slow = [asyncio.ensure_future(slow_download(port, task_id, stop, args.chunk_size, args.interval))
+                for _ in range(clients)]
+    # Let every client get its request in and the server pick them up
+    await asyncio.sleep(args.settle)
+    latencies = []
+    for _ in range(args.probes):
+        latencies.append(await probe(port, task_id, args.probe_timeout))
+        await asyncio.sleep(args.probe_interval)
+    stop.set()
+    connected = sum(1 for result in await asyncio.gather(*slow, return_exceptions=True) if result is True)
+    answered = [latency for latency in latencies if latency is not None]
+    return {
+        'clients': clients,
+        'connected': connected,
+        'probes_answered': len(answered),
+        'probe_p50_ms': round(statistics.median(answered) * 1000, 1) if answered else None,
+        'probe_max_ms': round(max(answered) * 1000, 1) if answered else None,
+        'held': connected == clients and len(answered) == args.probes,
+    }
+
+
+def format_ms(value):
+    return '-' if value is None else f"{value}ms"
+
+
+async def wait_until_ready(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            await http_request(port, 'GET', '/status/ready', timeout=1)
+            return
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def bench_mode(mode, args):
+    workdir = tempfile.mkdtemp()
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, METRICS_DIR='', CACHE_MAX_MB='0',
+               TASK_DB=os.path.join(workdir, 'tasks.db'), WEB_CONCURRENCY='1')
+    # The app creates its temp folders in the working directory
+    process = subprocess.Popen(server_command(mode, port, args.threads), cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return asyncio.run(bench_server(port, process, workdir, args))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def bench_server(port, process, workdir, args):
+    await wait_until_ready(port, process)
+    download_path = os.path.join(workdir, 'download.wav')
+    write_download(download_path, args.download_seconds)
+    task_id = await upload_file(port, download_path)
+    results = []
+    for clients in args.levels:
+        result = await run_level(port, task_id, args, clients)
+        results.append(result)
+        print(f"  {clients:>5} clients: {result['connected']:>5} connected, "
+              f"{result['probes_answered']}/{args.probes} probes answered, "
+              f"p50 {format_ms(result['probe_p50_ms'])}, max {format_ms(result['probe_max_ms'])}"
+              f"{'' if result['held'] else '  (not held)'}")
+        if not result['held'] and not args.keep_going:
+            break
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', choices=['wsgi', 'asgi'], default=['wsgi', 'asgi'])
+    parser.add_argument('--kind', choices=['upload', 'download'], default='upload',
+                        help='what the slow clients do')
+    parser.add_argument('--levels', nargs='+', type=int, default=[8, 16, 32, 64, 128, 256, 512],
+                        help='numbers of concurrent slow clients to try')
+    parser.add_argument('--threads', type=int, default=32, help='gunicorn threads (the Dockerfile default)')
+    parser.add_argument('--chunk-size', type=int, default=512, help='bytes each slow client moves per step')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between slow client steps')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds before probing a level')
+    parser.add_argument('--probes', type=int, default=10)
+    parser.add_argument('--probe-interval', type=float, default=0.2)
+    parser.add_argument('--probe-timeout', type=float, default=2.0)
+    parser.add_argument('--download-seconds', type=int, default=600,
+                        help='length of the downloaded WAV; it must outlast the socket buffers')
+    parser.add_argument('--keep-going', action='store_true', help="try higher levels after one isn't held")
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        if mode == 'asgi' and importlib.util.find_spec('uvicorn') is None:
+            print("asgi: skipped (uvicorn is not installed)")
+            continue
+        print(f"{mode}: {args.kind} clients")
+        results[mode] = bench_mode(mode, args)
+
+    print()
+    for mode, levels in results.items():
+        held = [level['clients'] for level in levels if level['held']]
+        print(f"{mode}: held {max(held) if held else 0} concurrent slow {args.kind} clients")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'kind': args.kind, 'threads': args.threads, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
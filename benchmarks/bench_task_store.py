@@ -0,0 +1,104 @@
+"""
+Benchmark task store backends under concurrent pollers.
+
+Simulates what the app does while conversions run: a pool of clients polling
+``/status`` (single-task reads) while conversion threads write progress
+updates. Reports throughput and read/write latency for each backend.
+
+Usage:
+    python benchmarks/bench_task_store.py --tasks 300 --pollers 32 --writers 8
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from task_store import create_task_store
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run(backend, tasks, pollers, writers, duration):
+    workdir = tempfile.mkdtemp()
+    store = create_task_store(backend, os.path.join(workdir, 'tasks'))
+    task_ids = [f"task-{i}" for i in range(tasks)]
+    for task_id in task_ids:
+        store.put(task_id, {'status': 'processing', 'progress': 0, 'timestamp': time.time()})
+
+    stop = threading.Event()
+    read_latencies = []
+    write_latencies = []
+    lock = threading.Lock()
+
+    def poller():
+        local = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            store.get(random.choice(task_ids))
+            local.append(time.perf_counter() - start)
+        with lock:
+            read_latencies.extend(local)
+
+    def writer():
+        local = []
+        while not stop.is_set():
+            task_id = random.choice(task_ids)
+            start = time.perf_counter()
+            store.update(task_id, lambda current: dict(current, progress=(current['progress'] + 1) % 100))
+            local.append(time.perf_counter() - start)
+        with lock:
+            write_latencies.extend(local)
+
+    threads = [threading.Thread(target=poller) for _ in range(pollers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    store.close()
+
+    return {
+        'backend': backend,
+        'reads_per_sec': len(read_latencies) / duration,
+        'writes_per_sec': len(write_latencies) / duration,
+        'read_p50_ms': statistics.median(read_latencies) * 1000 if read_latencies else 0.0,
+        'read_p99_ms': percentile(read_latencies, 99) * 1000,
+        'write_p50_ms': statistics.median(write_latencies) * 1000 if write_latencies else 0.0,
+        'write_p99_ms': percentile(write_latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=300, help='number of live tasks')
+    parser.add_argument('--pollers', type=int, default=32, help='concurrent status pollers')
+    parser.add_argument('--writers', type=int, default=8, help='concurrent progress writers')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per backend')
+    parser.add_argument('--backends', default='json,sqlite', help='comma-separated backends')
+    args = parser.parse_args()
+
+    print(f"{'backend':<8} {'reads/s':>10} {'writes/s':>10} {'read p50':>10} {'read p99':>10} "
+          f"{'write p50':>10} {'write p99':>10}")
+    for backend in args.backends.split(','):
+        result = run(backend, args.tasks, args.pollers, args.writers, args.duration)
+        print(f"{result['backend']:<8} {result['reads_per_sec']:>10.0f} {result['writes_per_sec']:>10.0f} "
+              f"{result['read_p50_ms']:>8.2f}ms {result['read_p99_ms']:>8.2f}ms "
+              f"{result['write_p50_ms']:>8.2f}ms {result['write_p99_ms']:>8.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark output verification modes.
+
+Writes a converted-format WAV (mono, 8kHz, 16-bit) of the given length plus a
+stand-in input file, then times ``app.verify_output`` in each VERIFY_MODE.
+``full`` decodes the output and hashes both files; ``header`` parses only the
+WAV headers.
+
+Usage:
+    python benchmarks/bench_verify.py --minutes 5 15 60
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app
+
+
+def write_output(path, minutes):
+    frames = int(minutes * 60 * 8000)
+    block = b'\x00\x10\x00\xf0' * 4096
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        remaining = frames * 2
+        while remaining:
+            n = min(remaining, len(block))
+            wav.writeframesraw(block[:n])
+            remaining -= n
+    return frames
+
+
+def time_mode(mode, input_path, output_path, frames, repeat):
+    input_size = os.path.getsize(input_path)
+    output_size = os.path.getsize(output_path)
+    original_format = {'channels': 2, 'sample_rate': 44100, 'sample_width': 2}
+    app.app.config['VERIFY_MODE'] = mode
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        app.verify_output(input_path, output_path, input_size, output_size,
+                          original_format, expected_frames=frames, exact=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 10, 60],
+                        help='output lengths to test, in minutes of audio')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per mode (best is reported)')
+    args = parser.parse_args()
+    logging.getLogger('app').setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp()
+    print(f"{'minutes':>8} {'size':>10} {'full':>10} {'header':>10} {'saved':>10}")
+    for minutes in args.minutes:
+        output_path = os.path.join(workdir, 'out.wav')
+        input_path = os.path.join(workdir, 'in.mp3')
+        frames = write_output(output_path, minutes)
+        # Stand-in for a 192 kbps MP3 of the same length
+        with open(input_path, 'wb') as f:
+            f.write(os.urandom(int(minutes * 60 * 24000)))
+
+        full = time_mode('full', input_path, output_path, frames, args.repeat)
+        header = time_mode('header', input_path, output_path, frames, args.repeat)
+        size_mb = os.path.getsize(output_path) / (1024 * 1024)
+        print(f"{minutes:>8g} {size_mb:>8.1f}MB {full * 1000:>8.1f}ms {header * 1000:>8.2f}ms "
+              f"{(full - header) * 1000:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
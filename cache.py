@@ -0,0 +1,174 @@
+"""
+Content-addressed cache of converted outputs.
+
+Entries are keyed by a hash of the input bytes plus the target format, so a
+repeat upload of the same file can reuse the earlier conversion. Each entry is
+a WAV file plus a small JSON sidecar holding the input's original format. The
+cache is bounded by total size and evicts least recently used entries first;
+file modification times record recency so the order survives restarts.
+
+Every process using the folder shares the one bound: adding an entry takes a
+lock file in the folder and re-reads usage and recency from the directory
+before evicting, so N workers still keep it within ``max_bytes``.
+"""
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def link_or_copy(source_path, dest_path):
+    """Hardlink source_path to dest_path, copying when linking isn't possible"""
+    try:
+        os.link(source_path, dest_path)
+    except OSError:
+        shutil.copyfile(source_path, dest_path)
+
+
+def touch(path):
+    """Mark path as just used, with the same clock for every entry
+
+    Letting the kernel stamp the time instead would mix in its coarser clock
+    and could order entries used a moment apart the wrong way round.
+    """
+    now = time.time()
+    os.utime(path, (now, now))
+
+
+class ConversionCache:
+    """Size-bounded LRU cache of converted files on disk"""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> size, oldest first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+        self.trim()
+
+    def _paths(self, key):
+        base = os.path.join(self.folder, key)
+        return base + '.wav', base + '.json'
+
+    @contextlib.contextmanager
+    def _folder_lock(self):
+        """Hold the lock file shared by every process using the folder"""
+        with open(os.path.join(self.folder, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _scan_locked(self):
+        """Re-read entries, their sizes and recency from the folder"""
+        found = []
+        for filename in os.listdir(self.folder):
+            if not filename.endswith('.wav'):
+                continue
+            path = os.path.join(self.folder, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((stat.st_mtime, filename[:-4], stat.st_size))
+        # Ties in mtime keep the order this process last saw
+        order = {key: position for position, key in enumerate(self._entries)}
+        found.sort(key=lambda entry: (entry[0], order.get(entry[1], len(order))))
+        self._entries = collections.OrderedDict((key, size) for _, key, size in found)
+        self._bytes = sum(self._entries.values())
+
+    def lookup(self, key):
+        """Return (wav_path, metadata) for key, or None on a miss
+
+        Entries added by other processes are found too, since the files are
+        checked rather than this process's index.
+        """
+        wav_path, meta_path = self._paths(key)
+        with self._lock:
+            try:
+                with open(meta_path) as f:
+                    metadata = json.load(f)
+                # Bump recency on disk, where every process (and a restart) sees it
+                touch(wav_path)
+                size = os.path.getsize(wav_path)
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+            if key not in self._entries:
+                self._bytes += size
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return wav_path, metadata
+
+    def store(self, key, source_path, metadata):
+        """Add a converted file to the cache"""
+        if self.max_bytes <= 0:
+            return
+        wav_path, meta_path = self._paths(key)
+        size = os.path.getsize(source_path)
+        if size > self.max_bytes:
+            return
+        with self._lock, self._folder_lock():
+            if os.path.exists(wav_path) and os.path.exists(meta_path):
+                touch(wav_path)
+                return
+            # Both files appear whole; the metadata first, as lookups read it first
+            suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+            tmp_path = f"{wav_path}.{suffix}"
+            link_or_copy(source_path, tmp_path)
+            tmp_meta_path = f"{meta_path}.{suffix}"
+            with open(tmp_meta_path, 'w') as f:
+                json.dump(metadata, f)
+            os.replace(tmp_meta_path, meta_path)
+            os.replace(tmp_path, wav_path)
+            touch(wav_path)
+            self._scan_locked()
+            self._evict_locked()
+
+    def trim(self):
+        """Re-read the folder, picking up other processes' changes, and enforce the size limit"""
+        with self._lock, self._folder_lock():
+            self._scan_locked()
+            self._evict_locked()
+
+    def _evict_locked(self):
+        while self._entries and self._bytes > self.max_bytes:
+            key = next(iter(self._entries))
+            self._forget_locked(key)
+            self.evictions += 1
+            logger.info(f"Evicted cached conversion {key}")
+
+    def _forget_locked(self, key):
+        self._bytes -= self._entries.pop(key, 0)
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Return hit/miss counters and current usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,313 @@
+"""
+Headless bulk conversion from the command line.
+
+Converts audio files, or every audio file under directories, with the same
+engines and output verification as the web app's ``convert_audio``, but
+without HTTP, the task store or polling. Files are converted by a pool of
+``--jobs`` workers, and each output mirrors its input's place in the tree
+under ``--output-dir``.
+
+Outputs are written under a temporary name and renamed once verified, so an
+interrupted run never leaves a partial file that looks finished. Files whose
+outputs are already up to date are skipped: by default an output is current
+when it is newer than its input (``--check mtime``); with ``--check hash``
+when the input's SHA-256 matches the one recorded for it in the output
+directory's ``.wav-maker.json`` manifest, which survives copies that reset
+mtimes. A line is printed per converted or failed file and a summary at the
+end; ``--report`` writes the same as JSON. The exit status is 1 if any file
+failed.
+
+Usage:
+    wav-maker prompts/ -o converted/ --profile pcm8k,ulaw8k --jobs 8 --report report.json
+    find prompts -name '*.mp3' | wav-maker --files-from - -o converted/
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flac')
+MANIFEST_NAME = '.wav-maker.json'
+
+
+def load_app(scratch):
+    """Import the web app's conversion code, keeping its own state in ``scratch``
+
+    Importing app creates its upload and converted folders, opens its task
+    store, shares metrics through ``METRICS_DIR`` and, with
+    ``JOB_QUEUE=lease``, starts claiming the shared queue's jobs; a CLI run
+    must not touch a server's.
+    """
+    # Stays set so spawned conversion processes keep their metrics to themselves too
+    os.environ['METRICS_DIR'] = ''
+
+    overrides = {
+        'UPLOAD_FOLDER': os.path.join(scratch, 'uploads'),
+        'CONVERTED_FOLDER': os.path.join(scratch, 'converted'),
+        'TASK_STORE_BACKEND': 'sqlite',
+        'TASK_DB': os.path.join(scratch, 'tasks.db'),
+        'JOB_QUEUE': 'local',
+    }
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        import app
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    return app
+
+
+def find_inputs(paths, extensions, output_dir):
+    """``(input_path, relative_dir)`` pairs for files, and audio files under directories
+
+    Files under ``output_dir`` are left out, so converting a tree into a
+    subfolder of itself doesn't pick up earlier outputs.
+    """
+    output_dir = os.path.realpath(output_dir)
+    inputs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            inputs.append((path, ''))
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(name for name in dirs
+                             if os.path.realpath(os.path.join(root, name)) != output_dir)
+            relative_dir = os.path.relpath(root, path)
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    inputs.append((os.path.join(root, name),
+                                   '' if relative_dir == '.' else relative_dir))
+    return inputs
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def load_manifest(output_dir):
+    """Input hashes recorded for earlier outputs, keyed by primary output path"""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with tempfile.NamedTemporaryFile('w', dir=output_dir, prefix='.manifest-', delete=False) as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f.name, path)
+
+
+def up_to_date(input_path, output_paths, check, recorded, input_sha256):
+    """Whether every output exists and is current for the input"""
+    if not all(os.path.exists(path) for path in output_paths.values()):
+        return False
+    if check == 'hash':
+        return recorded is not None and recorded.get('sha256') == input_sha256
+    input_mtime = os.stat(input_path).st_mtime
+    return all(os.stat(path).st_mtime >= input_mtime for path in output_paths.values())
+
+
+def convert_file(web, input_path, output_paths, profiles):
+    """Convert one input into each profile's output path; returns details for the report
+
+    Outputs are written to ``.part`` files next to their final paths and only
+    renamed into place once all of them verify. Raises on failure.
+    """
+    parts = {name: os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.part")
+             for name, path in output_paths.items()}
+    details = {}
+    os.makedirs(os.path.dirname(output_paths[profiles[0]]), exist_ok=True)
+    try:
+        for part in parts.values():
+            if os.path.exists(part):
+                os.remove(part)
+        # Copied rather than hardlinked, so editing a source file in place can't change its output
+        fast_path = web.write_without_conversion(input_path, profiles, parts, link=False)
+        if fast_path is not None:
+            details['fast_path'] = fast_path
+        else:
+            try:
+                original_format, expected_frames, engine, exact, duration = web.transcode_input(
+                    input_path, parts, profiles)
+            except web.InvalidAudio:
+                raise Exception("Invalid audio file format")
+            missing = [name for name in profiles if not os.path.exists(parts[name])]
+            if missing:
+                raise Exception(f"No output file for profiles: {', '.join(missing)}")
+            web.verify_outputs(input_path, profiles, parts, original_format, expected_frames, exact)
+            details.update(engine=engine, duration=duration)
+        for name in profiles:
+            os.replace(parts[name], output_paths[name])
+    finally:
+        for part in parts.values():
+            if os.path.exists(part):
+                os.remove(part)
+    details['output_bytes'] = sum(os.path.getsize(path) for path in output_paths.values())
+    return details
+
+
+def process(web, job, profiles, check, force, manifest):
+    """Convert one planned input unless it's up to date; returns its report entry"""
+    started = time.perf_counter()
+    entry = {'input': job['input'], 'outputs': job['outputs']}
+    try:
+        entry['input_bytes'] = os.path.getsize(job['input'])
+        entry['sha256'] = file_sha256(job['input'])
+        if not force and up_to_date(job['input'], job['outputs'], check,
+                                    manifest.get(job['key']), entry['sha256']):
+            entry['status'] = 'up_to_date'
+        else:
+            entry.update(convert_file(web, job['input'], job['outputs'], profiles))
+            entry['status'] = 'converted'
+    except Exception as e:
+        entry.update(status='failed', error=str(e))
+    entry['seconds'] = round(time.perf_counter() - started, 3)
+    return entry
+
+
+def plan(web, inputs, output_dir, profiles):
+    """Output paths of every input, by profile; inputs whose outputs collide are entries already failed"""
+    jobs, failed, claimed = [], [], {}
+    for input_path, relative_dir in inputs:
+        outputs = {name: os.path.join(output_dir, relative_dir,
+                                      web.converted_filename(input_path, name))
+                   for name in profiles}
+        key = os.path.relpath(outputs[profiles[0]], output_dir)
+        if key in claimed:
+            failed.append({'input': input_path, 'outputs': outputs, 'status': 'failed',
+                           'error': f"Output {key} is already written for {claimed[key]}"})
+            continue
+        claimed[key] = input_path
+        jobs.append({'input': input_path, 'outputs': outputs, 'key': key})
+    return jobs, failed
+
+
+def summarize(entries, elapsed):
+    summary = {'files': len(entries), 'converted': 0, 'up_to_date': 0, 'failed': 0,
+               'fast_path': 0, 'input_bytes': 0, 'output_bytes': 0, 'audio_seconds': 0.0}
+    for entry in entries:
+        summary[entry['status']] += 1
+        if entry['status'] == 'converted':
+            summary['fast_path'] += 'fast_path' in entry
+            summary['input_bytes'] += entry['input_bytes']
+            summary['output_bytes'] += entry['output_bytes']
+            summary['audio_seconds'] += entry.get('duration') or 0
+    summary['audio_seconds'] = round(summary['audio_seconds'], 2)
+    summary['elapsed_seconds'] = round(elapsed, 3)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='wav-maker',
+                                     description="Convert audio files to telephony WAV in bulk")
+    parser.add_argument('paths', nargs='*', help="Audio files, or directories to convert recursively")
+    parser.add_argument('--files-from', metavar='FILE',
+                        help="Read more input paths from FILE, one per line ('-' for stdin)")
+    parser.add_argument('-o', '--output-dir', required=True)
+    parser.add_argument('-p', '--profile', action='append', default=[],
+                        help="Output profile, repeatable or comma-separated; the default is pcm8k")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Files converted at once (default: CPU count)")
+    parser.add_argument('--mode', choices=['process', 'thread'], default='process',
+                        help="Run in-process engines (NumPy, pydub) in child processes or threads")
+    parser.add_argument('--check', choices=['mtime', 'hash'], default='mtime',
+                        help="How to tell an output is up to date")
+    parser.add_argument('--force', action='store_true', help="Convert even up-to-date files")
+    parser.add_argument('--extensions', default=','.join(AUDIO_EXTENSIONS),
+                        help="File extensions converted from directories")
+    parser.add_argument('--report', metavar='FILE', help="Write a JSON report to FILE")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only print the summary")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log each conversion's details")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = list(args.paths)
+    if args.files_from:
+        with (sys.stdin if args.files_from == '-' else open(args.files_from)) as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    if not paths:
+        print("wav-maker: no input files", file=sys.stderr)
+        return 2
+    extensions = tuple(f".{ext.strip().lstrip('.').lower()}" for ext in args.extensions.split(','))
+    jobs_count = max(1, args.jobs)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Configured before app is imported, whose own basicConfig then does nothing
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    with tempfile.TemporaryDirectory(prefix='wav-maker-') as scratch:
+        web = load_app(scratch)
+        try:
+            profiles = web.parse_profiles(args.profile)
+        except ValueError as e:
+            print(f"wav-maker: {e}", file=sys.stderr)
+            return 2
+        web.app.config['CONVERSION_MODE'] = args.mode
+        web.app.config['CONVERSION_PROCESSES'] = jobs_count
+        # Files are converted side by side, so long ones get only their share of CPUs for segments
+        web.app.config['SEGMENT_WORKERS'] = max(1, (os.cpu_count() or 1) // jobs_count)
+
+        started = time.time()
+        clock = time.perf_counter()
+        jobs, entries = plan(web, find_inputs(paths, extensions, args.output_dir),
+                             args.output_dir, profiles)
+        for entry in entries:
+            print(f"failed     {entry['input']}: {entry['error']}", file=sys.stderr)
+        manifest = load_manifest(args.output_dir)
+        total = len(jobs) + len(entries)
+        try:
+            with ThreadPoolExecutor(max_workers=jobs_count, thread_name_prefix='convert') as executor:
+                futures = {executor.submit(process, web, job, profiles, args.check, args.force,
+                                           manifest): job for job in jobs}
+                for future in as_completed(futures):
+                    entry = future.result()
+                    entries.append(entry)
+                    if entry['status'] == 'converted':
+                        manifest[futures[future]['key']] = {'input': entry['input'],
+                                                            'sha256': entry['sha256']}
+                    if entry['status'] == 'failed' or (entry['status'] == 'converted'
+                                                       and not args.quiet):
+                        detail = entry.get('error') or f"{entry['seconds']:.1f}s"
+                        print(f"[{len(entries)}/{total}] {entry['status']:<10} {entry['input']} "
+                              f"({detail})", file=sys.stderr)
+        finally:
+            save_manifest(args.output_dir, manifest)
+            if args.mode == 'process':
+                web.get_process_pool().shutdown()
+
+    summary = summarize(entries, time.perf_counter() - clock)
+    rate = summary['audio_seconds'] / summary['elapsed_seconds'] if summary['elapsed_seconds'] else 0
+    print(f"{summary['files']} files: {summary['converted']} converted "
+          f"({summary['fast_path']} without decoding), {summary['up_to_date']} up to date, "
+          f"{summary['failed']} failed in {summary['elapsed_seconds']:.1f}s "
+          f"({rate:.1f} audio seconds/s)", file=sys.stderr)
+
+    if args.report:
+        report = {'started': started, 'output_dir': args.output_dir, 'profiles': profiles,
+                  'jobs': jobs_count, 'check': args.check, 'summary': summary,
+                  'files': sorted(entries, key=lambda entry: entry['input'])}
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,874 @@
+"""
+Audio conversion engine.
+
+Pure conversion functions with no Flask or task-store dependencies, so they can
+run in the web process, in a worker process from the process pool, or from
+other tools. Everything here works on file paths.
+
+Two engines are available:
+
+* ``transcode`` decodes the whole input into a pydub ``AudioSegment``.
+* ``transcode_streaming`` has ffmpeg decode, downmix, resample and encode in
+  one pass and copies its output to the WAV file in fixed-size chunks, so
+  memory use doesn't grow with the length of the input. Its input can be a
+  path or a readable stream such as a ``GrowingFile``, which lets conversion
+  start while an upload is still arriving.
+* ``transcode_segmented`` splits a long input into time slices, converts them
+  with several ffmpeg runs at once and joins the results, so one long file
+  can use more than one core.
+
+``transcode_numpy`` is used instead for PCM WAV input when NumPy is installed.
+It memory-maps the input and downmixes and resamples in-process, so short
+files don't pay for starting ffprobe and ffmpeg.
+
+Each engine records how long its stages take in ``metrics.STAGE_SECONDS``,
+and as spans of the task's trace when it is being traced.
+
+Output formats are named profiles (see ``PROFILES``). Both engines can write
+several profiles from one decode of the input: the decoded audio is shared and
+only the resample and encode steps run once per profile.
+"""
+import contextvars
+import math
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from pydub import AudioSegment
+
+import metrics
+import tracing
+
+try:
+    import numpy as np
+except ImportError:  # Optional; without it every input goes through ffmpeg
+    np = None
+
+TARGET_CHANNELS = 1
+TARGET_SAMPLE_RATE = 8000
+TARGET_SAMPLE_WIDTH = 2  # 2 bytes = 16-bit
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+SEGMENT_OVERLAP_SECONDS = 1  # Decoded on each side of a segment and then dropped
+SEGMENT_MIN_SECONDS = 30  # Shortest segment worth its own ffmpeg run
+
+# Output profiles. All are mono; ``sample_width`` is the stored bytes per
+# sample, ``raw_format`` the ffmpeg muxer for headerless output and
+# ``format_tag`` the WAV format code (1 PCM, 6 A-law, 7 mu-law).
+PROFILES = {
+    'pcm8k': {'sample_rate': 8000, 'codec': 'pcm_s16le', 'raw_format': 's16le',
+              'sample_width': 2, 'format_tag': 1, 'label': 'mono_8khz_16bit'},
+    'pcm16k': {'sample_rate': 16000, 'codec': 'pcm_s16le', 'raw_format': 's16le',
+               'sample_width': 2, 'format_tag': 1, 'label': 'mono_16khz_16bit'},
+    'ulaw8k': {'sample_rate': 8000, 'codec': 'pcm_mulaw', 'raw_format': 'mulaw',
+               'sample_width': 1, 'format_tag': 7, 'label': 'mono_8khz_ulaw'},
+    'alaw8k': {'sample_rate': 8000, 'codec': 'pcm_alaw', 'raw_format': 'alaw',
+               'sample_width': 1, 'format_tag': 6, 'label': 'mono_8khz_alaw'},
+}
+DEFAULT_PROFILE = 'pcm8k'
+
+
+def encode_options(profile):
+    """ffmpeg output options that downmix, resample and encode to ``profile``"""
+    settings = PROFILES[profile]
+    return ['-vn', '-ac', str(TARGET_CHANNELS), '-ar', str(settings['sample_rate']),
+            '-acodec', settings['codec']]
+
+
+def wav_header(profile, data_size):
+    """WAV header for ``data_size`` bytes of audio in ``profile``.
+
+    PCM gets the canonical 44-byte header. The G.711 formats get the 18-byte
+    fmt chunk and the fact chunk that non-PCM WAV files require.
+    """
+    settings = PROFILES[profile]
+    width = settings['sample_width']
+    block_align = TARGET_CHANNELS * width
+    fmt = struct.pack('<HHIIHH', settings['format_tag'], TARGET_CHANNELS,
+                      settings['sample_rate'], settings['sample_rate'] * block_align,
+                      block_align, width * 8)
+    chunks = b''
+    if settings['format_tag'] == 1:
+        chunks += b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+    else:
+        fmt += struct.pack('<H', 0)
+        chunks += b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+        chunks += b'fact' + struct.pack('<II', 4, data_size // block_align)
+    chunks += b'data' + struct.pack('<I', data_size)
+    riff_size = 4 + len(chunks) + data_size + data_size % 2
+    return b'RIFF' + struct.pack('<I', riff_size) + b'WAVE' + chunks
+
+
+def transcode(input_path, output_path, progress=None, profile=DEFAULT_PROFILE, extra_outputs=()):
+    """Convert input_path to a WAV in ``profile`` at output_path.
+
+    ``extra_outputs`` is a list of ``(profile, path)`` pairs written from the
+    same decoded audio. ``progress`` is an optional callable receiving a
+    percentage as each step finishes. Returns the original format of the input.
+    """
+    # Load the audio file - this may take time for large files
+    with metrics.stage('pydub', 'decode'):
+        sound = AudioSegment.from_file(input_path)
+
+    original_format = {
+        'channels': sound.channels,
+        'sample_rate': sound.frame_rate,
+        'sample_width': sound.sample_width,
+    }
+    if progress:
+        progress(30)
+
+    with metrics.stage('pydub', 'downmix'):
+        # Make mono if not already
+        if sound.channels > TARGET_CHANNELS:
+            sound = sound.set_channels(TARGET_CHANNELS)
+        if progress:
+            progress(50)
+
+        # Set sample width if not already 16-bit; companded profiles encode from 16-bit too
+        if sound.sample_width != TARGET_SAMPLE_WIDTH:
+            sound = sound.set_sample_width(TARGET_SAMPLE_WIDTH)
+    if progress:
+        progress(70)
+
+    outputs = [(profile, output_path)] + list(extra_outputs)
+    for index, (name, path) in enumerate(outputs):
+        # Set sample rate if not already at the profile's rate
+        rate = PROFILES[name]['sample_rate']
+        with metrics.stage('pydub', 'resample'):
+            resampled = sound.set_frame_rate(rate) if sound.frame_rate != rate else sound
+
+        # Export as WAV using explicit parameters to ensure proper WAV encoding
+        with metrics.stage('pydub', 'export'):
+            resampled.export(path, format="wav", parameters=encode_options(name)[1:])
+        if progress:
+            progress(70 + 15 * (index + 1) // len(outputs))
+
+    return original_format
+
+
+def format_from_probe(info):
+    """Build an original-format dict from ``pydub.utils.mediainfo`` output"""
+    bits = 0
+    for key in ('bits_per_sample', 'bits_per_raw_sample'):
+        try:
+            bits = int(info.get(key) or 0)
+        except ValueError:
+            bits = 0
+        if bits:
+            break
+    return {
+        'channels': int(info.get('channels') or 0),
+        'sample_rate': int(info.get('sample_rate') or 0),
+        # Compressed formats report no bit depth; they decode to 16-bit
+        'sample_width': bits // 8 if bits else TARGET_SAMPLE_WIDTH,
+    }
+
+
+class WavFormatError(Exception):
+    """Raised when a file isn't a well-formed RIFF/WAVE file"""
+
+
+def read_wav_header(path):
+    """Parse the RIFF, fmt and data chunk headers of a WAV file.
+
+    Only chunk headers are read, so this costs the same for any file length.
+    Returns a dict with the format fields, the data chunk's offset and size and
+    the file size.
+    """
+    with open(path, 'rb') as f:
+        return parse_wav_header(f, os.path.getsize(path))
+
+
+def parse_wav_header(f, file_size):
+    """``read_wav_header`` for a binary file object positioned at the start of the WAV"""
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise WavFormatError("Missing RIFF/WAVE header")
+    riff_size = struct.unpack('<I', riff[4:8])[0]
+
+    header = {'riff_size': riff_size, 'file_size': file_size}
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            raise WavFormatError("No data chunk found")
+        chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if chunk_id == b'fmt ':
+            if chunk_size < 16:
+                raise WavFormatError("fmt chunk is too short")
+            fmt = f.read(chunk_size)
+            (header['format_tag'], header['channels'], header['sample_rate'],
+             header['byte_rate'], header['block_align'],
+             header['bits_per_sample']) = struct.unpack('<HHIIHH', fmt[:16])
+            if header['format_tag'] == 0xFFFE and chunk_size >= 26:
+                # WAVE_FORMAT_EXTENSIBLE keeps the real format in the sub-format GUID
+                header['format_tag'] = struct.unpack('<H', fmt[24:26])[0]
+            if chunk_size % 2:
+                f.seek(1, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if 'format_tag' not in header:
+                raise WavFormatError("data chunk appears before fmt chunk")
+            header['data_offset'] = f.tell()
+            header['data_size'] = chunk_size
+            return header
+        else:
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def passthrough_mode(path, profile=DEFAULT_PROFILE):
+    """How a file already holding ``profile``'s audio format can skip conversion.
+
+    Returns ``'link'`` when the file is byte-for-byte what conversion would
+    write, ``'rewrite'`` when only its header differs (extensible format,
+    extra chunks, wrong sizes, trailing bytes) and ``None`` when the audio
+    itself needs converting. Only the header is read.
+    """
+    try:
+        header = read_wav_header(path)
+    except (WavFormatError, OSError, struct.error):
+        return None
+    settings = PROFILES[profile]
+    data_end = header['data_offset'] + header['data_size']
+    if (header['format_tag'] != settings['format_tag']
+            or header['channels'] != TARGET_CHANNELS
+            or header['sample_rate'] != settings['sample_rate']
+            or header['bits_per_sample'] != settings['sample_width'] * 8
+            or header['block_align'] != TARGET_CHANNELS * settings['sample_width']
+            or data_end > header['file_size']
+            or header['data_size'] % header['block_align']):
+        return None
+    expected = wav_header(profile, header['data_size'])
+    with open(path, 'rb') as f:
+        current = f.read(header['data_offset'])
+    if current == expected and header['file_size'] == data_end + header['data_size'] % 2:
+        return 'link'
+    return 'rewrite'
+
+
+def rewrite_header(input_path, output_path, profile=DEFAULT_PROFILE):
+    """Copy the audio data of input_path under a canonical ``profile`` header"""
+    header = read_wav_header(input_path)
+    data_size = header['data_size']
+    with open(input_path, 'rb') as source, open(output_path, 'wb') as out:
+        out.write(wav_header(profile, data_size))
+        source.seek(header['data_offset'])
+        remaining = data_size
+        while remaining:
+            chunk = source.read(min(remaining, STREAM_CHUNK_SIZE))
+            if not chunk:
+                raise WavFormatError("WAV data ended early")
+            out.write(chunk)
+            remaining -= len(chunk)
+        if data_size % 2:
+            out.write(b'\x00')
+    return data_size // header['block_align']
+
+
+class UploadAborted(Exception):
+    """Raised when reading from an upload that failed part-way"""
+
+
+class GrowingFile:
+    """Reader for a file that another thread is still writing.
+
+    The writer calls ``extend`` after each chunk lands on disk and ``finish``
+    (or ``abort``) at the end. ``read`` blocks until more data is available.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cond = threading.Condition()
+        self._size = 0
+        self._position = 0
+        self._finished = False
+        self._aborted = False
+        self._file = None
+        self.digest = None
+
+    def extend(self, size):
+        """Record that the file now holds ``size`` bytes"""
+        with self._cond:
+            self._size = size
+            self._cond.notify_all()
+
+    def finish(self, digest=None):
+        """Mark the upload as complete, recording the hash computed while writing"""
+        with self._cond:
+            self.digest = digest
+            self._finished = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """Mark the upload as failed; pending and future reads raise"""
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until the upload ends; return True if it completed"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._finished or self._aborted, timeout)
+            return self._finished and not self._aborted
+
+    def read(self, size=STREAM_CHUNK_SIZE):
+        with self._cond:
+            self._cond.wait_for(lambda: self._position < self._size
+                                or self._finished or self._aborted)
+            if self._aborted:
+                raise UploadAborted("Upload did not complete")
+            available = self._size - self._position
+        if available <= 0:
+            return b''
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        data = self._file.read(min(size, available))
+        self._position += len(data)
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def probe_duration(info):
+    """Duration in seconds from ``pydub.utils.mediainfo`` output, or None"""
+    try:
+        duration = float(info.get('duration') or 0)
+    except (TypeError, ValueError):
+        return None
+    return duration if duration > 0 else None
+
+
+def pcm_command(input_path, profile=DEFAULT_PROFILE, extra_outputs=()):
+    """ffmpeg command that writes the converted audio without a header to stdout.
+
+    An ``input_path`` of ``None`` reads the input from stdin. Each
+    ``(profile, path)`` in ``extra_outputs`` becomes another output of the same
+    ffmpeg run, written straight to a WAV file, so the input is decoded once.
+    """
+    command = [AudioSegment.converter, '-v', 'error', '-y']
+    if input_path:
+        command += ['-nostdin', '-i', input_path]
+    else:
+        command += ['-i', 'pipe:0']
+    command += encode_options(profile) + ['-f', PROFILES[profile]['raw_format'], 'pipe:1']
+    for name, path in extra_outputs:
+        command += encode_options(name) + ['-f', 'wav', '-bitexact', path]
+    return command
+
+
+def _feed(source, stdin, errors):
+    """Copy a readable stream into ffmpeg's stdin"""
+    try:
+        shutil.copyfileobj(source, stdin, STREAM_CHUNK_SIZE)
+    except BrokenPipeError:
+        # ffmpeg stopped reading; its exit status reports why
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def transcode_streaming(source, output_path, chunk_size=STREAM_CHUNK_SIZE, progress=None,
+                        profile=DEFAULT_PROFILE, extra_outputs=()):
+    """Convert source to a WAV in ``profile`` without holding it in memory.
+
+    ``source`` is a path or a readable binary stream. ``extra_outputs`` is a
+    list of ``(profile, path)`` pairs that ffmpeg writes from the same decode.
+    ``progress`` is an optional callable receiving the number of audio bytes
+    written to output_path so far. Returns the number of frames written there.
+    """
+    is_path = isinstance(source, str)
+    feed_errors = []
+    # ffmpeg decodes, downmixes, resamples and encodes in one pass, timed as one stage
+    started = time.perf_counter()
+    # stderr goes to a file so a chatty ffmpeg can't fill a pipe and stall
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(pcm_command(source if is_path else None, profile, extra_outputs),
+                                   stdin=None if is_path else subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=stderr)
+        spawned = time.perf_counter()
+        tracing.add('ffmpeg.spawn', start=started, duration=spawned - started)
+        feeder = None
+        if not is_path:
+            feeder = threading.Thread(target=_feed, args=(source, process.stdin, feed_errors),
+                                      daemon=True)
+            feeder.start()
+        try:
+            with open(output_path, 'wb') as out:
+                # Sizes aren't known until the end, so the header is rewritten then
+                out.write(wav_header(profile, 0))
+                written = 0
+                while True:
+                    chunk = process.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    written += len(chunk)
+                    if progress:
+                        progress(written)
+                if written % 2:
+                    out.write(b'\x00')  # RIFF chunks are padded to an even length
+                out.seek(0)
+                out.write(wav_header(profile, written))
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            if feeder is not None:
+                feeder.join()
+            tracing.add('ffmpeg.run', start=spawned, duration=time.perf_counter() - spawned,
+                        returncode=returncode)
+
+        if feed_errors:
+            raise feed_errors[0]
+        if returncode != 0:
+            stderr.seek(0)
+            message = stderr.read()[-2000:].decode('utf-8', 'replace').strip()
+            raise Exception(f"ffmpeg exited with status {returncode}: {message}")
+
+    metrics.observe_stage('ffmpeg', 'transcode', time.perf_counter() - started)
+    return written // (TARGET_CHANNELS * PROFILES[profile]['sample_width'])
+
+
+def bytes_per_second(profile=DEFAULT_PROFILE):
+    settings = PROFILES[profile]
+    return settings['sample_rate'] * settings['sample_width'] * TARGET_CHANNELS
+
+
+def segment_bounds(duration, segments, min_length=SEGMENT_MIN_SECONDS):
+    """Split ``duration`` seconds into at most ``segments`` ``(start, end)`` pairs
+
+    Boundaries fall on whole seconds, which are whole samples at every input
+    and output rate, so the segments line up exactly. The last segment's end
+    is None: it runs to wherever the input really stops, which the probed
+    duration only estimates.
+    """
+    segments = max(1, min(segments, int(duration // min_length)))
+    length = math.ceil(duration / segments)
+    starts = [index * length for index in range(segments) if index * length < duration]
+    return [(start, start + length) for start in starts[:-1]] + [(starts[-1], None)]
+
+
+def segment_command(input_path, start, end, profile=DEFAULT_PROFILE, extra_outputs=()):
+    """``pcm_command`` for the segment from ``start`` to ``end`` seconds, with overlap
+
+    Decoding starts ``SEGMENT_OVERLAP_SECONDS`` before ``start`` and stops as
+    long after ``end``. Extra outputs are written without a header too, so
+    they can be trimmed and joined like the primary one.
+    """
+    seek = max(0, start - SEGMENT_OVERLAP_SECONDS)
+    command = [AudioSegment.converter, '-v', 'error', '-y', '-nostdin']
+    if seek:
+        command += ['-ss', str(seek)]
+    if end is not None:
+        command += ['-t', str(end + SEGMENT_OVERLAP_SECONDS - seek)]
+    command += ['-i', input_path]
+    command += encode_options(profile) + ['-f', PROFILES[profile]['raw_format'], 'pipe:1']
+    for name, path in extra_outputs:
+        command += encode_options(name) + ['-f', PROFILES[name]['raw_format'], path]
+    return command
+
+
+def _join_segments(output_path, profile, pieces):
+    """Write a WAV in ``profile`` from headerless ``(path, skip, keep)`` pieces
+
+    ``skip`` bytes are dropped from the start of each piece and at most
+    ``keep`` bytes (all of them if None) are copied. Returns the bytes of audio
+    written.
+    """
+    written = 0
+    with open(output_path, 'wb') as out:
+        out.write(wav_header(profile, 0))
+        for path, skip, keep in pieces:
+            with open(path, 'rb') as piece:
+                piece.seek(skip)
+                remaining = keep
+                while remaining is None or remaining > 0:
+                    chunk = piece.read(STREAM_CHUNK_SIZE if remaining is None
+                                       else min(STREAM_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    written += len(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+        if written % 2:
+            out.write(b'\x00')
+        out.seek(0)
+        out.write(wav_header(profile, written))
+    return written
+
+
+def transcode_segmented(input_path, output_path, duration, segments, progress=None,
+                        profile=DEFAULT_PROFILE, extra_outputs=()):
+    """Convert a long input as up to ``segments`` time slices at once, then join them.
+
+    Each slice is converted by its own ffmpeg run, from
+    ``SEGMENT_OVERLAP_SECONDS`` before its start to as long after its end, and
+    the overlap is cut off again. By the slice boundary the decoder (an MP3
+    frame depends on the ones before it) and the resampler's filter have the
+    same history they would have had in a single pass, so the joined audio
+    matches single-pass output instead of clicking where slices meet.
+
+    ``duration`` is the probed length in seconds. ``progress`` and
+    ``extra_outputs`` are as for ``transcode_streaming``; progress may be
+    called from several threads. Returns the number of frames written to
+    output_path.
+    """
+    bounds = segment_bounds(duration, segments)
+    started = time.perf_counter()
+    lock = threading.Lock()
+    processes = []
+    cancelled = False
+    total = 0
+    
+    def report(size):
+        nonlocal total
+        with lock:
+            total += size
+            current = total
+        if progress:
+            progress(current)
+    
+    def convert(index, start, end, workdir):
+        seek = max(0, start - SEGMENT_OVERLAP_SECONDS)
+        primary_path = os.path.join(workdir, f"{index}_{profile}.raw")
+        extras = [(name, os.path.join(workdir, f"{index}_{name}.raw")) for name, _ in extra_outputs]
+        # The primary output is trimmed as it arrives, so progress counts only kept audio
+        skip = (start - seek) * bytes_per_second(profile)
+        keep = None if end is None else (end - start) * bytes_per_second(profile)
+        with tempfile.TemporaryFile() as stderr:
+            with lock:
+                if cancelled:
+                    raise Exception("Conversion of another segment failed")
+                spawned = time.perf_counter()
+                process = subprocess.Popen(segment_command(input_path, start, end, profile, extras),
+                                           stdout=subprocess.PIPE, stderr=stderr)
+                processes.append(process)
+            kept = 0
+            try:
+                with open(primary_path, 'wb') as out:
+                    while True:
+                        chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk, skip = chunk[dropped:], skip - dropped
+                        if keep is not None:
+                            chunk = chunk[:keep - kept]
+                        if chunk:
+                            out.write(chunk)
+                            kept += len(chunk)
+                            report(len(chunk))
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+                tracing.add('ffmpeg.segment', start=spawned, duration=time.perf_counter() - spawned,
+                            index=index, returncode=returncode)
+            if returncode != 0:
+                stderr.seek(0)
+                message = stderr.read()[-2000:].decode('utf-8', 'replace').strip()
+                raise Exception(f"ffmpeg exited with status {returncode} on segment {index}: {message}")
+        return primary_path, extras, start - seek
+    
+    # Pieces live next to the output, on the same disk
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+        with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+            # Each thread gets its own copy of the context, so segments join the task's trace
+            futures = [pool.submit(contextvars.copy_context().run, convert, index, start, end, workdir)
+                       for index, (start, end) in enumerate(bounds)]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = next((future for future in done if future.exception()), None)
+            if failed is not None:
+                # Stop the other segments rather than finish audio that will be thrown away
+                with lock:
+                    cancelled = True
+                    for process in processes:
+                        process.kill()
+                raise failed.exception()
+        results = [future.result() for future in futures]
+        
+        written = _join_segments(output_path, profile,
+                                 [(primary_path, 0, None) for primary_path, _, _ in results])
+        for position, (name, path) in enumerate(extra_outputs):
+            pieces = []
+            for (_, extras, lead), (start, end) in zip(results, bounds):
+                keep = None if end is None else (end - start) * bytes_per_second(name)
+                pieces.append((extras[position][1], lead * bytes_per_second(name), keep))
+            _join_segments(path, name, pieces)
+    
+    metrics.observe_stage('ffmpeg', 'transcode', time.perf_counter() - started)
+    return written // (TARGET_CHANNELS * PROFILES[profile]['sample_width'])
+
+
+# Integer PCM sample widths the NumPy engine reads, with their dtypes
+NUMPY_SAMPLE_TYPES = {1: 'u1', 2: '<i2', 3: None, 4: '<i4'}
+NUMPY_BLOCK_FRAMES = 64 * 1024  # Output frames resampled per block
+
+
+def numpy_wav_input(path, profiles=(DEFAULT_PROFILE,)):
+    """Return the WAV header of path if the NumPy engine can convert it, else None.
+
+    That needs NumPy, integer PCM input and PCM output profiles.
+    """
+    if np is None or any(PROFILES[name]['format_tag'] != 1 for name in profiles):
+        return None
+    try:
+        header = read_wav_header(path)
+    except (WavFormatError, OSError, struct.error):
+        return None
+    if (header['format_tag'] != 1 or not header['channels'] or not header['sample_rate']
+            or header['bits_per_sample'] % 8
+            or header['bits_per_sample'] // 8 not in NUMPY_SAMPLE_TYPES
+            or header['block_align'] != header['channels'] * header['bits_per_sample'] // 8):
+        return None
+    return header
+
+
+def probe_from_wav_header(header):
+    """``pydub.utils.mediainfo``-style dict describing a parsed WAV header"""
+    data_size = min(header['data_size'], header['file_size'] - header['data_offset'])
+    frames = data_size // header['block_align'] if header['block_align'] else 0
+    return {
+        'format_name': 'wav',
+        'channels': str(header['channels']),
+        'sample_rate': str(header['sample_rate']),
+        'bits_per_sample': str(header['bits_per_sample']),
+        'duration': str(frames / header['sample_rate']),
+    }
+
+
+# MPEG audio frame header tables, indexed by the header's version bits
+MPEG_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+MPEG_BITRATES = {  # kbps by (MPEG-1?, layer), for bitrate indexes 1-14
+    (True, 1): (32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MPEG_BITRATES[(False, 3)] = MPEG_BITRATES[(False, 2)]
+PROBE_BYTES = 64 * 1024  # How far into the audio to look for the first MPEG frame
+
+
+def _id3_size(head):
+    """Length of an ID3v2 tag at the start of ``head``, or 0"""
+    if head[:3] != b'ID3' or len(head) < 10:
+        return 0
+    size = 0
+    for byte in head[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    return 10 + size + (10 if head[5] & 0x10 else 0)
+
+
+def _mpeg_samples(f, start, file_size):
+    """Total samples x channels of the MPEG audio stream starting near ``start``"""
+    f.seek(start)
+    data = f.read(PROBE_BYTES)
+    for index in range(len(data) - 3):
+        if data[index] != 0xFF or data[index + 1] & 0xE0 != 0xE0:
+            continue
+        header = struct.unpack('>I', data[index:index + 4])[0]
+        version, layer = (header >> 19) & 3, 4 - ((header >> 17) & 3)
+        bitrate_index, rate_index = (header >> 12) & 15, (header >> 10) & 3
+        if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+            continue
+        mpeg1 = version == 3
+        channels = 1 if (header >> 6) & 3 == 3 else 2
+        sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+        frame_samples = 384 if layer == 1 else 1152 if layer == 2 or mpeg1 else 576
+        # A Xing/Info frame in place of the first audio frame gives the frame count (VBR)
+        side_info = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+        tag = data[index + 4 + side_info:index + 16 + side_info]
+        if layer == 3 and tag[:4] in (b'Xing', b'Info') and tag[7] & 1:
+            frames = struct.unpack('>I', tag[8:12])[0]
+            return frames * frame_samples * channels
+        bitrate = MPEG_BITRATES[(mpeg1, layer)][bitrate_index - 1] * 1000
+        seconds = (file_size - start - index) * 8 / bitrate
+        return int(seconds * sample_rate) * channels
+    return None
+
+
+def estimate_cost(source):
+    """Estimate a conversion's work as input samples x channels, from the file's header only
+
+    Reads WAV headers, FLAC STREAMINFO and the first MPEG audio frame (using a
+    Xing/Info frame count when present, otherwise assuming a constant
+    bitrate), so it costs the same for any file length. ``source`` is a path
+    or a seekable binary file object, such as an upload not saved yet, which
+    is left at the position it was at. Returns None for other formats or
+    unreadable files.
+    """
+    try:
+        if isinstance(source, (str, bytes, os.PathLike)):
+            with open(source, 'rb') as f:
+                return _estimate_cost(f)
+        position = source.tell()
+        try:
+            return _estimate_cost(source)
+        finally:
+            source.seek(position)
+    except (WavFormatError, OSError, struct.error, IndexError, ZeroDivisionError):
+        return None
+
+
+def _estimate_cost(f):
+    file_size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    head = f.read(10)
+    if head[:4] == b'RIFF':
+        f.seek(0)
+        header = parse_wav_header(f, file_size)
+        data_size = min(header['data_size'], header['file_size'] - header['data_offset'])
+        return data_size // header['block_align'] * header['channels']
+    # FLAC and MP3 files may start with an ID3v2 tag
+    start = _id3_size(head)
+    f.seek(start)
+    if f.read(4) == b'fLaC':
+        block = f.read(4 + 34)
+        if block[0] & 0x7F != 0:  # STREAMINFO must be the first metadata block
+            return None
+        info = int.from_bytes(block[14:22], 'big')
+        return (info & ((1 << 36) - 1)) * (((info >> 41) & 7) + 1)
+    return _mpeg_samples(f, start, file_size)
+
+
+def resample_filter(up, down, half_width=10, beta=5.0):
+    """Polyphase anti-aliasing filter for resampling by ``up / down``.
+
+    A Kaiser-windowed sinc low-pass with its cutoff at the lower of the two
+    Nyquist frequencies, split into ``up`` phases. Returns the ``(taps, up)``
+    phase matrix and the filter's delay in upsampled samples.
+    """
+    ratio = max(up, down)
+    half_len = half_width * ratio
+    n = np.arange(-half_len, half_len + 1)
+    h = np.sinc(n / ratio) * np.kaiser(len(n), beta)
+    # Zero-stuffing divides the gain by ``up``, so each phase sums to about 1
+    h *= up / h.sum()
+    taps = -(-len(h) // up)
+    h = np.concatenate([h, np.zeros(taps * up - len(h))])
+    return h.reshape(taps, up), half_len
+
+
+def _mono_block(samples, width, start, stop):
+    """Downmixed float samples in [start, stop), zero outside the input"""
+    frames = samples.shape[0]
+    lo, hi = max(start, 0), min(stop, frames)
+    block = np.zeros(stop - start)
+    if lo >= hi:
+        return block
+    raw = samples[lo:hi]
+    if width == 3:
+        # 24-bit has no NumPy dtype; assemble it from bytes, sign-extended via the top byte
+        raw = (raw[..., 0].astype(np.int32) | (raw[..., 1].astype(np.int32) << 8)
+               | (raw[..., 2].astype(np.int8).astype(np.int32) << 16))
+    mono = raw.mean(axis=1, dtype=np.float64)
+    if width == 1:
+        mono = (mono - 128) / 128  # 8-bit WAV is unsigned
+    else:
+        mono /= float(1 << (8 * width - 1))
+    block[lo - start:hi - start] = mono
+    return block
+
+
+def _resample_to_file(samples, width, in_rate, profile, path, progress=None):
+    """Resample mono-mixed ``samples`` to ``profile`` and write the WAV file
+
+    Reading PCM from the memory map is its decode, so that time is counted
+    in the downmix stage.
+    """
+    frames = samples.shape[0]
+    out_rate = PROFILES[profile]['sample_rate']
+    divisor = math.gcd(in_rate, out_rate)
+    up, down = out_rate // divisor, in_rate // divisor
+    out_frames = -(-frames * up // down)
+    if up != down:
+        phases, delay = resample_filter(up, down)
+        taps = phases.shape[0]
+        reversed_phases = np.ascontiguousarray(phases[::-1])
+
+    stage_seconds = dict.fromkeys(('downmix', 'resample', 'export'), 0.0)
+    with open(path, 'wb') as out:
+        out.write(wav_header(profile, out_frames * 2))
+        for start in range(0, out_frames, NUMPY_BLOCK_FRAMES):
+            stop = min(start + NUMPY_BLOCK_FRAMES, out_frames)
+            started = time.perf_counter()
+            if up == down:
+                mono = _mono_block(samples, width, start, stop)
+                mixed = time.perf_counter()
+            else:
+                # Output n sits at upsampled position n*down + delay, which picks
+                # its filter phase and the last input sample it needs
+                position = np.arange(start, stop) * down + delay
+                phase, index = position % up, position // up
+                first = int(index[0]) - (taps - 1)
+                block = _mono_block(samples, width, first, int(index[-1]) + 1)
+                mixed = time.perf_counter()
+                windows = np.lib.stride_tricks.sliding_window_view(block, taps)
+                mono = np.empty(stop - start)
+                # Every up-th output shares a phase and steps down inputs, so each
+                # phase is one strided matrix-vector product
+                for offset in range(min(up, stop - start)):
+                    window = int(index[offset]) - (taps - 1) - first
+                    count = len(range(offset, stop - start, up))
+                    mono[offset::up] = (windows[window::down][:count]
+                                        @ reversed_phases[:, phase[offset]])
+            pcm = np.clip(np.rint(mono * 32768), -32768, 32767).astype('<i2')
+            resampled = time.perf_counter()
+            pcm.tofile(out)
+            stage_seconds['downmix'] += mixed - started
+            stage_seconds['resample'] += resampled - mixed
+            stage_seconds['export'] += time.perf_counter() - resampled
+            if progress:
+                progress(stop * 2)
+    for name, seconds in stage_seconds.items():
+        metrics.observe_stage('numpy', name, seconds)
+    return out_frames
+
+
+def transcode_numpy(input_path, output_path, progress=None, profile=DEFAULT_PROFILE,
+                    extra_outputs=()):
+    """Convert a PCM WAV to ``profile`` in-process with NumPy.
+
+    The input's data chunk is memory-mapped and processed in blocks, so memory
+    use is bounded and no subprocess is started. Channels are averaged, then
+    resampled with a polyphase windowed-sinc filter. ``extra_outputs`` and
+    ``progress`` work as in ``transcode_streaming``; ``progress`` only
+    covers the primary output. Returns the number of frames written there.
+    """
+    header = numpy_wav_input(input_path, [profile] + [name for name, _ in extra_outputs])
+    if header is None:
+        raise WavFormatError("Input isn't a PCM WAV file the NumPy engine can convert")
+    width = header['bits_per_sample'] // 8
+    channels = header['channels']
+    # A truncated file is read up to its last complete frame
+    data_size = min(header['data_size'], header['file_size'] - header['data_offset'])
+    frames = data_size // header['block_align']
+    if frames == 0:
+        raise WavFormatError("Input WAV has no audio frames")
+
+    # Pages are read on demand as blocks are processed; the map closes with the array
+    mapped = np.memmap(input_path, dtype=np.uint8, mode='r', offset=header['data_offset'],
+                       shape=(frames * header['block_align'],))
+    if width == 3:
+        samples = mapped.reshape(frames, channels, 3)
+    else:
+        samples = mapped.view(NUMPY_SAMPLE_TYPES[width]).reshape(frames, channels)
+    written = _resample_to_file(samples, width, header['sample_rate'], profile,
+                                output_path, progress)
+    for name, path in extra_outputs:
+        _resample_to_file(samples, width, header['sample_rate'], name, path)
+    return written
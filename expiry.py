@@ -0,0 +1,132 @@
+"""
+Deadline-ordered expiry of tasks and their files.
+
+``ExpiryScheduler`` keeps every pending expiry in a min-heap of
+``(deadline, key)`` and runs one thread that sleeps until the earliest
+deadline. Due entries are handed to the ``expire`` callback together, so
+removals are batched and neither the thread count nor any disk scanning grows
+with traffic.
+"""
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """Min-heap of deadlines with a single thread expiring due entries.
+
+    Each key has one deadline and a set of files. Rescheduling a key pushes a
+    new heap entry and leaves the old one to be skipped when popped; the heap
+    is rebuilt once stale entries outnumber live ones. ``expire`` receives a
+    list of ``(key, files)`` pairs.
+    """
+
+    def __init__(self, expire, batch_window=5.0, clock=time.time):
+        self.expire = expire
+        self.batch_window = batch_window
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._heap = []
+        self._entries = {}
+        self._thread = None
+        self._stopped = False
+
+    def schedule(self, key, deadline, files=(), shorten_only=False):
+        """Expire ``key`` and its files at ``deadline`` (a ``clock`` timestamp).
+
+        Files add to any already registered for the key. With ``shorten_only``
+        an existing later deadline is brought forward but an earlier one is kept.
+        """
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1].update(files)
+                if entry[0] == deadline or (shorten_only and entry[0] < deadline):
+                    return
+            else:
+                entry = self._entries[key] = [deadline, set(files)]
+            entry[0] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._compact_locked()
+            if self._heap[0] == (deadline, key):
+                # New earliest deadline; the thread may be sleeping past it
+                self._cond.notify()
+
+    def cancel(self, key):
+        """Forget ``key`` without expiring it"""
+        with self._cond:
+            self._entries.pop(key, None)
+
+    def deadline(self, key):
+        """Return the deadline scheduled for ``key``, or None"""
+        with self._cond:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+
+    def pending(self):
+        """Return the number of keys waiting to expire"""
+        with self._cond:
+            return len(self._entries)
+
+    def run_due(self, now=None):
+        """Expire every entry due at ``now`` in one batch; returns the batch"""
+        with self._cond:
+            due = self._pop_due_locked(self.clock() if now is None else now)
+        if due:
+            self.expire(due)
+        return due
+
+    def start(self):
+        """Start the expiry thread"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='expiry', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the expiry thread; pending entries are left unexpired"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _pop_due_locked(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != deadline:
+                continue  # Cancelled or rescheduled
+            del self._entries[key]
+            due.append((key, sorted(entry[1])))
+        return due
+
+    def _compact_locked(self):
+        self._heap = [(entry[0], key) for key, entry in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = self.clock()
+                    # Let entries due shortly after the first one join its batch
+                    if self._heap and self._heap[0][0] + self.batch_window <= now:
+                        due = self._pop_due_locked(now)
+                        if due:
+                            break
+                        continue
+                    timeout = self._heap[0][0] + self.batch_window - now if self._heap else None
+                    self._cond.wait(timeout)
+            try:
+                self.expire(due)
+            except Exception as e:
+                logger.error(f"Error expiring {len(due)} items: {e}")
@@ -0,0 +1,339 @@
+"""
+Shared conversion job queue with time-limited leases.
+
+With ``JOB_QUEUE=lease`` uploads are queued in a ``jobs`` table next to the
+tasks in the SQLite task database instead of in one process's memory. Any
+process using the same database (gunicorn workers, or several containers
+sharing the data volume) claims queued jobs when it has an idle worker:
+
+* a claim leases the job to its owner for ``lease_seconds``. The owner's
+  heartbeat extends the leases of every job it holds in one statement.
+* a lease that runs out (the owner crashed, was killed or hung) makes the job
+  claimable again, so it's re-queued without anyone having to notice the
+  failure. A job whose leases have expired ``max_attempts`` times is given up.
+* finishing a job deletes its row.
+
+``LeaseDispatcher`` runs the claim and heartbeat loops for one process.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteJobQueue:
+    """Leased jobs in a ``jobs`` table; every change is one short transaction"""
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._conn()
+        # owner is NULL while a job is queued; attempts counts claims
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " owner TEXT,"
+            " lease_expires REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " enqueued REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_enqueued ON jobs (enqueued)")
+
+    def _conn(self):
+        # SQLite connections can't be shared across threads or forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def enqueue(self, job_id, payload, limit=None, owner=None, lease_seconds=0, now=None):
+        """Queue a job and return its 1-based position, or None if ``limit`` jobs are waiting
+
+        With ``owner`` the job starts out leased to it, for work the caller
+        runs itself but that should be recovered if it dies.
+        """
+        now = time.time() if now is None else now
+
+        def apply(conn):
+            waiting = self._waiting(conn, now)
+            if owner is None and limit is not None and waiting >= limit:
+                return None
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, payload, owner, lease_expires, attempts, enqueued)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(payload), owner, now + lease_seconds if owner else None,
+                 1 if owner else 0, now))
+            return waiting + 1
+        return self._transaction(apply)
+
+    def update(self, job_id, changes):
+        """Merge ``changes`` into job_id's payload; returns False if the job is gone"""
+        def apply(conn):
+            row = conn.execute("SELECT payload FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            payload = dict(json.loads(row[0]), **changes)
+            conn.execute("UPDATE jobs SET payload = ? WHERE job_id = ?", (json.dumps(payload), job_id))
+            return True
+        return self._transaction(apply)
+
+    def _waiting(self, conn, now, before=None):
+        query = "SELECT COUNT(*) FROM jobs WHERE (owner IS NULL OR lease_expires < ?)"
+        args = [now]
+        if before is not None:
+            query += " AND enqueued <= ?"
+            args.append(before)
+        return conn.execute(query, args).fetchone()[0]
+
+    def claim(self, owner, lease_seconds, max_attempts=3, now=None):
+        """Lease the oldest claimable job to owner.
+
+        Returns ``(job, failed)``: ``job`` is ``(job_id, payload, attempts)``
+        or None, and ``failed`` lists jobs dropped because their leases had
+        already expired ``max_attempts`` times.
+        """
+        now = time.time() if now is None else now
+
+        def apply(conn):
+            failed = []
+            while True:
+                row = conn.execute(
+                    "SELECT job_id, payload, attempts FROM jobs"
+                    " WHERE owner IS NULL OR lease_expires < ?"
+                    " ORDER BY enqueued LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None, failed
+                job_id, payload, attempts = row
+                if attempts >= max_attempts:
+                    conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+                    failed.append(job_id)
+                    continue
+                conn.execute(
+                    "UPDATE jobs SET owner = ?, lease_expires = ?, attempts = attempts + 1"
+                    " WHERE job_id = ?", (owner, now + lease_seconds, job_id))
+                return (job_id, json.loads(payload), attempts + 1), failed
+        return self._transaction(apply)
+
+    def heartbeat(self, owner, job_ids, lease_seconds, now=None):
+        """Extend owner's leases on job_ids; returns the set it still holds"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return set()
+        now = time.time() if now is None else now
+
+        def apply(conn):
+            # A lease that ran out may already belong to someone else
+            placeholders = ','.join('?' * len(job_ids))
+            conn.execute(
+                f"UPDATE jobs SET lease_expires = ? WHERE owner = ? AND lease_expires >= ?"
+                f" AND job_id IN ({placeholders})", [now + lease_seconds, owner, now] + job_ids)
+            rows = conn.execute(
+                f"SELECT job_id FROM jobs WHERE owner = ? AND lease_expires >= ?"
+                f" AND job_id IN ({placeholders})", [owner, now] + job_ids).fetchall()
+            return {row[0] for row in rows}
+        return self._transaction(apply)
+
+    def complete(self, job_id, owner):
+        """Remove a finished job; returns False if owner no longer held it"""
+        cursor = self._conn().execute(
+            "DELETE FROM jobs WHERE job_id = ? AND owner = ?", (job_id, owner))
+        return cursor.rowcount == 1
+
+    def release(self, owner, job_ids=None):
+        """Put owner's jobs (or just job_ids) back in the queue without using up an attempt"""
+        query = ("UPDATE jobs SET owner = NULL, lease_expires = NULL, attempts = MAX(attempts - 1, 0)"
+                 " WHERE owner = ?")
+        args = [owner]
+        if job_ids is not None:
+            job_ids = list(job_ids)
+            if not job_ids:
+                return 0
+            query += f" AND job_id IN ({','.join('?' * len(job_ids))})"
+            args += job_ids
+        return self._conn().execute(query, args).rowcount
+
+    def position(self, job_id, now=None):
+        """Return the 1-based queue position of job_id, or None if it isn't waiting"""
+        now = time.time() if now is None else now
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT enqueued FROM jobs WHERE job_id = ? AND (owner IS NULL OR lease_expires < ?)",
+            (job_id, now)).fetchone()
+        if row is None:
+            return None
+        return self._waiting(conn, now, before=row[0])
+
+    def stats(self, now=None):
+        """Return counts of waiting and leased jobs"""
+        now = time.time() if now is None else now
+        conn = self._conn()
+        total = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        waiting = self._waiting(conn, now)
+        return {'waiting': waiting, 'leased': total - waiting}
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class LeaseDispatcher:
+    """Claims jobs for this process while it has capacity and keeps their leases alive.
+
+    ``run(job_id, payload, attempts)`` must hand the job off without blocking
+    (e.g. submit it to the local worker pool) and return False if it couldn't
+    take it after all. The job's worker calls ``done(job_id)`` when finished.
+    ``has_capacity()`` says whether a worker is free. ``on_failed(job_id)`` is
+    called for jobs given up after too many expired leases. A worker about to
+    publish its results calls ``renew(job_id)`` first, since its job may have
+    been handed to another worker in the meantime.
+    """
+
+    def __init__(self, queue, run, has_capacity, on_failed=None, lease_seconds=60.0,
+                 poll_seconds=1.0, max_attempts=3, owner=None):
+        self.queue = queue
+        self.run = run
+        self.has_capacity = has_capacity
+        self.on_failed = on_failed
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._held = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the claim and heartbeat threads"""
+        if self._threads:
+            return
+        for target, name in ((self._claim_loop, 'job-claimer'), (self._heartbeat_loop, 'job-heartbeat')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Claiming conversion jobs as {self.owner}")
+
+    def stop(self, release=True):
+        """Stop claiming; with ``release`` held jobs go straight back to the queue"""
+        self._stopped.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        if release:
+            with self._lock:
+                held, self._held = set(self._held), set()
+            if held:
+                self.queue.release(self.owner, held)
+                logger.info(f"Released {len(held)} conversion jobs")
+
+    def wake(self):
+        """Look for a job now instead of at the next poll"""
+        self._wake.set()
+
+    def hold(self, job_id):
+        """Keep the lease of a job this process enqueued as its own alive"""
+        with self._lock:
+            self._held.add(job_id)
+
+    def done(self, job_id):
+        """Finish a job claimed or held by this process"""
+        with self._lock:
+            self._held.discard(job_id)
+        if not self.queue.complete(job_id, self.owner):
+            logger.warning(f"Lease on job {job_id} was lost before it finished; "
+                           f"another worker may have run it again")
+
+    def renew(self, job_id):
+        """Renew one held job's lease now; returns False (dropping the job) if it was lost"""
+        with self._lock:
+            if job_id not in self._held:
+                return False
+        if job_id in self.queue.heartbeat(self.owner, [job_id], self.lease_seconds):
+            return True
+        with self._lock:
+            self._held.discard(job_id)
+        logger.warning(f"Lost the lease on job {job_id}")
+        return False
+
+    def held(self):
+        with self._lock:
+            return set(self._held)
+
+    def claim_once(self):
+        """Claim and hand off one job if there's capacity; returns True if one was started"""
+        if not self.has_capacity():
+            return False
+        job, failed = self.queue.claim(self.owner, self.lease_seconds, self.max_attempts)
+        for job_id in failed:
+            logger.error(f"Giving up on job {job_id} after {self.max_attempts} expired leases")
+            if self.on_failed:
+                self.on_failed(job_id)
+        if job is None:
+            return False
+        job_id, payload, attempts = job
+        if attempts > 1:
+            logger.warning(f"Re-running job {job_id} (attempt {attempts}) after its lease expired")
+        self.hold(job_id)
+        if not self.run(job_id, payload, attempts):
+            with self._lock:
+                self._held.discard(job_id)
+            self.queue.release(self.owner, [job_id])
+            return False
+        return True
+
+    def heartbeat_once(self):
+        """Renew every held lease; jobs whose lease was lost are dropped"""
+        held = self.held()
+        if not held:
+            return
+        still_held = self.queue.heartbeat(self.owner, held, self.lease_seconds)
+        lost = held - still_held
+        if lost:
+            with self._lock:
+                self._held -= lost
+            logger.warning(f"Lost the lease on jobs {sorted(lost)}")
+
+    def _claim_loop(self):
+        while not self._stopped.is_set():
+            try:
+                if self.claim_once():
+                    continue
+            except Exception as e:
+                logger.error(f"Error claiming conversion jobs: {e}")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def _heartbeat_loop(self):
+        # Renew well before expiry so one slow round doesn't lose the leases
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat_once()
+            except Exception as e:
+                logger.error(f"Error renewing job leases: {e}")
@@ -0,0 +1,413 @@
+"""
+Prometheus metrics shared across worker processes.
+
+Each process (gunicorn worker or conversion child process) records metrics in
+memory and periodically writes them to ``<directory>/<pid>.json``. ``render``
+merges every process's file into the Prometheus text exposition format, so
+``/metrics`` on any worker reports the whole server:
+
+* counters and histograms are summed over all files, including those of
+  processes that have exited, so worker restarts don't reset them. Files left
+  by dead processes are folded into ``archived.json`` to keep the directory
+  small.
+* gauges are summed over live processes only.
+
+Without a directory the registry only reports the current process.
+"""
+import bisect
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'wav-maker-metrics')
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+ARCHIVE_FILE = 'archived.json'
+
+
+class Metric:
+    """A named metric with optional labels; ``labels`` returns a child to record on"""
+
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        return _Child(self, tuple(str(value) for value in values))
+
+
+class _Child:
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric._inc(self.key, amount)
+
+    def set(self, value):
+        self.metric._set(self.key, value)
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    """Context manager observing the time spent in its block"""
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def _inc(self, key, amount):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        with self.registry._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self.registry._changed()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self._set((), value)
+
+    def _set(self, key, value):
+        with self.registry._lock:
+            self._values[key] = value
+            self.registry._changed()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def time(self):
+        return _Timer(_Child(self, ()))
+
+    def _observe(self, key, value):
+        with self.registry._lock:
+            sample = self._values.get(key)
+            if sample is None:
+                # Per-bucket counts (not cumulative) plus +Inf, then the sum
+                sample = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            sample['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            sample['sum'] += value
+            self.registry._changed()
+
+
+class Registry:
+    """Metrics of this process, written to ``directory`` every ``flush_interval`` seconds"""
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+        self._thread = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent's values are in its own file, and its flush thread didn't survive the fork
+        self._lock = threading.Lock()
+        self._thread = None
+        for metric in self._metrics.values():
+            metric._values = {}
+
+    def configure(self, directory, flush_interval=None):
+        """Share metrics through ``directory`` (None keeps them in this process)"""
+        self.directory = directory or None
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def add_collector(self, fn):
+        """Call ``fn()`` before each flush or render, e.g. to set gauges from live state"""
+        self._collectors.append(fn)
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def _changed(self):
+        # Called with the lock held; the first recorded value starts the flush thread
+        if self.directory and self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Failed to write metrics: {e}")
+
+    def _collect(self):
+        for fn in self._collectors:
+            try:
+                fn()
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+
+    def snapshot(self):
+        """This process's metrics as a JSON-serializable dict"""
+        with self._lock:
+            return {name: {'kind': metric.kind, 'help': metric.documentation,
+                           'labelnames': list(metric.labelnames),
+                           'buckets': list(getattr(metric, 'buckets', ())),
+                           'values': [[list(key), _copy(value)] for key, value in metric._values.items()]}
+                    for name, metric in self._metrics.items()}
+
+    def flush(self):
+        """Write this process's metrics to its file in the shared directory"""
+        if not self.directory:
+            return
+        self._collect()
+        data = {'pid': os.getpid(), 'metrics': self.snapshot()}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    def render(self):
+        """Metrics of every process in the Prometheus text format"""
+        if not self.directory:
+            self._collect()
+            return _render(_merge([{'pid': os.getpid(), 'metrics': self.snapshot()}]))
+        self.flush()
+        with _DirectoryLock(self.directory):
+            self._archive_dead()
+            files = [_read(os.path.join(self.directory, name))
+                     for name in os.listdir(self.directory)
+                     if name.endswith('.json') and not name.startswith('.')]
+        return _render(_merge([data for data in files if data is not None]))
+
+    def _archive_dead(self):
+        # Called with the directory lock held
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+        dead = []
+        for name in os.listdir(self.directory):
+            pid = name[:-len('.json')]
+            if name.endswith('.json') and pid.isdigit() and not _alive(int(pid)):
+                dead.append(os.path.join(self.directory, name))
+        if not dead:
+            return
+        sources = [_read(path) for path in dead]
+        archive = _read(archive_path)
+        merged = _merge([data for data in [archive] + sources if data is not None],
+                        include_gauges=False)
+        data = {'pid': None, 'metrics': merged}
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, archive_path)
+        for path in dead:
+            os.remove(path)
+
+
+class _DirectoryLock:
+    """Exclusive lock held while files of dead processes are archived"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, '.lock')
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {'counts': list(value['counts']), 'sum': value['sum']}
+    return value
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(files, include_gauges=True):
+    """Sum per-process snapshots; gauges only come from live processes"""
+    merged = {}
+    for data in files:
+        live = data['pid'] is not None and _alive(data['pid'])
+        for name, metric in data['metrics'].items():
+            if metric['kind'] == 'gauge' and not (include_gauges and live):
+                continue
+            target = merged.setdefault(name, dict(metric, values=[]))
+            values = {tuple(key): value for key, value in target['values']}
+            for key, value in metric['values']:
+                key = tuple(key)
+                if key not in values:
+                    values[key] = _copy(value)
+                elif isinstance(value, dict):
+                    values[key]['counts'] = [a + b for a, b in zip(values[key]['counts'], value['counts'])]
+                    values[key]['sum'] += value['sum']
+                else:
+                    values[key] += value
+            target['values'] = [[list(key), value] for key, value in values.items()]
+    return merged
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _render(merged):
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        names = metric['labelnames']
+        for key, value in sorted(metric['values']):
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_labels(names, key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + [float('inf')], value['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(names, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {_number(value['sum'])}")
+            lines.append(f"{name}_count{_labels(names, key)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+# The process-wide registry. Spawned conversion processes inherit METRICS_DIR
+# from the environment, so their stage timings reach the same directory.
+REGISTRY = Registry(os.environ.get('METRICS_DIR', DEFAULT_DIR) or None,
+                    float(os.environ.get('METRICS_FLUSH_SECONDS', 5.0)))
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'wavmaker_stage_seconds', 'Time spent in each conversion stage', ['engine', 'stage'])
+CONVERSION_SECONDS = REGISTRY.histogram(
+    'wavmaker_conversion_seconds', 'End-to-end conversion time of a task', ['source'])
+CONVERSIONS = REGISTRY.counter(
+    'wavmaker_conversions_total', 'Completed tasks by how the output was produced', ['source'])
+ERRORS = REGISTRY.counter(
+    'wavmaker_conversion_errors_total', 'Failed or rejected tasks by reason', ['reason'])
+INPUT_BYTES = REGISTRY.counter(
+    'wavmaker_input_bytes_total', 'Bytes of input audio in completed tasks')
+OUTPUT_BYTES = REGISTRY.counter(
+    'wavmaker_output_bytes_total', 'Bytes of converted output written', ['profile'])
+AUDIO_SECONDS = REGISTRY.counter(
+    'wavmaker_audio_seconds_total', 'Seconds of input audio in completed tasks')
+STORE_SECONDS = REGISTRY.histogram(
+    'wavmaker_task_store_seconds', 'Task store operation latency', ['operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+STORE_LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    'wavmaker_task_store_lock_wait_seconds', 'Time spent waiting for the task store lock', ['backend'],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+QUEUE_DEPTH = REGISTRY.gauge(
+    'wavmaker_queue_depth', 'Conversion jobs waiting for a worker')
+ACTIVE_CONVERSIONS = REGISTRY.gauge(
+    'wavmaker_active_conversions', 'Conversion jobs currently running')
+
+
+@contextlib.contextmanager
+def timed(child, span_name, **attributes):
+    """Observe the block's duration on a histogram child and trace it as a span"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        child.observe(duration)
+        tracing.add(span_name, start=start, duration=duration, **attributes)
+
+
+def stage(engine, name):
+    """Context manager timing one conversion stage"""
+    return timed(STAGE_SECONDS.labels(engine, name), name, engine=engine)
+
+
+def observe_stage(engine, name, seconds):
+    """Record a stage measured by the engine itself, e.g. summed over blocks"""
+    STAGE_SECONDS.labels(engine, name).observe(seconds)
+    tracing.add(name, duration=seconds, engine=engine)
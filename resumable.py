@@ -0,0 +1,166 @@
+"""
+Helpers for resumable, chunked uploads.
+
+The protocol follows tus 1.0 (creation, checksum and termination extensions):
+an upload is created with its total length, then its bytes are sent in PATCH
+requests that each name the offset they start at. Unlike core tus, chunks may
+arrive out of order and in parallel; each is verified, then written in place
+into a sparse file of the full length, and the byte ranges received so far
+are kept as a sorted list of ``[start, end)`` pairs. Bytes already received
+are never overwritten.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import tempfile
+
+TUS_VERSION = '1.0.0'
+CHECKSUM_ALGORITHMS = ('sha1', 'sha256', 'md5')
+CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 8 * 1024 * 1024  # Chunks up to this size are checked in memory
+
+
+class ChecksumMismatch(Exception):
+    """A chunk's bytes don't match its Upload-Checksum header"""
+
+
+def parse_metadata(header):
+    """Decode an Upload-Metadata header into a dict of strings
+
+    The header is a comma-separated list of ``key base64value`` pairs; a key
+    may appear without a value. Raises ValueError on malformed values.
+    """
+    metadata = {}
+    for pair in (header or '').split(','):
+        parts = pair.strip().split(' ')
+        if not parts[0]:
+            continue
+        if len(parts) > 2:
+            raise ValueError(f"Malformed metadata pair: {pair.strip()}")
+        try:
+            value = base64.b64decode(parts[1], validate=True).decode() if len(parts) == 2 else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise ValueError(f"Metadata value for {parts[0]} is not base64")
+        metadata[parts[0]] = value
+    return metadata
+
+
+def parse_checksum(header):
+    """Split an Upload-Checksum header into ``(algorithm, digest bytes)``
+
+    Returns None for an empty header. Raises ValueError for an unsupported
+    algorithm or a digest that isn't base64.
+    """
+    if not header:
+        return None
+    algorithm, _, encoded = header.strip().partition(' ')
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f"Unsupported checksum algorithm: {algorithm}")
+    try:
+        return algorithm, base64.b64decode(encoded, validate=True)
+    except binascii.Error:
+        raise ValueError("Checksum is not base64")
+
+
+def create_upload_file(path, length):
+    """Create ``path`` as a sparse file of ``length`` bytes for the upload
+
+    No blocks are reserved: space is only used as chunks are written, so
+    creating an upload costs nothing however large it claims to be.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, length)
+    finally:
+        os.close(fd)
+
+
+def write_chunk(stream, path, offset, length, checksum=None, received=(), chunk_size=CHUNK_SIZE):
+    """Copy up to ``length`` bytes from ``stream`` into ``path`` at ``offset``
+
+    The chunk is spooled (in memory up to ``SPOOL_SIZE``, then next to
+    ``path``) and checked before anything is written, so a corrupt chunk
+    never touches the upload. ``checksum`` is an ``(algorithm, digest)`` pair
+    from ``parse_checksum``; ChecksumMismatch is raised if the received bytes
+    differ. Only the parts not in ``received``, the ranges already accepted,
+    are written, with ``pwrite`` so concurrent chunks of the same upload
+    don't share a file position. Returns the number of bytes the chunk
+    covers, which is short if the client stopped sending early.
+    """
+    hasher = hashlib.new(checksum[0]) if checksum else None
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=os.path.dirname(path) or None) as spool:
+        size = 0
+        while size < length:
+            data = stream.read(min(chunk_size, length - size))
+            if not data:
+                break
+            spool.write(data)
+            if hasher:
+                hasher.update(data)
+            size += len(data)
+        if hasher and not hmac.compare_digest(hasher.digest(), checksum[1]):
+            raise ChecksumMismatch(f"{checksum[0]} of {size} bytes at offset {offset} doesn't match")
+
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            for start, end in gaps(received, offset, offset + size):
+                spool.seek(start - offset)
+                while start < end:
+                    data = spool.read(min(chunk_size, end - start))
+                    os.pwrite(fd, data, start)
+                    start += len(data)
+        finally:
+            os.close(fd)
+    return size
+
+
+def gaps(ranges, start, end):
+    """The parts of ``[start, end)`` not covered by ``ranges``"""
+    missing = []
+    for range_start, range_end in sorted(ranges):
+        if range_end <= start or range_start >= end:
+            continue
+        if range_start > start:
+            missing.append([start, range_start])
+        start = max(start, range_end)
+    if start < end:
+        missing.append([start, end])
+    return missing
+
+
+def add_range(ranges, start, end):
+    """Return ``ranges`` with ``[start, end)`` merged in"""
+    merged = []
+    for range_start, range_end in sorted(list(ranges) + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def contiguous(ranges):
+    """Bytes received without a gap from the start of the upload"""
+    return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+
+def received(ranges):
+    """Total bytes received"""
+    return sum(end - start for start, end in ranges)
+
+
+def format_ranges(ranges):
+    """Ranges as an Upload-Ranges header: inclusive ``start-end`` pairs"""
+    return ','.join(f"{start}-{end - 1}" for start, end in ranges)
+
+
+def sha256_file(path, chunk_size=CHUNK_SIZE):
+    """SHA-256 of a finished upload, for the conversion cache"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
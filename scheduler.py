@@ -0,0 +1,399 @@
+"""
+Bounded worker pool for conversion jobs.
+
+A fixed number of worker threads pull jobs from a bounded queue. When the
+queue is full ``submit`` raises ``QueueFull`` with a Retry-After estimate so the
+caller can shed load instead of starting unbounded work.
+
+Jobs are ordered by weighted fair queuing across clients. Each job carries a
+cost (its input's duration x channels x sample rate) and gets a virtual
+finish time: its cost added to the later of the current virtual time and its
+client's previous finish time (self-clocked fair queuing). The job with the
+earliest finish time runs next. A client's jobs still run in the order it
+submitted them, but a short prompt from one client isn't stuck behind
+another client's twenty long recordings. Per-client quotas limit how many
+jobs and how much cost a client may have in flight, and how many of its jobs
+may run at once while other clients are waiting; jobs over the last limit wait
+in the queue ("deferred") only as long as another client's job can use the
+worker instead.
+
+``ProcessPool`` optionally moves the CPU-bound part of a job into child
+processes so conversions aren't serialized on the web process's GIL.
+``AsyncScheduler`` is the same bounded queue for coroutine jobs on an asyncio
+event loop.
+"""
+import asyncio
+import bisect
+import collections
+import logging
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when the conversion queue has no free slots"""
+
+    reason = 'queue_full'
+
+    def __init__(self, retry_after):
+        super().__init__(f"Conversion queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class QuotaExceeded(QueueFull):
+    """Raised when a client already has as many jobs, or as much cost, in flight as it may
+
+    ``reason`` is ``client_jobs`` or ``client_cost``.
+    """
+
+    def __init__(self, retry_after, reason):
+        Exception.__init__(self, f"Client quota ({reason}) exceeded, retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+# finish is the job's virtual finish time; seq breaks ties in submission order
+_Job = collections.namedtuple('_Job', 'finish seq task_id fn args client cost')
+
+
+class ConversionScheduler:
+    """Fixed-size pool of worker threads fed by a bounded, fair-queued job queue
+
+    ``client_max_jobs`` and ``client_max_cost`` cap each client's queued and
+    running jobs and their summed cost; ``client_max_active`` caps its running
+    jobs while another client has a job that could start. None (or 0) means
+    no limit. Jobs submitted without a ``client`` (such as ones claimed from a
+    shared queue) are exempt from all three.
+    """
+
+    def __init__(self, workers=2, max_queue=20, default_job_seconds=10.0,
+                 client_max_jobs=None, client_max_cost=None, client_max_active=None):
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.client_max_jobs = client_max_jobs or None
+        self.client_max_cost = client_max_cost or None
+        self.client_max_active = client_max_active or None
+        self._queue = []  # _Jobs sorted by (finish, seq)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._active = set()
+        self._avg_job_seconds = default_job_seconds
+        self._avg_cost = 1.0
+        self._seconds_per_cost = None
+        self._completed = 0
+        self._shutdown = False
+        self._seq = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._client_jobs = collections.Counter()
+        self._client_cost = collections.Counter()
+        self._client_active = collections.Counter()
+
+    def start(self):
+        """Start the worker threads"""
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"conversion-worker-{i}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, task_id, fn, *args, client=None, cost=None):
+        """Queue ``fn(*args)`` for ``task_id`` and return its 1-based queue position
+
+        ``client`` identifies who submitted the job for fair queuing and quotas;
+        jobs without one aren't limited by the client quotas.
+        ``cost`` is its estimated work; None counts as the average cost so far.
+        Raises ``QuotaExceeded`` if the client is over a quota and
+        ``QueueFull`` if the queue is.
+        """
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Scheduler is shut down")
+            cost = self._job_cost_locked(cost)
+            self._check_quota_locked(client, [cost])
+            # Idle workers pick jobs up straight away, so they add to capacity
+            idle_workers = self.workers - len(self._active)
+            if len(self._queue) >= self.max_queue + idle_workers:
+                raise QueueFull(self._retry_after_locked())
+
+            self._seq += 1
+            finish = max(self._virtual_time, self._last_finish.get(client, 0.0)) + cost
+            self._last_finish[client] = finish
+            job = _Job(finish, self._seq, task_id, fn, args, client, cost)
+            bisect.insort(self._queue, job)
+            self._client_jobs[client] += 1
+            self._client_cost[client] += cost
+            self._avg_cost = 0.8 * self._avg_cost + 0.2 * cost if self._seq > 1 else cost
+            position = self._queue.index(job) + 1
+            self._cond.notify_all()
+        return position
+
+    def check_quota(self, client, costs):
+        """Raise ``QuotaExceeded`` unless ``client`` could submit jobs of each of ``costs`` now
+
+        Lets a caller take several jobs all or none. Only the client's quotas
+        are checked, not free queue slots (see ``free_slots``).
+        """
+        with self._cond:
+            self._check_quota_locked(client, [self._job_cost_locked(cost) for cost in costs])
+
+    def position(self, task_id):
+        """Return the 1-based queue position of ``task_id``, or None if not queued"""
+        with self._cond:
+            for index, job in enumerate(self._queue):
+                if job.task_id == task_id:
+                    return index + 1
+        return None
+
+    def deferred(self, task_id):
+        """Whether queued ``task_id`` is held back because its client has enough jobs running"""
+        with self._cond:
+            for job in self._queue:
+                if job.task_id == task_id:
+                    return not self._may_start_locked(job)
+        return False
+
+    def stats(self):
+        """Return a snapshot of queue depth and worker usage"""
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'active': len(self._active),
+                'queued': len(self._queue),
+                'max_queue': self.max_queue,
+                'completed': self._completed,
+                'clients': sum(1 for count in self._client_jobs.values() if count),
+            }
+
+    def free_slots(self):
+        """Return how many more jobs ``submit`` would accept right now"""
+        with self._cond:
+            idle_workers = self.workers - len(self._active)
+            return max(0, self.max_queue + idle_workers - len(self._queue))
+
+    def retry_after(self):
+        """Estimate how many seconds until a queue slot frees up"""
+        with self._cond:
+            return self._retry_after_locked()
+
+    def _retry_after_locked(self):
+        # One slot opens roughly every avg_job_seconds / workers
+        return max(1, int(math.ceil(self._avg_job_seconds / self.workers)))
+
+    def _job_cost_locked(self, cost):
+        return self._avg_cost if cost is None else max(float(cost), 0.0)
+
+    def _check_quota_locked(self, client, costs):
+        if client is None:
+            return
+        in_flight, total = self._client_jobs[client], self._client_cost[client]
+        for cost in costs:
+            if self.client_max_jobs and in_flight >= self.client_max_jobs:
+                raise QuotaExceeded(self._client_retry_after_locked(client, None), 'client_jobs')
+            # A job is always admitted when its client has nothing else in flight
+            over_cost = total + cost - (self.client_max_cost or 0)
+            if self.client_max_cost and in_flight and over_cost > 0:
+                raise QuotaExceeded(self._client_retry_after_locked(client, over_cost), 'client_cost')
+            in_flight += 1
+            total += cost
+
+    def _client_retry_after_locked(self, client, cost):
+        """Seconds until ``cost`` of the client's work (by default its smallest job) is done"""
+        if cost is None:
+            cost = min((job.cost for job in self._queue if job.client == client),
+                       default=self._avg_cost)
+        seconds_per_cost = self._seconds_per_cost or self._avg_job_seconds / max(self._avg_cost, 1e-9)
+        running = min(self.client_max_active or self.workers, self.workers)
+        return max(1, int(math.ceil(cost * seconds_per_cost / running)))
+
+    def _under_active_cap_locked(self, job):
+        return (job.client is None or not self.client_max_active
+                or self._client_active[job.client] < self.client_max_active)
+
+    def _may_start_locked(self, job):
+        if self._under_active_cap_locked(job):
+            return True
+        # Over its cap a client only gives way to another client's job; workers never sit idle
+        return not any(other.client != job.client and self._under_active_cap_locked(other)
+                       for other in self._queue)
+
+    def _next_job_locked(self):
+        """Take the queued job with the earliest finish time whose client may start one, or None"""
+        for index, job in enumerate(self._queue):
+            if self._may_start_locked(job):
+                del self._queue[index]
+                self._virtual_time = max(self._virtual_time, job.finish)
+                self._client_active[job.client] += 1
+                self._active.add(job.task_id)
+                return job
+        return None
+
+    def _job_done_locked(self, job, elapsed):
+        self._active.discard(job.task_id)
+        self._completed += 1
+        # Exponentially weighted averages for Retry-After estimates
+        self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * elapsed
+        if job.cost > 0:
+            rate = elapsed / job.cost
+            self._seconds_per_cost = (rate if self._seconds_per_cost is None
+                                      else 0.8 * self._seconds_per_cost + 0.2 * rate)
+        self._client_active[job.client] -= 1
+        self._client_jobs[job.client] -= 1
+        self._client_cost[job.client] -= job.cost
+        if not self._client_jobs[job.client]:
+            for counter in (self._client_jobs, self._client_cost, self._client_active):
+                del counter[job.client]
+            self._last_finish.pop(job.client, None)
+        # A deferred job of this client may be able to start now
+        self._cond.notify_all()
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs and let workers exit once the queue drains"""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    job = self._next_job_locked()
+                    if job is not None or (self._shutdown and not self._queue):
+                        break
+                    self._cond.wait()
+                if job is None:
+                    return
+
+            start = time.monotonic()
+            try:
+                job.fn(*job.args)
+            except Exception as e:
+                logger.error(f"Unhandled error in conversion job {job.task_id}: {e}")
+            finally:
+                with self._cond:
+                    self._job_done_locked(job, time.monotonic() - start)
+
+
+class WorkerCrashed(Exception):
+    """Raised when a child process died while running a job"""
+
+
+class ProcessPool:
+    """Process pool that rebuilds itself when a child process crashes.
+
+    Jobs should take only picklable, lightweight arguments such as file paths
+    and task IDs. Children are started with ``spawn`` so they don't inherit the
+    web process's threads or locks.
+    """
+
+    def __init__(self, processes=None, retries=1):
+        self.processes = max(1, int(processes or multiprocessing.cpu_count()))
+        self.retries = max(0, int(retries))
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _discard_executor(self, executor):
+        with self._lock:
+            # Another thread may already have replaced the broken pool
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        """Run ``fn(*args)`` in a child process and return its result.
+
+        A crashed child breaks every job in flight, so the job is retried on a
+        fresh pool up to ``retries`` times before ``WorkerCrashed`` is raised.
+        """
+        for attempt in range(self.retries + 1):
+            executor = self._get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                logger.error(f"Conversion process crashed (attempt {attempt + 1}), restarting pool")
+                self._discard_executor(executor)
+        raise WorkerCrashed("Conversion worker process crashed")
+
+    def shutdown(self, wait=True):
+        """Stop all child processes"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+class AsyncScheduler(ConversionScheduler):
+    """``ConversionScheduler`` for coroutines, run on an asyncio event loop.
+
+    At most ``workers`` jobs run at once, each as an asyncio task, so a job
+    waiting on a child process holds no thread. ``submit`` must be called
+    from the event loop; positions and stats can be read from any thread.
+    """
+
+    def __init__(self, workers=2, max_queue=20, default_job_seconds=10.0, **client_limits):
+        super().__init__(workers, max_queue, default_job_seconds, **client_limits)
+        self._tasks = set()
+
+    def start(self):
+        """Jobs start as they're submitted; there are no threads to start"""
+
+    def submit(self, task_id, fn, *args, client=None, cost=None):
+        """Queue the coroutine ``fn(*args)`` for ``task_id`` and return its 1-based queue position"""
+        position = super().submit(task_id, fn, *args, client=client, cost=cost)
+        self._start_jobs()
+        return position
+
+    def _start_jobs(self):
+        while True:
+            with self._cond:
+                if len(self._active) >= self.workers:
+                    return
+                job = self._next_job_locked()
+                if job is None:
+                    return
+            task = asyncio.ensure_future(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job):
+        start = time.monotonic()
+        try:
+            await job.fn(*job.args)
+        except Exception as e:
+            logger.error(f"Unhandled error in conversion job {job.task_id}: {e}")
+        finally:
+            with self._cond:
+                self._job_done_locked(job, time.monotonic() - start)
+            self._start_jobs()
+
+    async def shutdown(self, wait=True):
+        """Stop accepting jobs; with ``wait`` queued jobs still run, otherwise running ones are cancelled"""
+        with self._cond:
+            self._shutdown = True
+            if not wait:
+                self._queue.clear()
+        if not wait:
+            for task in self._tasks:
+                task.cancel()
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -3,13 +3,22 @@ from setuptools import setup
 setup(
     name="wav-maker",
     version="1.0.0",
-    py_modules=["app"],  # Explicitly list the app.py module
+    py_modules=["app", "archive", "asgi", "cache", "cli", "converter", "expiry", "job_queue", "metrics", "resumable", "scheduler", "task_store", "tracing"],  # Explicitly list the top-level modules
     include_package_data=True,
+    entry_points={
+        "console_scripts": ["wav-maker=cli:main"],
+    },
     install_requires=[
         "Flask>=2.2.0",
         "pydub>=0.25.1",
         "Werkzeug>=2.2.0",
         "gunicorn>=20.1.0",
     ],
+    extras_require={
+        # Optional in-process engine for PCM WAV input
+        "numpy": ["numpy>=1.22"],
+        # Server for the asyncio serving mode (asgi.py)
+        "asgi": ["uvicorn>=0.20"],
+    },
     python_requires=">=3.8",
 )
\ No newline at end of file
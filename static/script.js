@@ -13,9 +13,19 @@ document.addEventListener('DOMContentLoaded', function() {
     const cancelButton = document.getElementById('cancelButton');
     const reloadButton = document.getElementById('reloadButton');
     const reloadFooter = document.getElementById('reloadFooter');
+    const profileOptions = document.getElementById('profileOptions');
 
     let currentTaskId = null;
+    let currentBatchId = null;
     let statusCheckInterval = null;
+    let statusEvents = null;
+
+    // Files larger than this go up in resumable chunks instead of one request
+    const RESUMABLE_THRESHOLD = 32 * 1024 * 1024;
+    const CHUNK_SIZE = 8 * 1024 * 1024;
+    const PARALLEL_CHUNKS = 4;
+    const CHUNK_ATTEMPTS = 3;
+    const TUS_HEADERS = { 'Tus-Resumable': '1.0.0' };
 
     // Theme Management - Simplified for automatic system preference only
     function setTheme(theme) {
@@ -113,12 +123,10 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Clear task ID
         currentTaskId = null;
+        currentBatchId = null;
         
-        // Clear interval
-        if (statusCheckInterval) {
-            clearInterval(statusCheckInterval);
-            statusCheckInterval = null;
-        }
+        // Stop status updates
+        stopStatusUpdates();
         
         // Add a small animation to the drop area
         dropArea.classList.add('reset-animation');
@@ -128,10 +136,7 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     function cancelConversion() {
-        if (statusCheckInterval) {
-            clearInterval(statusCheckInterval);
-            statusCheckInterval = null;
-        }
+        stopStatusUpdates();
         resetUI();
     }
 
@@ -148,7 +153,24 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
-        const file = files[0];
+        for (const file of files) {
+            const problem = validateFile(file, files.length > 1);
+            if (problem) {
+                showError(files.length > 1 ? `${file.name}: ${problem}` : problem);
+                return;
+            }
+        }
+        
+        if (files.length > 1) {
+            uploadBatch(files);
+        } else {
+            uploadFile(files[0]);
+        }
+    }
+    
+    // Returns a message describing why the file can't be converted, or null.
+    // Single files can be as large as the server allows; batches are one request.
+    function validateFile(file, inBatch) {
         const validTypes = ['audio/mpeg', 'audio/wav', 'audio/x-wav', 'audio/mp3'];
         const fileExtension = file.name.split('.').pop().toLowerCase();
         const validExtensions = ['mp3', 'wav'];
@@ -166,25 +188,32 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         if (!isValid) {
-            showError("Only MP3 or WAV files are allowed.");
-            return;
+            return "Only MP3 or WAV files are allowed.";
         }
         
-        // File size check (100MB max)
-        if (file.size > 100 * 1024 * 1024) {
-            showError("File size exceeds 100MB limit.");
-            return;
+        // File size check (100MB max per batch file)
+        if (inBatch && file.size > 100 * 1024 * 1024) {
+            return "File size exceeds 100MB limit.";
         }
         
         // Check if file is not empty
         if (file.size === 0) {
-            showError("The file is empty.");
-            return;
+            return "The file is empty.";
         }
         
-        uploadFile(file);
+        return null;
     }
     
+    // The checked output profiles; the first is the primary download
+    function checkedProfiles() {
+        return Array.from(profileOptions.querySelectorAll('input[name="profiles"]:checked'),
+                          input => input.value);
+    }
+
+    function appendProfiles(formData) {
+        checkedProfiles().forEach(profile => formData.append('profiles', profile));
+    }
+
     function showError(message) {
         errorMessage.textContent = message;
         dropArea.style.display = 'none';
@@ -211,8 +240,19 @@ document.addEventListener('DOMContentLoaded', function() {
         progressBar.style.width = '0%';
         statusMessage.textContent = 'Uploading file...';
         
+        if (file.size > RESUMABLE_THRESHOLD) {
+            uploadResumable(file)
+                .then(watchConversion)
+                .catch(error => {
+                    console.error('Upload error:', error);
+                    showError(`Upload failed: ${error.message}`);
+                });
+            return;
+        }
+        
         const formData = new FormData();
         formData.append('audiofile', file);
+        appendProfiles(formData);
         
         fetch('/upload', {
             method: 'POST',
@@ -221,7 +261,7 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(response => {
             if (!response.ok) {
                 return response.json().then(data => {
-                    throw new Error(data.error || `HTTP error! Status: ${response.status}`);
+                    throw new Error(rejectionMessage(data, response.status));
                 });
             }
             return response.json();
@@ -231,12 +271,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 throw new Error(data.error);
             }
             if (data.task_id) {
-                currentTaskId = data.task_id;
-                statusMessage.textContent = 'Converting...';
-                progressBar.style.width = '10%';
-                
-                // Start checking status
-                checkConversionStatus();
+                watchConversion(data.task_id);
             } else {
                 throw new Error('No task ID returned from server');
             }
@@ -247,9 +282,344 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    function watchConversion(taskId) {
+        currentTaskId = taskId;
+        statusMessage.textContent = 'Converting...';
+        progressBar.style.width = '10%';
+        
+        // Start checking status
+        checkConversionStatus();
+    }
+
+    // Upload a large file in checksummed chunks, several at a time. The upload
+    // is remembered so choosing the same file again after a dropped connection
+    // or a reload only sends the chunks the server doesn't have yet.
+    // Resolves with the task ID once the last chunk has landed.
+    async function uploadResumable(file) {
+        const upload = await findResumableUpload(file) || await createResumableUpload(file);
+        const pending = [];
+        for (let start = 0; start < file.size; start += CHUNK_SIZE) {
+            const end = Math.min(start + CHUNK_SIZE, file.size);
+            if (!upload.ranges.some(([from, to]) => from <= start && end <= to)) {
+                pending.push([start, end]);
+            }
+        }
+        
+        let sent = file.size - pending.reduce((total, [start, end]) => total + end - start, 0);
+        const sendNext = async () => {
+            while (pending.length) {
+                const [start, end] = pending.shift();
+                await sendChunk(upload.url, file, start, end);
+                sent += end - start;
+                const percent = Math.round(sent / file.size * 100);
+                progressBar.style.width = `${percent}%`;
+                statusMessage.textContent = `Uploading file... ${percent}%`;
+            }
+        };
+        await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, sendNext));
+        localStorage.removeItem(resumeKey(file));
+        return upload.url.split('/').pop();
+    }
+
+    function resumeKey(file) {
+        return `upload:${file.name}:${file.size}:${file.lastModified}`;
+    }
+
+    async function findResumableUpload(file) {
+        const url = localStorage.getItem(resumeKey(file));
+        if (!url) return null;
+        const response = await fetch(url, { method: 'HEAD', headers: TUS_HEADERS });
+        if (!response.ok) {
+            localStorage.removeItem(resumeKey(file));
+            return null;
+        }
+        return { url, ranges: parseRanges(response.headers.get('Upload-Ranges')) };
+    }
+
+    async function createResumableUpload(file) {
+        const metadata = [`filename ${encodeBase64(file.name)}`];
+        const profiles = checkedProfiles();
+        if (profiles.length) {
+            metadata.push(`profiles ${encodeBase64(profiles.join(','))}`);
+        }
+        const response = await fetch('/uploads', {
+            method: 'POST',
+            headers: { ...TUS_HEADERS, 'Upload-Length': String(file.size),
+                       'Upload-Metadata': metadata.join(',') }
+        });
+        if (!response.ok) {
+            throw await responseError(response);
+        }
+        const url = response.headers.get('Location');
+        localStorage.setItem(resumeKey(file), url);
+        return { url, ranges: [] };
+    }
+
+    // Send one chunk, retrying network failures, server errors and checksum mismatches
+    async function sendChunk(url, file, start, end) {
+        const data = await file.slice(start, end).arrayBuffer();
+        const headers = { ...TUS_HEADERS, 'Upload-Offset': String(start),
+                          'Content-Type': 'application/offset+octet-stream' };
+        if (window.crypto && crypto.subtle) {
+            const digest = await crypto.subtle.digest('SHA-256', data);
+            headers['Upload-Checksum'] = `sha256 ${encodeBase64(new Uint8Array(digest))}`;
+        }
+        
+        for (let attempt = 1; ; attempt++) {
+            let response;
+            try {
+                response = await fetch(url, { method: 'PATCH', headers, body: data });
+            } catch (error) {
+                if (attempt >= CHUNK_ATTEMPTS) throw error;
+                await new Promise(resolve => setTimeout(resolve, attempt * 1000));
+                continue;
+            }
+            if (response.ok) return;
+            const retryable = response.status === 460 || response.status >= 500;
+            if (!retryable || attempt >= CHUNK_ATTEMPTS) {
+                throw await responseError(response);
+            }
+            await new Promise(resolve => setTimeout(resolve, attempt * 1000));
+        }
+    }
+
+    async function responseError(response) {
+        const data = await response.json().catch(() => ({}));
+        return new Error(rejectionMessage(data, response.status));
+    }
+
+    // Rejected uploads say when to try again
+    function rejectionMessage(data, status) {
+        const message = data.error || `HTTP error! Status: ${status}`;
+        return data.retry_after ? `${message} (try again in ${data.retry_after}s)` : message;
+    }
+
+    // Upload-Ranges lists inclusive start-end pairs; returns half-open [start, end) pairs
+    function parseRanges(header) {
+        if (!header) return [];
+        return header.split(',').map(range => {
+            const [start, end] = range.split('-').map(Number);
+            return [start, end + 1];
+        });
+    }
+
+    // Base64 of a string (as UTF-8) or of a byte array
+    function encodeBase64(value) {
+        const bytes = typeof value === 'string' ? new TextEncoder().encode(value) : value;
+        return btoa(String.fromCharCode(...bytes));
+    }
+
+    function uploadBatch(files) {
+        dropArea.style.display = 'none';
+        errorContainer.style.display = 'none';
+        downloadContainer.style.display = 'none';
+        conversionStatus.style.display = 'block';
+        progressBar.style.width = '0%';
+        statusMessage.textContent = `Uploading ${files.length} files...`;
+        
+        const formData = new FormData();
+        for (const file of files) {
+            formData.append('audiofiles', file);
+        }
+        appendProfiles(formData);
+        
+        fetch('/upload/batch', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => {
+            if (!response.ok) {
+                return response.json().then(data => {
+                    throw new Error(rejectionMessage(data, response.status));
+                });
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (!data.batch_id) {
+                throw new Error('No batch ID returned from server');
+            }
+            currentBatchId = data.batch_id;
+            statusMessage.textContent = `Converting ${files.length} files...`;
+            pollBatchStatus();
+        })
+        .catch(error => {
+            console.error('Upload error:', error);
+            showError(`Upload failed: ${error.message}`);
+        });
+    }
+
+    function handleBatchUpdate(data) {
+        if (data.status === 'unknown') {
+            stopStatusUpdates();
+            showError('Conversion batch not found');
+            return;
+        }
+        
+        progressBar.style.width = `${data.progress || 0}%`;
+        
+        if (data.status === 'processing') {
+            statusMessage.textContent = `Converting... ${data.completed + data.failed} of ${data.total} files done`;
+            return;
+        }
+        
+        stopStatusUpdates();
+        if (data.completed === 0) {
+            showError('Conversion failed for every file in the batch');
+            return;
+        }
+        
+        conversionStatus.style.display = 'none';
+        downloadContainer.style.display = 'block';
+        downloadLink.href = `/download/batch/${currentBatchId}`;
+        
+        const failures = data.tasks.filter(task => task.status !== 'complete');
+        fileInfo.innerHTML = `<p><strong>Converted:</strong> ${data.completed} of ${data.total} files (ZIP download)</p>`;
+        for (const task of failures) {
+            const p = document.createElement('p');
+            p.textContent = `${task.original_filename}: ${task.error || 'conversion failed'}`;
+            fileInfo.appendChild(p);
+        }
+    }
+
+    function pollBatchStatus() {
+        if (!currentBatchId) return;
+        
+        statusCheckInterval = setInterval(() => {
+            fetch(`/status/batch/${currentBatchId}`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! Status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(handleBatchUpdate)
+                .catch(error => {
+                    console.error('Status check error:', error);
+                    stopStatusUpdates();
+                    showError(`Error checking status: ${error.message}`);
+                });
+        }, 1000);
+    }
+
+    function stopStatusUpdates() {
+        if (statusCheckInterval) {
+            clearInterval(statusCheckInterval);
+            statusCheckInterval = null;
+        }
+        if (statusEvents) {
+            statusEvents.close();
+            statusEvents = null;
+        }
+    }
+
+    function handleStatusUpdate(data) {
+        if (data.status === 'unknown') {
+            stopStatusUpdates();
+            showError('Conversion task not found');
+            return;
+        }
+        
+        if (data.status === 'error') {
+            stopStatusUpdates();
+            showError(`Conversion failed: ${data.error || 'Unknown error'}`);
+            return;
+        }
+        
+        if (data.status === 'queued') {
+            if (data.deferred) {
+                statusMessage.textContent = 'Waiting for your other conversions to finish...';
+            } else {
+                statusMessage.textContent = data.position
+                    ? `Waiting in queue (position ${data.position})...`
+                    : 'Waiting in queue...';
+            }
+        }
+        
+        if (data.status === 'processing') {
+            progressBar.style.width = `${data.progress || 0}%`;
+            let message = `Converting... ${data.progress || 0}%`;
+            if (data.eta_seconds !== undefined) {
+                message += ` (about ${Math.max(1, Math.ceil(data.eta_seconds))}s left)`;
+            }
+            statusMessage.textContent = message;
+        }
+        
+        if (data.status === 'complete') {
+            stopStatusUpdates();
+            progressBar.style.width = '100%';
+            
+            // Show download option
+            conversionStatus.style.display = 'none';
+            downloadContainer.style.display = 'block';
+            
+            // Set download link
+            downloadLink.href = `/download/${currentTaskId}`;
+            
+            // Show file info
+            const originalFormat = data.original_format || {};
+            fileInfo.innerHTML = `
+                <p><strong>Filename:</strong> ${data.filename || 'converted_audio.wav'}</p>
+                <p><strong>Original:</strong> ${formatFileSize(data.original_size)} - 
+                    ${originalFormat.channels || '?'} channel(s), 
+                    ${originalFormat.sample_rate || '?'} Hz, 
+                    ${originalFormat.bit_depth || '?'} bit</p>
+                <p><strong>Converted:</strong> ${formatFileSize(data.converted_size)}</p>
+            `;
+            if (data.fast_path) {
+                const note = document.createElement('p');
+                note.textContent = data.fast_path === 'unchanged'
+                    ? 'Already in the target format - no conversion needed.'
+                    : 'Already in the target format - only the WAV header was rewritten.';
+                fileInfo.appendChild(note);
+            }
+            
+            // Link any other profiles converted alongside the primary one
+            const outputs = data.outputs || {};
+            for (const [profile, output] of Object.entries(outputs)) {
+                if (profile === data.profile) continue;
+                const p = document.createElement('p');
+                const link = document.createElement('a');
+                link.href = `/download/${currentTaskId}?profile=${encodeURIComponent(profile)}`;
+                link.textContent = output.filename;
+                p.appendChild(link);
+                p.append(` (${formatFileSize(output.converted_size)})`);
+                fileInfo.appendChild(p);
+            }
+            
+            // Add a click event to the download link to track successful downloads
+            downloadLink.addEventListener('click', function() {
+                // Optional: Track successful downloads or analytics here
+                console.log('Download initiated for task:', currentTaskId);
+            }, { once: true });
+        }
+    }
+
     function checkConversionStatus() {
         if (!currentTaskId) return;
         
+        // Prefer pushed updates; fall back to polling if the stream isn't available
+        if (!window.EventSource) {
+            pollConversionStatus();
+            return;
+        }
+        
+        statusEvents = new EventSource(`/status/${currentTaskId}/events`);
+        statusEvents.addEventListener('status', event => {
+            handleStatusUpdate(JSON.parse(event.data));
+        });
+        statusEvents.onerror = () => {
+            // The browser reconnects on its own unless the server refused the stream
+            if (statusEvents && statusEvents.readyState === EventSource.CLOSED) {
+                statusEvents = null;
+                pollConversionStatus();
+            }
+        };
+    }
+
+    function pollConversionStatus() {
+        if (!currentTaskId) return;
+        
         // Check status every 1 second
         statusCheckInterval = setInterval(() => {
             fetch(`/status/${currentTaskId}`)
@@ -259,57 +629,10 @@ document.addEventListener('DOMContentLoaded', function() {
                     }
                     return response.json();
                 })
-                .then(data => {
-                    if (data.status === 'unknown') {
-                        clearInterval(statusCheckInterval);
-                        showError('Conversion task not found');
-                        return;
-                    }
-                    
-                    if (data.status === 'error') {
-                        clearInterval(statusCheckInterval);
-                        showError(`Conversion failed: ${data.error || 'Unknown error'}`);
-                        return;
-                    }
-                    
-                    if (data.status === 'processing') {
-                        progressBar.style.width = `${data.progress || 0}%`;
-                        statusMessage.textContent = `Converting... ${data.progress || 0}%`;
-                    }
-                    
-                    if (data.status === 'complete') {
-                        clearInterval(statusCheckInterval);
-                        progressBar.style.width = '100%';
-                        
-                        // Show download option
-                        conversionStatus.style.display = 'none';
-                        downloadContainer.style.display = 'block';
-                        
-                        // Set download link
-                        downloadLink.href = `/download/${currentTaskId}`;
-                        
-                        // Show file info
-                        const originalFormat = data.original_format || {};
-                        fileInfo.innerHTML = `
-                            <p><strong>Filename:</strong> ${data.filename || 'converted_audio.wav'}</p>
-                            <p><strong>Original:</strong> ${formatFileSize(data.original_size)} - 
-                                ${originalFormat.channels || '?'} channel(s), 
-                                ${originalFormat.sample_rate || '?'} Hz, 
-                                ${originalFormat.bit_depth || '?'} bit</p>
-                            <p><strong>Converted:</strong> ${formatFileSize(data.converted_size)} - 
-                                1 channel, 8000 Hz, 16 bit</p>
-                        `;
-                        
-                        // Add a click event to the download link to track successful downloads
-                        downloadLink.addEventListener('click', function() {
-                            // Optional: Track successful downloads or analytics here
-                            console.log('Download initiated for task:', currentTaskId);
-                        }, { once: true });
-                    }
-                })
+                .then(handleStatusUpdate)
                 .catch(error => {
                     console.error('Status check error:', error);
-                    clearInterval(statusCheckInterval);
+                    stopStatusUpdates();
                     showError(`Error checking status: ${error.message}`);
                 });
         }, 1000);
@@ -0,0 +1,350 @@
+"""
+Task store backends for conversion task state.
+
+Every backend exposes the same small interface so ``app.py`` can keep its
+``get_tasks``/``save_task``/``delete_task`` helpers and switch storage with the
+``TASK_STORE_BACKEND`` setting:
+
+* ``sqlite`` - one row per task in a WAL-mode SQLite database. Reads and writes
+  touch a single row, and ``update`` runs inside ``BEGIN IMMEDIATE`` so a
+  read-modify-write is atomic across threads and processes.
+* ``json`` - the original single JSON file. Kept for compatibility; every
+  operation parses and rewrites the whole file, but writes now hold an
+  exclusive lock for the entire read-modify-write.
+"""
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def lock_wait(backend):
+    """Time waiting for the store's lock, for metrics and the current task's trace"""
+    return metrics.timed(metrics.STORE_LOCK_WAIT_SECONDS.labels(backend), 'store.lock_wait')
+
+
+class TaskStore:
+    """Interface shared by all task store backends"""
+
+    def get(self, task_id):
+        """Return the task dict for ``task_id`` or ``None``"""
+        raise NotImplementedError
+
+    def all(self):
+        """Return a dict of every stored task keyed by task ID"""
+        raise NotImplementedError
+
+    def put(self, task_id, task_data):
+        """Replace the stored data for ``task_id``"""
+        raise NotImplementedError
+
+    def update(self, task_id, fn):
+        """Atomically apply ``fn`` to the current task data.
+
+        ``fn`` receives the current dict (or ``None``) and returns the new dict,
+        or ``None`` to delete the task. The new value is returned.
+        """
+        raise NotImplementedError
+
+    def delete(self, task_id):
+        """Remove ``task_id`` if present"""
+        self.delete_many([task_id])
+
+    def delete_many(self, task_ids, where=None):
+        """Remove several tasks in one operation
+
+        With ``where``, a task is only removed if ``where(task_data)`` is true
+        when checked inside that operation. Returns a dict of the tasks kept.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the store"""
+
+
+class JsonFileTaskStore(TaskStore):
+    """All tasks in one JSON file, guarded by ``flock``"""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                json.dump({}, f)
+            try:
+                os.chmod(path, 0o666)  # Make writable by all users
+            except OSError:
+                pass
+            logger.info(f"Created tasks file: {path}")
+
+    def _load(self, f):
+        f.seek(0)
+        content = f.read()
+        if not content.strip():
+            return {}
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            logger.error("Invalid JSON in tasks file, resetting")
+            return {}
+
+    def _rewrite(self, fn):
+        # Open without truncating and hold the exclusive lock for the whole
+        # read-modify-write so concurrent writers can't lose each other's updates
+        with open(self.path, 'a+') as f:
+            with lock_wait('json'):
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                tasks = self._load(f)
+                result = fn(tasks)
+                f.seek(0)
+                f.truncate()
+                json.dump(tasks, f)
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def all(self):
+        try:
+            with open(self.path, 'r') as f:
+                with lock_wait('json'):
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                try:
+                    return self._load(f)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, task_id):
+        return self.all().get(task_id)
+
+    def put(self, task_id, task_data):
+        def apply(tasks):
+            tasks[task_id] = task_data
+        self._rewrite(apply)
+
+    def update(self, task_id, fn):
+        def apply(tasks):
+            new_data = fn(tasks.get(task_id))
+            if new_data is None:
+                tasks.pop(task_id, None)
+            else:
+                tasks[task_id] = new_data
+            return new_data
+        return self._rewrite(apply)
+
+    def delete_many(self, task_ids, where=None):
+        def apply(tasks):
+            kept = {}
+            for task_id in task_ids:
+                task_data = tasks.get(task_id)
+                if task_data is not None and where is not None and not where(task_data):
+                    kept[task_id] = task_data
+                else:
+                    tasks.pop(task_id, None)
+            return kept
+        return self._rewrite(apply)
+
+
+class SqliteTaskStore(TaskStore):
+    """One row per task in a WAL-mode SQLite database"""
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " task_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated REAL NOT NULL)"
+        )
+
+    def _conn(self):
+        # SQLite connections can't be shared across threads or forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, task_id):
+        row = self._conn().execute(
+            "SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all(self):
+        rows = self._conn().execute("SELECT task_id, data FROM tasks").fetchall()
+        return {task_id: json.loads(data) for task_id, data in rows}
+
+    def put(self, task_id, task_data):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO tasks (task_id, data, updated) VALUES (?, ?, ?)",
+            (task_id, json.dumps(task_data), time.time()))
+
+    def update(self, task_id, fn):
+        conn = self._conn()
+        with lock_wait('sqlite'):
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            new_data = fn(json.loads(row[0]) if row else None)
+            if new_data is None:
+                conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tasks (task_id, data, updated) VALUES (?, ?, ?)",
+                    (task_id, json.dumps(new_data), time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return new_data
+
+    def delete_many(self, task_ids, where=None):
+        task_ids = list(task_ids)
+        kept = {}
+        if not task_ids:
+            return kept
+        conn = self._conn()
+        with lock_wait('sqlite'):
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            if where is not None:
+                for task_id in task_ids:
+                    row = conn.execute(
+                        "SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+                    task_data = json.loads(row[0]) if row else None
+                    if task_data is not None and not where(task_data):
+                        kept[task_id] = task_data
+            conn.executemany("DELETE FROM tasks WHERE task_id = ?",
+                             [(task_id,) for task_id in task_ids if task_id not in kept])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return kept
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class ProgressTracker:
+    """Keeps the latest progress of running tasks in memory.
+
+    Progress can change many times a second; ``update`` records every change
+    in memory but only passes one per ``flush_interval`` seconds per task to
+    ``save`` (usually a task store write). Status readers in the same process
+    see the live value via ``get``.
+    """
+
+    def __init__(self, save, flush_interval=2.0):
+        self.save = save
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._last_flush = {}
+
+    def update(self, task_id, task_data):
+        """Record progress for task_id, writing it through if a flush is due"""
+        now = time.monotonic()
+        with self._lock:
+            self._latest[task_id] = task_data
+            due = now - self._last_flush.get(task_id, float('-inf')) >= self.flush_interval
+            if due:
+                self._last_flush[task_id] = now
+        if due:
+            self.save(task_id, task_data)
+
+    def get(self, task_id):
+        """Return the latest in-memory progress for task_id, or None"""
+        with self._lock:
+            task_data = self._latest.get(task_id)
+            return dict(task_data) if task_data is not None else None
+
+    def clear(self, task_id):
+        """Forget a task once it has finished"""
+        with self._lock:
+            self._latest.pop(task_id, None)
+            self._last_flush.pop(task_id, None)
+
+
+class TaskNotifier:
+    """Wakes threads in this process that are waiting for a task to change.
+
+    Each task has a change counter. Waiters pass in the counter they last saw,
+    so a change between reading the task and starting to wait isn't missed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._conditions = {}
+        self._waiters = {}
+
+    def version(self, task_id):
+        """Return the current change counter for task_id"""
+        with self._lock:
+            return self._versions.get(task_id, 0)
+
+    def notify(self, task_id):
+        """Record a change to task_id and wake its waiters"""
+        with self._lock:
+            self._versions[task_id] = self._versions.get(task_id, 0) + 1
+            condition = self._conditions.get(task_id)
+            if condition is not None:
+                condition.notify_all()
+
+    def wait(self, task_id, seen, timeout):
+        """Block until task_id's counter differs from ``seen`` or timeout expires"""
+        with self._lock:
+            condition = self._conditions.get(task_id)
+            if condition is None:
+                condition = self._conditions[task_id] = threading.Condition(self._lock)
+            self._waiters[task_id] = self._waiters.get(task_id, 0) + 1
+            try:
+                return condition.wait_for(lambda: self._versions.get(task_id, 0) != seen, timeout)
+            finally:
+                self._waiters[task_id] -= 1
+                if not self._waiters[task_id]:
+                    del self._waiters[task_id]
+                    del self._conditions[task_id]
+
+    def forget(self, task_id):
+        """Drop bookkeeping for a deleted task, waking anyone still waiting"""
+        self.notify(task_id)
+        with self._lock:
+            if task_id not in self._waiters:
+                self._versions.pop(task_id, None)
+
+
+BACKENDS = {
+    'json': JsonFileTaskStore,
+    'sqlite': SqliteTaskStore,
+}
+
+
+def create_task_store(backend, path):
+    """Create a task store for the named backend"""
+    try:
+        store_class = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown task store backend: {backend}")
+    return store_class(path)
@@ -6,6 +6,9 @@ import pytest
 import shutil
 from unittest.mock import patch
 
+# Keep metrics in-process so test runs don't leave files in the shared metrics directory
+os.environ['METRICS_DIR'] = ''
+
 # Import the app and set the template folder before app initialization
 @pytest.fixture(autouse=True, scope="session")
 def setup_test_environment():
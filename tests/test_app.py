@@ -1,15 +1,25 @@
+import base64
+import errno
+import io
 import os
 import sys
+import wave
+import hashlib
+import threading
+import time
 import pytest
+import socket
 import tempfile
 import json
 from unittest.mock import patch, MagicMock, mock_open
+from werkzeug.wsgi import FileWrapper
 
 # Add the parent directory to the path so we can import the app
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Import app module but manually set template/static folder before creating test client
 import app
+import converter
 
 
 @pytest.fixture
@@ -21,6 +31,7 @@ def client():
     test_app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
     test_app.config['CONVERTED_FOLDER'] = tempfile.mkdtemp()
     test_app.config['TASKS_FILE'] = tempfile.mktemp()
+    test_app.config['TASK_DB'] = tempfile.mktemp(suffix='.db')
     
     # Override template and static folders
     test_dir = os.path.dirname(os.path.abspath(__file__))
@@ -38,6 +49,9 @@ def client():
     # Cleanup temporary directories and files
     try:
         os.unlink(test_app.config['TASKS_FILE'])
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(test_app.config['TASK_DB'] + suffix):
+                os.unlink(test_app.config['TASK_DB'] + suffix)
         os.rmdir(test_app.config['UPLOAD_FOLDER'])
         os.rmdir(test_app.config['CONVERTED_FOLDER'])
     except:
@@ -69,9 +83,10 @@ def test_upload_empty_filename(client):
     assert b'No selected file' in response.data
 
 
-@patch('app.threading.Thread')
-def test_upload_success(mock_thread, client):
-    """Test successful file upload starts conversion thread."""
+@patch('app.get_scheduler')
+def test_upload_success(mock_get_scheduler, client):
+    """Test successful file upload queues a conversion job."""
+    mock_get_scheduler.return_value.submit.return_value = 1
     # Mock the save_task function to avoid file operations
     with patch('app.save_task') as mock_save_task:
         # Create a small dummy audio file
@@ -87,11 +102,75 @@ def test_upload_success(mock_thread, client):
     
     assert response.status_code == 200
     assert 'task_id' in response.json
-    mock_thread.assert_called_once()
+    mock_get_scheduler.return_value.submit.assert_called_once()
     
-    # Verify the thread was started with the correct arguments
-    args, kwargs = mock_thread.call_args
-    assert kwargs.get('target') == app.convert_audio
+    # Verify the job was queued with the conversion function
+    args, kwargs = mock_get_scheduler.return_value.submit.call_args
+    assert args[0] == response.json['task_id']
+    assert args[1] == app.convert_audio
+
+
+@patch('app.get_scheduler')
+def test_upload_queue_full(mock_get_scheduler, client):
+    """Test uploads are rejected with 429 and Retry-After when the queue is full."""
+    mock_get_scheduler.return_value.submit.side_effect = app.QueueFull(retry_after=7)
+    
+    response = client.post(
+        '/upload',
+        data={'audiofile': (io.BytesIO(b'dummy audio content'), 'test_audio.mp3')}
+    )
+    
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '7'
+    assert os.listdir(app.app.config['UPLOAD_FOLDER']) == []
+    assert app.get_tasks() == {}
+
+
+@patch('app.get_scheduler')
+def test_upload_client_quota(mock_get_scheduler, client, monkeypatch):
+    """Test uploads are fair-queued by client and cost, and a client over quota gets 429."""
+    monkeypatch.setitem(app.app.config, 'CLIENT_ID_HEADER', 'X-Forwarded-For')
+    audio = io.BytesIO()
+    with wave.open(audio, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(44100)
+        wav.writeframes(b'\x00' * 4000)
+    
+    response = client.post('/upload', headers={'X-Forwarded-For': '203.0.113.9, 10.0.0.1'},
+                           data={'audiofile': (io.BytesIO(audio.getvalue()), 'prompt.wav')})
+    assert response.status_code == 200
+    _, kwargs = mock_get_scheduler.return_value.submit.call_args
+    assert kwargs == {'client': '203.0.113.9', 'cost': 2000}
+    
+    mock_get_scheduler.return_value.submit.side_effect = app.QuotaExceeded(12, 'client_jobs')
+    response = client.post('/upload', data={'audiofile': (io.BytesIO(audio.getvalue()), 'prompt.wav')})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '12'
+    assert response.json['reason'] == 'client_jobs'
+    assert 'too many conversions' in response.json['error']
+
+
+@patch('app.get_scheduler')
+def test_status_reports_deferred_job(mock_get_scheduler, client):
+    """Test a job waiting on its client's other conversions is reported as deferred."""
+    mock_get_scheduler.return_value.position.return_value = 1
+    mock_get_scheduler.return_value.deferred.return_value = True
+    app.save_task('queued-task', {'status': 'queued', 'position': 1, 'timestamp': 0})
+    
+    response = client.get('/status/queued-task')
+    assert response.json['deferred'] is True
+
+
+@patch('app.get_scheduler')
+def test_status_queued_reports_position(mock_get_scheduler, client):
+    """Test queued tasks report their live queue position."""
+    mock_get_scheduler.return_value.position.return_value = 3
+    app.save_task('queued-task', {'status': 'queued', 'position': 5, 'timestamp': 0})
+    
+    response = client.get('/status/queued-task')
+    assert response.json['status'] == 'queued'
+    assert response.json['position'] == 3
 
 
 def test_status_unknown(client):
@@ -139,7 +218,10 @@ def test_convert_audio(mock_audiosegment, mock_mediainfo, mock_getsize, mock_exi
         mock_tasks[task_id] = task_data
         return True
     
-    with patch('app.save_task', side_effect=mock_save_task_impl):
+    # The decode happens in the converter module, verification in app
+    with patch('app.save_task', side_effect=mock_save_task_impl), \
+            patch('converter.AudioSegment', mock_audiosegment), \
+            patch.dict(app.app.config, {'VERIFY_MODE': 'full', 'CONVERSION_ENGINE': 'pydub'}):
         # Test convert_audio function
         task_id = 'test-task-id'
         input_path = 'test_input.mp3'
@@ -169,4 +251,954 @@ def test_download_nonexistent(client):
     with patch('app.get_tasks', return_value={}):
         response = client.get('/download/nonexistent-task-id')
         assert response.status_code == 404
-        assert b'File not found or conversion not complete' in response.data
\ No newline at end of file
+        assert b'File not found or conversion not complete' in response.data
+
+@patch('app.get_scheduler')
+def test_streaming_ingest_queues_before_upload_completes(mock_get_scheduler, client):
+    """Test streaming ingest writes, hashes and hands the upload to the converter."""
+    mock_get_scheduler.return_value.submit.return_value = 1
+    content = b'RIFF' + os.urandom(200000)
+    
+    with patch.dict(app.app.config, {'STREAMING_INGEST': True}):
+        response = client.post(
+            '/upload',
+            data={'audiofile': (io.BytesIO(content), 'test_audio.wav')}
+        )
+    
+    assert response.status_code == 200
+    task_id = response.json['task_id']
+    args, kwargs = mock_get_scheduler.return_value.submit.call_args
+    assert args[:2] == (task_id, app.convert_audio)
+    temp_path, source = args[2], args[5]
+    
+    assert source.wait(timeout=1)
+    assert source.digest == hashlib.sha256(content).hexdigest()
+    with open(temp_path, 'rb') as f:
+        assert f.read() == content
+    os.remove(temp_path)
+
+
+@patch('app.mediainfo', return_value={'sample_rate': '8000', 'channels': '1', 'bits_per_sample': '16'})
+def test_convert_audio_from_growing_upload(mock_mediainfo, client, tmp_path):
+    """Test conversion runs while the upload is still being written."""
+    input_path = str(tmp_path / 'upload.raw')
+    source = converter.GrowingFile(input_path)
+    chunks = [os.urandom(32000) for _ in range(4)]
+    # Stands in for ffmpeg: copies raw PCM from stdin to stdout
+    passthrough = [sys.executable, '-c',
+                   'import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)']
+    
+    with patch('converter.pcm_command', return_value=passthrough):
+        with open(input_path, 'wb') as f:
+            worker = threading.Thread(target=app.convert_audio,
+                                      args=(input_path, str(tmp_path), 'stream-task', source))
+            worker.start()
+            size = 0
+            for chunk in chunks:
+                f.write(chunk)
+                f.flush()
+                size += len(chunk)
+                source.extend(size)
+            source.finish('digest')
+            worker.join(10)
+    
+    task = app.get_task('stream-task')
+    assert task['status'] == 'complete'
+    assert task['input_sha256'] == 'digest'
+    with wave.open(task['output_path'], 'rb') as wav:
+        assert wav.readframes(wav.getnframes()) == b''.join(chunks)
+
+
+def fake_multi_output_ffmpeg(input_path, profile, extra_outputs):
+    """Stands in for ffmpeg: 2s of audio on stdout plus a WAV per extra profile"""
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = (
+        "import os, sys\n"
+        f"sys.path.insert(0, {repo_dir!r})\n"
+        "import converter\n"
+        f"for name, path in {list(extra_outputs)!r}:\n"
+        "    settings = converter.PROFILES[name]\n"
+        "    size = 2 * settings['sample_rate'] * settings['sample_width']\n"
+        "    with open(path, 'wb') as f:\n"
+        "        f.write(converter.wav_header(name, size) + os.urandom(size))\n"
+        f"size = 2 * converter.PROFILES[{profile!r}]['sample_rate'] * converter.PROFILES[{profile!r}]['sample_width']\n"
+        "sys.stdout.buffer.write(os.urandom(size))\n"
+    )
+    return [sys.executable, '-c', script]
+
+
+@patch('app.mediainfo', return_value={'sample_rate': '44100', 'channels': '2', 'duration': '2.0'})
+def test_convert_audio_multiple_profiles(mock_mediainfo, client, tmp_path, monkeypatch):
+    """Test one conversion job produces every requested profile, each downloadable."""
+    input_path = str(tmp_path / 'prompt.mp3')
+    with open(input_path, 'wb') as f:
+        f.write(os.urandom(4000))
+    monkeypatch.setitem(app.app.config, 'CONVERSION_ENGINE', 'stream')
+    
+    with patch('converter.pcm_command', side_effect=fake_multi_output_ffmpeg) as mock_command:
+        app.convert_audio(input_path, app.app.config['CONVERTED_FOLDER'], 'multi-task',
+                          profiles=['pcm16k', 'ulaw8k', 'alaw8k'])
+    
+    # A single decoder run writes every profile
+    mock_command.assert_called_once()
+    task = app.get_task('multi-task')
+    assert task['status'] == 'complete', task.get('error')
+    assert task['profile'] == 'pcm16k'
+    assert set(task['outputs']) == {'pcm16k', 'ulaw8k', 'alaw8k'}
+    assert task['filename'] == 'prompt_mono_16khz_16bit.wav'
+    
+    header = converter.read_wav_header(task['outputs']['ulaw8k']['output_path'])
+    assert (header['format_tag'], header['sample_rate'], header['data_size']) == (7, 8000, 16000)
+    
+    response = client.get('/download/multi-task?profile=alaw8k')
+    assert response.status_code == 200
+    assert 'prompt_mono_8khz_alaw.wav' in response.headers['Content-Disposition']
+    response.close()
+    assert client.get('/download/multi-task?profile=pcm8k').status_code == 404
+
+
+
+@patch('app.mediainfo', return_value={'sample_rate': '44100', 'channels': '2', 'duration': '1200.0'})
+def test_convert_audio_segments_long_input(mock_mediainfo, client, tmp_path, monkeypatch):
+    """Test inputs over SEGMENTED_MIN_DURATION are converted in SEGMENT_WORKERS segments."""
+    input_path = str(tmp_path / 'lecture.mp3')
+    with open(input_path, 'wb') as f:
+        f.write(os.urandom(4000))
+    monkeypatch.setitem(app.app.config, 'CONVERSION_ENGINE', 'stream')
+    monkeypatch.setitem(app.app.config, 'SEGMENT_WORKERS', 4)
+    
+    def fake_segmented(input_path, output_path, duration, segments, progress=None, **kwargs):
+        with open(output_path, 'wb') as f:
+            f.write(converter.wav_header(converter.DEFAULT_PROFILE, 16000) + bytes(16000))
+        return 8000
+    
+    with patch('converter.transcode_segmented', side_effect=fake_segmented) as mock_segmented, \
+            patch('converter.transcode_streaming') as mock_streaming:
+        app.convert_audio(input_path, app.app.config['CONVERTED_FOLDER'], 'long-task')
+        monkeypatch.setitem(app.app.config, 'SEGMENTED_MIN_DURATION', 3600)
+        assert app.conversion_segments(1200.0) == 1
+    
+    assert mock_segmented.call_args[0][2:] == (1200.0, 4)
+    mock_streaming.assert_not_called()
+    assert app.get_task('long-task')['status'] == 'complete'
+
+
+@pytest.mark.skipif(converter.np is None, reason="NumPy is not installed")
+def test_convert_audio_pcm_wav_uses_numpy_engine(client, tmp_path):
+    """Test PCM WAV input is converted in-process without ffprobe or ffmpeg."""
+    input_path = str(tmp_path / 'prompt.wav')
+    with wave.open(input_path, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(os.urandom(16000 * 4))
+    
+    with patch('app.mediainfo') as mock_mediainfo, patch('converter.pcm_command') as mock_command:
+        app.convert_audio(input_path, app.app.config['CONVERTED_FOLDER'], 'numpy-task',
+                          profiles=['pcm8k', 'pcm16k'])
+    
+    mock_mediainfo.assert_not_called()
+    mock_command.assert_not_called()
+    task = app.get_task('numpy-task')
+    assert task['status'] == 'complete', task.get('error')
+    assert task['original_format'] == {'channels': 2, 'sample_rate': 16000, 'bit_depth': 16}
+    with wave.open(task['output_path'], 'rb') as wav:
+        assert (wav.getframerate(), wav.getnframes()) == (8000, 8000)
+    with wave.open(task['outputs']['pcm16k']['output_path'], 'rb') as wav:
+        assert (wav.getframerate(), wav.getnframes()) == (16000, 16000)
+
+
+def test_late_progress_does_not_reopen_finished_task(client):
+    """Test a progress update arriving after the task finished leaves it finished."""
+    app.save_task('late-task', {'status': 'processing', 'progress': 0, 'timestamp': 0})
+    app.save_task('late-task', {'status': 'complete', 'progress': 100, 'timestamp': 1})
+    app.report_progress('late-task', 60)
+    assert app.get_task('late-task')['status'] == 'complete'
+    assert app.current_status('late-task')['status'] == 'complete'
+    app.get_progress_tracker().clear('late-task')
+    
+    # A task that's gone isn't recreated either
+    app.report_progress('gone-task', 60)
+    assert app.get_task('gone-task') is None
+    app.get_progress_tracker().clear('gone-task')
+
+
+@pytest.mark.skipif(converter.np is None, reason="NumPy is not installed")
+def test_convert_audio_publishes_only_while_leased(client, tmp_path):
+    """Test a conversion whose lease was lost leaves the outputs and task to its successor."""
+    input_path = str(tmp_path / 'prompt.wav')
+    with wave.open(input_path, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(os.urandom(16000 * 4))
+    output_dir = app.app.config['CONVERTED_FOLDER']
+    
+    assert app.convert_audio(input_path, output_dir, 'lost-task', lease=lambda: False) is None
+    assert app.get_task('lost-task')['status'] == 'processing'
+    assert not [name for name in os.listdir(output_dir) if name.startswith('lost-task')]
+    
+    output_path = app.convert_audio(input_path, output_dir, 'held-task', lease=lambda: True)
+    assert app.get_task('held-task')['output_path'] == output_path
+    assert [name for name in os.listdir(output_dir) if name.startswith('held-task')] == [
+        os.path.basename(output_path)]
+
+
+@pytest.mark.parametrize('extra_chunk, fast_path', [
+    (b'', 'unchanged'),
+    (b'LIST' + (4).to_bytes(4, 'little') + b'INFO', 'header_rewritten'),
+])
+def test_convert_audio_skips_compliant_input(client, tmp_path, monkeypatch, extra_chunk, fast_path):
+    """Test input already in the target format completes without converting."""
+    input_path = str(tmp_path / 'prompt.wav')
+    with wave.open(input_path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(os.urandom(16000))
+    with open(input_path, 'rb') as f:
+        canonical = f.read()
+    with open(input_path, 'wb') as f:
+        f.write(canonical[:36] + extra_chunk + canonical[36:])
+    # Full verification would reject an output identical to its input
+    monkeypatch.setitem(app.app.config, 'VERIFY_MODE', 'full')
+    
+    with patch('app.mediainfo') as mock_mediainfo, patch('converter.pcm_command') as mock_command, \
+            patch('converter.transcode_numpy') as mock_numpy:
+        app.convert_audio(input_path, app.app.config['CONVERTED_FOLDER'], 'compliant-task')
+    
+    mock_mediainfo.assert_not_called()
+    mock_command.assert_not_called()
+    mock_numpy.assert_not_called()
+    task = app.get_task('compliant-task')
+    assert task['status'] == 'complete', task.get('error')
+    assert task['fast_path'] == fast_path
+    assert task['original_format'] == {'channels': 1, 'sample_rate': 8000, 'bit_depth': 16}
+    with open(task['output_path'], 'rb') as f:
+        assert f.read() == canonical
+
+
+def test_upload_unknown_profile(client):
+    """Test uploads naming an unknown output profile are rejected."""
+    response = client.post('/upload', data={
+        'audiofile': (io.BytesIO(b'dummy audio content'), 'test_audio.mp3'),
+        'profiles': 'pcm8k,gsm'
+    })
+    assert response.status_code == 400
+    assert b'Unknown output profile: gsm' in response.data
+
+
+@patch('app.get_scheduler')
+def test_upload_cache_hit_completes_immediately(mock_get_scheduler, client, tmp_path):
+    """Test a repeat upload is served from the conversion cache without converting."""
+    content = b'dummy audio content'
+    cached_wav = tmp_path / 'cached.wav'
+    cached_wav.write_bytes(b'RIFF converted')
+    metadata = {'original_format': {'channels': 2, 'sample_rate': 44100, 'bit_depth': 16}}
+    app.get_cache().store(app.cache_key(hashlib.sha256(content).hexdigest()),
+                          str(cached_wav), metadata)
+    
+    response = client.post(
+        '/upload',
+        data={'audiofile': (io.BytesIO(content), 'hold_music.mp3')}
+    )
+    
+    assert response.status_code == 200
+    mock_get_scheduler.return_value.submit.assert_not_called()
+    
+    status = client.get(f"/status/{response.json['task_id']}").json
+    assert status['status'] == 'complete'
+    assert status['cached'] is True
+    assert status['original_format'] == metadata['original_format']
+    with open(status['output_path'], 'rb') as f:
+        assert f.read() == b'RIFF converted'
+    
+    assert client.get('/cache/stats').json['hits'] == 1
+
+
+def test_verify_output_header_mode(client, tmp_path):
+    """Test header verification checks format and frame count without decoding."""
+    output_path = str(tmp_path / 'out.wav')
+    with wave.open(output_path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\x00\x01' * 8000)
+    original_format = {'channels': 2, 'sample_rate': 44100, 'sample_width': 2}
+    output_size = os.path.getsize(output_path)
+    
+    with patch.dict(app.app.config, {'VERIFY_MODE': 'header'}), \
+            patch('app.AudioSegment') as mock_audiosegment, \
+            patch('app.get_file_md5') as mock_md5:
+        app.verify_output('in.mp3', output_path, 50000, output_size, original_format,
+                          expected_frames=8000, exact=True)
+        mock_audiosegment.from_file.assert_not_called()
+        mock_md5.assert_not_called()
+        
+        with pytest.raises(Exception, match='expected 9000'):
+            app.verify_output('in.mp3', output_path, 50000, output_size, original_format,
+                              expected_frames=9000, exact=True)
+        
+        # Truncate the data chunk
+        with open(output_path, 'r+b') as f:
+            f.truncate(output_size - 100)
+        with pytest.raises(Exception, match='truncated'):
+            app.verify_output('in.mp3', output_path, 50000, output_size - 100, original_format)
+
+
+def test_status_reports_live_progress(client):
+    """Test /status returns in-memory progress with ETA between store flushes."""
+    app.save_task('live-task', {'status': 'processing', 'progress': 10, 'timestamp': 0})
+    progress = app.stream_progress('live-task', duration=10.0)
+    
+    # Half of the audio converted: 5 seconds of 8kHz 16-bit mono
+    with patch.object(app.get_progress_tracker(), 'flush_interval', 3600):
+        progress(5 * 8000 * 2)
+        status = client.get('/status/live-task').json
+        app.get_progress_tracker().clear('live-task')
+    
+    assert status['status'] == 'processing'
+    assert status['progress'] == 52
+    assert status['bytes_processed'] == 80000
+    assert status['processed_seconds'] == 5.0
+    assert status['duration'] == 10.0
+    assert 'eta_seconds' in status
+
+
+def test_status_long_poll(client):
+    """Test ?since= holds the request until the task changes."""
+    app.save_task('poll-task', {'status': 'processing', 'progress': 10, 'timestamp': 0})
+    first = client.get('/status/poll-task').json
+    
+    # Unchanged status: returns after the wait expires with the same version
+    same = client.get(f"/status/poll-task?since={first['version']}&wait=0.2").json
+    assert same['version'] == first['version']
+    
+    def finish():
+        time.sleep(0.2)
+        app.save_task('poll-task', {'status': 'complete', 'progress': 100, 'timestamp': 1})
+    
+    threading.Thread(target=finish).start()
+    started = time.monotonic()
+    changed = client.get(f"/status/poll-task?since={first['version']}&wait=10").json
+    assert changed['status'] == 'complete'
+    assert changed['version'] != first['version']
+    assert time.monotonic() - started < 5
+
+
+def test_status_events_stream(client):
+    """Test the SSE endpoint pushes each change and ends at a final status."""
+    app.save_task('sse-task', {'status': 'queued', 'position': 1, 'timestamp': 0})
+    
+    with patch('app.get_scheduler') as mock_get_scheduler:
+        mock_get_scheduler.return_value.position.return_value = None
+        response = client.get('/status/sse-task/events', buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        events = iter(response.response)
+        
+        first = next(events).decode()
+        assert 'event: status' in first
+        assert '"status": "queued"' in first
+        
+        app.save_task('sse-task', {'status': 'complete', 'progress': 100, 'timestamp': 1})
+        second = next(events).decode()
+        assert '"status": "complete"' in second
+        
+        with pytest.raises(StopIteration):
+            next(events)
+    response.close()
+
+
+def test_status_events_slot_freed_when_closed_unread(client, monkeypatch):
+    """Test a status stream closed before it starts doesn't keep its slot."""
+    monkeypatch.setattr(app, '_status_waiters', threading.BoundedSemaphore(1))
+    app.save_task('sse-task', {'status': 'queued', 'position': 1, 'timestamp': 0})
+    
+    for _ in range(2):
+        with app.app.test_request_context('/status/sse-task/events'):
+            response = app.status_events('sse-task')
+            assert response.status_code == 200
+            response.close()
+
+
+@patch('app.get_scheduler')
+def test_batch_upload_queues_each_file(mock_get_scheduler, client):
+    """Test a batch upload creates one queued task per file."""
+    mock_get_scheduler.return_value.free_slots.return_value = 10
+    mock_get_scheduler.return_value.submit.return_value = 1
+    mock_get_scheduler.return_value.position.return_value = 1
+    
+    response = client.post('/upload/batch', data={'audiofiles': [
+        (io.BytesIO(b'first audio'), 'one.mp3'),
+        (io.BytesIO(b'second audio'), 'two.mp3'),
+        (io.BytesIO(b'third audio'), 'three.mp3'),
+    ]})
+    
+    assert response.status_code == 200
+    tasks = response.json['tasks']
+    assert [task['filename'] for task in tasks] == ['one.mp3', 'two.mp3', 'three.mp3']
+    assert mock_get_scheduler.return_value.submit.call_count == 3
+    
+    status = client.get(f"/status/batch/{response.json['batch_id']}").json
+    assert status['status'] == 'processing'
+    assert status['total'] == 3
+    assert {task['status'] for task in status['tasks']} == {'queued'}
+
+
+@patch('app.get_scheduler')
+def test_batch_upload_rejected_when_it_does_not_fit(mock_get_scheduler, client):
+    """Test a batch larger than the free queue capacity is refused up front."""
+    mock_get_scheduler.return_value.free_slots.return_value = 1
+    mock_get_scheduler.return_value.retry_after.return_value = 5
+    
+    response = client.post('/upload/batch', data={'audiofiles': [
+        (io.BytesIO(b'first audio'), 'one.mp3'),
+        (io.BytesIO(b'second audio'), 'two.mp3'),
+    ]})
+    
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '5'
+    mock_get_scheduler.return_value.submit.assert_not_called()
+
+
+def test_batch_upload_rejected_over_client_quota(client, monkeypatch):
+    """Test a batch that would take its client over quota is refused whole."""
+    scheduler = app.ConversionScheduler(workers=1, max_queue=10, client_max_jobs=3,
+                                        client_max_cost=3000)
+    monkeypatch.setattr(app, 'get_scheduler', lambda: scheduler)
+    audio = io.BytesIO()
+    with wave.open(audio, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\x00' * 4000)
+    
+    response = client.post('/upload/batch', data={'audiofiles': [
+        (io.BytesIO(audio.getvalue()), f"{name}.wav") for name in ('one', 'two', 'three')]})
+    assert response.status_code == 429
+    assert response.json['reason'] == 'client_cost'
+    assert 'Retry-After' in response.headers
+    assert scheduler.stats()['queued'] == 0
+    assert os.listdir(app.app.config['UPLOAD_FOLDER']) == []
+    
+    scheduler.submit('earlier', lambda: None, client='127.0.0.1', cost=1)
+    response = client.post('/upload/batch', data={'audiofiles': [
+        (io.BytesIO(b'first audio'), 'one.mp3'), (io.BytesIO(b'second audio'), 'two.mp3'),
+        (io.BytesIO(b'third audio'), 'three.mp3')]})
+    assert response.status_code == 429
+    assert response.json['reason'] == 'client_jobs'
+    assert scheduler.stats()['queued'] == 1
+
+
+def test_batch_download_streams_zip(client):
+    """Test the batch download is a ZIP of every converted file."""
+    import zipfile
+    
+    entries = []
+    contents = {}
+    for i, name in enumerate(['prompt', 'prompt', 'greeting']):
+        task_id = f"task-{i}"
+        output_path = os.path.join(app.app.config['CONVERTED_FOLDER'], f"{task_id}_{name}.wav")
+        with open(output_path, 'wb') as f:
+            f.write(os.urandom(100000 + i))
+        app.save_task(task_id, {'status': 'complete', 'output_path': output_path,
+                                'filename': f"{name}_mono_8khz_16bit.wav", 'timestamp': time.time()})
+        entries.append({'task_id': task_id, 'filename': f"{name}.mp3"})
+        contents[task_id] = open(output_path, 'rb').read()
+    entries.append({'task_id': 'task-failed', 'filename': 'bad.mp3', 'error': 'Uploaded file is empty'})
+    app.save_task(app.batch_key('b1'), {'tasks': entries, 'timestamp': time.time()})
+    
+    status = client.get('/status/batch/b1').json
+    assert (status['status'], status['completed'], status['failed']) == ('complete', 3, 1)
+    
+    response = client.get('/download/batch/b1')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/zip'
+    
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.namelist() == ['prompt_mono_8khz_16bit.wav', 'prompt_mono_8khz_16bit_2.wav',
+                                  'greeting_mono_8khz_16bit.wav']
+    assert archive.read('prompt_mono_8khz_16bit_2.wav') == contents['task-1']
+    assert archive.read('greeting_mono_8khz_16bit.wav') == contents['task-2']
+
+
+def test_batch_download_waits_for_conversions(client):
+    """Test the batch download is refused while files are still converting."""
+    app.save_task('task-0', {'status': 'processing', 'progress': 40, 'timestamp': time.time()})
+    app.save_task(app.batch_key('b2'), {'tasks': [{'task_id': 'task-0', 'filename': 'a.mp3'}],
+                                        'timestamp': time.time()})
+    
+    response = client.get('/download/batch/b2')
+    assert response.status_code == 409
+
+
+def test_expire_items_removes_files_and_tasks(client, tmp_path):
+    """Test expired tasks are deleted in one batch along with their files."""
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"task-{i}.wav"
+        path.write_bytes(b'audio')
+        paths.append(str(path))
+        app.save_task(f"task-{i}", {'status': 'complete', 'timestamp': time.time(),
+                                    'expires': time.time() - 1})
+    
+    with patch('app.delete_expired_tasks', wraps=app.delete_expired_tasks) as mock_delete:
+        app.expire_items([('task-0', [paths[0]]), ('task-1', [paths[1], str(tmp_path / 'gone.wav')]),
+                          (f"{app.ORPHAN_PREFIX}{paths[2]}", [paths[2]])])
+    
+    assert mock_delete.call_count == 1
+    assert mock_delete.call_args[0][0] == ['task-0', 'task-1']
+    assert not any(os.path.exists(path) for path in paths)
+    assert app.get_task('task-0') is None
+    assert app.get_task('task-2') is not None
+
+
+def test_expire_items_keeps_task_extended_elsewhere(client, tmp_path):
+    """Test a task whose stored deadline was pushed back by another process survives its old deadline."""
+    upload_path = tmp_path / 'upload.mp3'
+    upload_path.write_bytes(b'audio')
+    app.save_task('moved-task', {'status': 'pending', 'timestamp': time.time()})
+    app.schedule_expiry('moved-task', [str(upload_path)], delay=0)
+    # The process that finished the task gave it the full retention period
+    app.save_task('moved-task', {'status': 'complete', 'timestamp': time.time()})
+    app.schedule_expiry('moved-task', delay=600)
+    
+    app.expire_items([('moved-task', [str(upload_path)])])
+    
+    assert app.get_task('moved-task')['status'] == 'complete'
+    assert upload_path.exists()
+    assert app.get_expiry().deadline('moved-task') == app.get_task('moved-task')['expires']
+
+
+def test_rebuild_expiry_from_store(client):
+    """Test the schedule is rebuilt from stored tasks and one scan of the folders."""
+    upload_path = os.path.join(app.app.config['UPLOAD_FOLDER'], 'a' * 36 + '_in.mp3')
+    output_path = os.path.join(app.app.config['CONVERTED_FOLDER'], 'a' * 36 + '_out.wav')
+    orphan_path = os.path.join(app.app.config['UPLOAD_FOLDER'], 'orphaned.mp3')
+    for path in (upload_path, output_path, orphan_path):
+        with open(path, 'wb') as f:
+            f.write(b'audio')
+    app.save_task('a' * 36, {'status': 'complete', 'output_path': output_path,
+                             'filename': 'out.wav', 'timestamp': 1000})
+    
+    expiry = app.ExpiryScheduler(lambda batch: None)
+    app.rebuild_expiry(expiry)
+    
+    retention = app.app.config['FILE_RETENTION_MINUTES'] * 60
+    assert expiry.deadline('a' * 36) == 1000 + retention
+    assert expiry.deadline(f"{app.ORPHAN_PREFIX}{orphan_path}") is not None
+    assert expiry.run_due(now=1000 + retention) == [('a' * 36, sorted([output_path, upload_path]))]
+    for path in (upload_path, output_path, orphan_path):
+        os.remove(path)
+
+
+def test_download_shortens_expiry_without_threads(client, tmp_path, monkeypatch):
+    """Test a download brings the task's expiry forward instead of starting a thread."""
+    expiry = app.ExpiryScheduler(lambda batch: None)
+    monkeypatch.setattr(app, '_expiry', expiry)
+    output_path = str(tmp_path / 'out.wav')
+    with open(output_path, 'wb') as f:
+        f.write(b'RIFF')
+    app.save_task('dl-task', {'status': 'complete', 'output_path': output_path,
+                              'filename': 'out.wav', 'timestamp': time.time()})
+    app.schedule_expiry('dl-task', [output_path])
+    
+    threads = threading.active_count()
+    response = client.get('/download/dl-task')
+    response.close()
+    
+    assert response.status_code == 200
+    assert threading.active_count() == threads
+    remaining = expiry.deadline('dl-task') - time.time()
+    assert 0 < remaining <= app.app.config['DOWNLOAD_RETENTION_SECONDS']
+
+
+def save_downloadable(task_id, output_path, data):
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    app.save_task(task_id, {'status': 'complete', 'output_path': output_path, 'filename': 'out.wav',
+                            'input_sha256': 'ab' * 32, 'timestamp': time.time()})
+
+
+def test_download_range_and_conditional(client, tmp_path, monkeypatch):
+    """Test downloads honour Range and If-None-Match."""
+    monkeypatch.setattr(app, '_expiry', app.ExpiryScheduler(lambda batch: None))
+    save_downloadable('range-task', str(tmp_path / 'out.wav'), bytes(range(100)))
+    
+    response = client.get('/download/range-task')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert etag == f'"{app.cache_key("ab" * 32, converter.DEFAULT_PROFILE)}"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    response.close()
+    
+    response = client.get('/download/range-task', headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == bytes(range(10, 20))
+    assert response.headers['Content-Range'] == 'bytes 10-19/100'
+    response.close()
+    
+    response = client.get('/download/range-task', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+@pytest.mark.parametrize('mode,header,expected', [
+    ('x-accel-redirect', 'X-Accel-Redirect', '/protected-downloads/out.wav'),
+    ('x-sendfile', 'X-Sendfile', None),
+])
+def test_download_offload_to_proxy(client, tmp_path, monkeypatch, mode, header, expected):
+    """Test a configured front proxy is told to send the file itself."""
+    monkeypatch.setattr(app, '_expiry', app.ExpiryScheduler(lambda batch: None))
+    monkeypatch.setitem(app.app.config, 'DOWNLOAD_OFFLOAD', mode)
+    output_path = str(tmp_path / 'out.wav')
+    save_downloadable('offload-task', output_path, b'RIFF' * 10)
+    
+    response = client.get('/download/offload-task')
+    
+    assert response.status_code == 200
+    assert response.data == b''
+    assert response.headers[header] == (expected or output_path)
+    assert 'out.wav' in response.headers['Content-Disposition']
+    
+    response = client.get('/download/offload-task', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_delete_after_download(client, tmp_path, monkeypatch):
+    """Test delete-on-complete mode removes the output only after a full transfer."""
+    expiry = app.ExpiryScheduler(lambda batch: None)
+    monkeypatch.setattr(app, '_expiry', expiry)
+    monkeypatch.setitem(app.app.config, 'DELETE_AFTER_DOWNLOAD', True)
+    output_path = str(tmp_path / 'out.wav')
+    save_downloadable('delete-task', output_path, bytes(100000))
+    
+    # Ranges leave the file in place, even one that reaches the end
+    for byte_range in ('bytes=0-49', 'bytes=50000-'):
+        response = client.get('/download/delete-task', headers={'Range': byte_range})
+        assert response.status_code == 206
+        response.data
+        response.close()
+        assert os.path.exists(output_path)
+    
+    # An aborted transfer leaves it too
+    response = client.get('/download/delete-task', buffered=False)
+    next(iter(response.response))
+    response.close()
+    assert os.path.exists(output_path)
+    
+    response = client.get('/download/delete-task')
+    assert response.data == bytes(100000)
+    response.close()
+    assert not os.path.exists(output_path)
+    assert expiry.deadline('delete-task') <= time.time()
+
+
+def test_delete_after_download_keeps_server_sendfile(client, tmp_path, monkeypatch):
+    """Test delete-on-complete mode still hands the server its own file wrapper, and sees sendfile finish."""
+    monkeypatch.setattr(app, '_expiry', app.ExpiryScheduler(lambda batch: None))
+    monkeypatch.setitem(app.app.config, 'DELETE_AFTER_DOWNLOAD', True)
+    output_path = str(tmp_path / 'out.wav')
+    save_downloadable('sendfile-task', output_path, bytes(100000))
+    
+    class ServerFileWrapper(FileWrapper):
+        """Stands in for a server's ``wsgi.file_wrapper``, as gunicorn's is"""
+    
+    with app.app.test_request_context('/download/sendfile-task',
+                                      environ_overrides={'wsgi.file_wrapper': ServerFileWrapper}):
+        response = app.download_file('sendfile-task')
+    assert isinstance(response.response, ServerFileWrapper)
+    
+    # As the server does: sendfile from the file's current offset, then close
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        received = []
+        reader = threading.Thread(target=lambda: received.extend(iter(lambda: receiver.recv(65536), b'')))
+        reader.start()
+        sender.sendfile(response.response.file, offset=0, count=100000)
+        sender.shutdown(socket.SHUT_WR)
+        reader.join()
+    response.response.close()
+    
+    assert b''.join(received) == bytes(100000)
+    assert not os.path.exists(output_path)
+
+
+@pytest.mark.skipif(converter.np is None, reason="NumPy is not installed")
+def test_metrics_endpoint_reports_conversion(client, tmp_path):
+    """Test /metrics exposes stage latencies, byte counts and queue gauges."""
+    input_path = str(tmp_path / 'prompt.wav')
+    with wave.open(input_path, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(os.urandom(16000 * 4))
+    app.convert_audio(input_path, app.app.config['CONVERTED_FOLDER'], 'metrics-task')
+    
+    with patch.object(app, '_scheduler', MagicMock()) as scheduler:
+        scheduler.stats.return_value = {'queued': 4, 'active': 2}
+        response = client.get('/metrics')
+    
+    text = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    for stage in ('probe', 'downmix', 'resample', 'export', 'verify'):
+        assert f'wavmaker_stage_seconds_count{{engine="numpy",stage="{stage}"}}' in text
+    assert 'wavmaker_queue_depth 4' in text
+    assert 'wavmaker_active_conversions 2' in text
+    assert 'wavmaker_output_bytes_total{profile="pcm8k"}' in text
+    assert 'wavmaker_task_store_seconds_count{operation="write"}' in text
+
+
+@pytest.mark.skipif(converter.np is None, reason="NumPy is not installed")
+@patch('app.get_scheduler')
+def test_traced_upload_records_spans(mock_get_scheduler, client, monkeypatch):
+    """Test an upload with X-Trace records a trace readable by admins only."""
+    mock_get_scheduler.return_value.submit.return_value = 1
+    monkeypatch.setitem(app.app.config, 'ADMIN_TOKEN', 'secret')
+    monkeypatch.setitem(app.app.config, 'CACHE_MAX_MB', 0)
+    monkeypatch.setitem(app.app.config, 'TRACE_PROFILE_SAMPLE_RATE', 1.0)
+    audio = io.BytesIO()
+    with wave.open(audio, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(os.urandom(16000 * 4))
+    audio.seek(0)
+    
+    response = client.post('/upload', data={'audiofile': (audio, 'prompt.wav')},
+                           headers={'X-Trace': '1'})
+    task_id = response.json['task_id']
+    args, _ = mock_get_scheduler.return_value.submit.call_args
+    assert args[1] == app.traced_convert_audio
+    args[1](*args[2:])
+    
+    assert app.get_task(task_id)['status'] == 'complete'
+    assert client.get(f'/status/{task_id}/trace').status_code == 403
+    response = client.get(f'/status/{task_id}/trace', headers={'Authorization': 'Bearer secret'})
+    trace = response.json
+    assert response.status_code == 200
+    assert trace['complete'] is True
+    for name in ('upload.receive', 'upload.save', 'upload.queue', 'queue_wait',
+                 'probe', 'resample', 'verify', 'store.write', 'store.lock_wait'):
+        assert name in trace['totals'], name
+    assert trace['profile'] == f"{task_id}_profile.pstats"
+    response = client.get(f'/status/{task_id}/trace?profile=text',
+                          headers={'Authorization': 'Bearer secret'})
+    assert 'convert_audio' in response.get_data(as_text=True)
+
+
+@patch('app.get_scheduler')
+def test_untraced_upload_and_disabled_trace_endpoint(mock_get_scheduler, client):
+    """Test uploads aren't traced by default and the endpoint needs ADMIN_TOKEN."""
+    mock_get_scheduler.return_value.submit.return_value = 1
+    response = client.post('/upload', data={'audiofile': (io.BytesIO(b'audio'), 'a.mp3')})
+    task_id = response.json['task_id']
+    
+    args, _ = mock_get_scheduler.return_value.submit.call_args
+    assert args[1] == app.convert_audio
+    assert app.tracing.get(task_id) is None
+    assert client.get(f'/status/{task_id}/trace').status_code == 404
+
+
+@pytest.mark.skipif(converter.np is None, reason="NumPy is not installed")
+@patch('app.get_scheduler')
+def test_lease_mode_queues_in_shared_store(mock_get_scheduler, client, monkeypatch):
+    """Test uploads go to the shared job queue and a claiming worker converts them."""
+    monkeypatch.setitem(app.app.config, 'JOB_QUEUE', 'lease')
+    monkeypatch.setitem(app.app.config, 'CACHE_MAX_MB', 0)
+    scheduler = mock_get_scheduler.return_value
+    scheduler.stats.return_value = {'workers': 1, 'active': 0, 'queued': 0}
+    dispatcher = app.LeaseDispatcher(app.get_job_queue(), app.start_claimed_job, app.worker_idle,
+                                     owner='worker-1')
+    monkeypatch.setattr(app, '_dispatcher', dispatcher)
+    audio = io.BytesIO()
+    with wave.open(audio, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(os.urandom(16000 * 2))
+    audio.seek(0)
+    
+    task_id = client.post('/upload', data={'audiofile': (audio, 'prompt.wav')}).json['task_id']
+    
+    scheduler.submit.assert_not_called()
+    status = client.get(f'/status/{task_id}').json
+    assert (status['status'], status['position']) == ('queued', 1)
+    
+    # Any process sharing the database can claim it
+    assert dispatcher.claim_once()
+    args, _ = scheduler.submit.call_args
+    assert args[:2] == (task_id, app.run_claimed_job)
+    args[1](*args[2:])
+    
+    assert app.get_task(task_id)['status'] == 'complete'
+    assert app.get_job_queue().stats() == {'waiting': 0, 'leased': 0}
+
+
+def test_abandoned_job_marks_task_failed(client, monkeypatch):
+    """Test a job whose leases keep expiring ends with an error status."""
+    queue = app.get_job_queue()
+    dispatcher = app.LeaseDispatcher(queue, lambda *job: True, lambda: True, max_attempts=1,
+                                     on_failed=app.fail_abandoned_job, owner='worker-2')
+    app.save_task('stuck-task', {'status': 'processing', 'progress': 40, 'timestamp': time.time()})
+    queue.enqueue('stuck-task', {'input_path': 'gone.wav'}, now=0)
+    queue.claim('crashed-worker', 10, now=0)
+    
+    assert not dispatcher.claim_once()
+    
+    task = app.get_task('stuck-task')
+    assert task['status'] == 'error'
+    assert 'interrupted' in task['error']
+
+
+def test_claimed_streamed_upload_that_never_arrived_fails(client, monkeypatch, tmp_path):
+    """Test a streamed upload picked up after its receiving process died isn't converted."""
+    queue = app.get_job_queue()
+    dispatcher = app.LeaseDispatcher(queue, lambda *job: True, lambda: True, owner='worker-2')
+    monkeypatch.setattr(app, '_dispatcher', dispatcher)
+    input_path = tmp_path / 'partial.mp3'
+    input_path.write_bytes(b'x' * 10)
+    app.save_task('partial-task', {'status': 'processing', 'progress': 20, 'timestamp': time.time()})
+    queue.enqueue('partial-task', {'input_path': str(input_path), 'size': None, 'enqueued': 0},
+                  owner='crashed-worker', lease_seconds=10, now=0)
+    (job_id, payload, _), _ = queue.claim('worker-2', 60)
+    
+    with patch('app.convert_audio') as mock_convert:
+        app.run_claimed_job(job_id, payload)
+    
+    mock_convert.assert_not_called()
+    assert app.get_task('partial-task')['error'] == 'Upload did not complete'
+    assert queue.stats() == {'waiting': 0, 'leased': 0}
+    
+    # Once the upload finished its size is recorded, and a short file still fails
+    assert app.upload_incomplete({'input_path': str(input_path), 'size': 20})
+    assert not app.upload_incomplete({'input_path': str(input_path), 'size': 10})
+    assert not app.upload_incomplete({'input_path': str(input_path)})
+
+
+def create_resumable(client, data, filename='long_prompt.mp3', profiles=None):
+    metadata = f"filename {base64.b64encode(filename.encode()).decode()}"
+    if profiles:
+        metadata += f",profiles {base64.b64encode(profiles.encode()).decode()}"
+    return client.post('/uploads', headers={'Tus-Resumable': '1.0.0', 'Upload-Length': str(len(data)),
+                                            'Upload-Metadata': metadata})
+
+
+def patch_chunk(client, task_id, data, offset, checksum=None):
+    headers = {'Tus-Resumable': '1.0.0', 'Upload-Offset': str(offset),
+               'Content-Type': 'application/offset+octet-stream'}
+    if checksum:
+        headers['Upload-Checksum'] = checksum
+    return client.patch(f'/uploads/{task_id}', data=data, headers=headers)
+
+
+@patch('app.get_scheduler')
+def test_resumable_upload_out_of_order_queues_conversion(mock_get_scheduler, client):
+    """Test chunks sent out of order fill the file and the last one queues the conversion."""
+    mock_get_scheduler.return_value.submit.return_value = 1
+    data = os.urandom(3000)
+    
+    response = create_resumable(client, data, profiles='pcm16k,ulaw8k')
+    assert response.status_code == 201
+    task_id = response.json['task_id']
+    assert response.headers['Location'] == f'/uploads/{task_id}'
+    assert app.get_task(task_id)['status'] == 'uploading'
+    
+    for start in (2000, 1000):
+        chunk = data[start:start + 1000]
+        response = patch_chunk(client, task_id, chunk, start,
+                               f"sha256 {base64.b64encode(hashlib.sha256(chunk).digest()).decode()}")
+        assert response.status_code == 204
+    # The gap at the start keeps the offset at zero; the ranges show what arrived
+    response = client.head(f'/uploads/{task_id}', headers={'Tus-Resumable': '1.0.0'})
+    assert (response.headers['Upload-Offset'], response.headers['Upload-Ranges']) == ('0', '1000-2999')
+    mock_get_scheduler.return_value.submit.assert_not_called()
+    
+    response = patch_chunk(client, task_id, data[:1000], 0)
+    assert response.status_code == 204
+    assert response.headers['Upload-Offset'] == '3000'
+    
+    args, kwargs = mock_get_scheduler.return_value.submit.call_args
+    job = args[1]
+    assert (args[0], job.func, job.keywords) == (task_id, app.convert_audio, {'hash_input': True})
+    input_path, _, _, _, input_sha256, profiles = args[2:]
+    with open(input_path, 'rb') as f:
+        assert f.read() == data
+    assert input_sha256 is None
+    assert profiles == ['pcm16k', 'ulaw8k']
+    assert app.get_task(task_id)['status'] == 'queued'
+    
+    # The worker, not the last request, hashes the upload for the cache
+    with patch('app.complete_from_cache', return_value=True) as mock_cache:
+        job(*args[2:])
+    assert mock_cache.call_args[0][2] == hashlib.sha256(data).hexdigest()
+    
+    # A retried chunk after completion is acknowledged without rewriting the file
+    response = patch_chunk(client, task_id, data[:1000], 0)
+    assert (response.status_code, response.headers['Upload-Offset']) == (204, '3000')
+    mock_get_scheduler.return_value.submit.assert_called_once()
+
+
+@patch('app.get_scheduler')
+def test_resumable_upload_rejects_bad_chunks(mock_get_scheduler, client):
+    """Test checksum mismatches, overlong chunks and protocol errors are rejected."""
+    data = os.urandom(100)
+    task_id = create_resumable(client, data).json['task_id']
+    
+    response = patch_chunk(client, task_id, data[:50], 0,
+                           f"md5 {base64.b64encode(hashlib.md5(b'other').digest()).decode()}")
+    assert response.status_code == 460
+    assert patch_chunk(client, task_id, data, 50).status_code == 400
+    assert client.patch(f'/uploads/{task_id}', data=data,
+                        headers={'Tus-Resumable': '1.0.0', 'Upload-Offset': '0'}).status_code == 415
+    assert client.patch(f'/uploads/{task_id}', data=data,
+                        headers={'Upload-Offset': '0',
+                                 'Content-Type': 'application/offset+octet-stream'}).status_code == 412
+    response = client.head(f'/uploads/{task_id}', headers={'Tus-Resumable': '1.0.0'})
+    assert (response.headers['Upload-Offset'], response.headers['Upload-Ranges']) == ('0', '')
+    
+    assert create_resumable(client, b'').status_code == 400
+    assert create_resumable(client, data, profiles='nope').status_code == 400
+    mock_get_scheduler.return_value.submit.assert_not_called()
+
+
+def test_resumable_upload_without_space(client, monkeypatch):
+    """Test a full disk refuses the upload, or the chunk that runs out, with 507."""
+    data = os.urandom(100)
+    task_id = create_resumable(client, data).json['task_id']
+    
+    def disk_full(*args, **kwargs):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    monkeypatch.setattr(app.resumable, 'write_chunk', disk_full)
+    assert patch_chunk(client, task_id, data, 0).status_code == 507
+    
+    monkeypatch.setattr(app.shutil, 'disk_usage', lambda path: MagicMock(free=len(data) - 1))
+    assert create_resumable(client, data).status_code == 507
+
+
+def test_status_of_upload_record_hides_its_path(client):
+    """Test the status of a resumable upload's record reports progress, not server paths."""
+    data = os.urandom(100)
+    task_id = create_resumable(client, data).json['task_id']
+    patch_chunk(client, task_id, data[:40], 0)
+    
+    status = client.get(f'/status/upload:{task_id}').json
+    assert {key: status[key] for key in ('status', 'offset', 'length', 'ranges')} == {
+        'status': 'uploading', 'offset': 40, 'length': 100, 'ranges': [[0, 40]]}
+    assert 'path' not in status
+    assert app.app.config['UPLOAD_FOLDER'] not in json.dumps(status)
+    assert client.get(f'/download/upload:{task_id}').status_code == 404
+
+
+def test_resumable_upload_delete(client):
+    """Test an unfinished upload can be abandoned, removing its file and task."""
+    task_id = create_resumable(client, b'x' * 10).json['task_id']
+    assert len(os.listdir(app.app.config['UPLOAD_FOLDER'])) == 1
+    
+    response = client.delete(f'/uploads/{task_id}', headers={'Tus-Resumable': '1.0.0'})
+    assert response.status_code == 204
+    assert os.listdir(app.app.config['UPLOAD_FOLDER']) == []
+    assert app.get_task(task_id) is None
+    assert client.head(f'/uploads/{task_id}', headers={'Tus-Resumable': '1.0.0'}).status_code == 404
@@ -0,0 +1,36 @@
+import io
+import os
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from archive import iter_zip
+
+
+def test_iter_zip_round_trip(tmp_path):
+    """Test the streamed archive is a valid ZIP with every member intact."""
+    first = tmp_path / 'first.wav'
+    first.write_bytes(os.urandom(300000))
+    empty = tmp_path / 'empty.wav'
+    empty.write_bytes(b'')
+
+    data = b''.join(iter_zip([('a.wav', str(first)), ('b.wav', str(empty))]))
+
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    assert archive.testzip() is None
+    assert archive.namelist() == ['a.wav', 'b.wav']
+    assert archive.read('a.wav') == first.read_bytes()
+    assert archive.read('b.wav') == b''
+
+
+def test_iter_zip_yields_bounded_pieces(tmp_path):
+    """Test pieces stay near the read size however large the members are."""
+    path = tmp_path / 'big.wav'
+    path.write_bytes(b'\x00' * (2 * 1024 * 1024))
+
+    pieces = list(iter_zip([('big.wav', str(path))], chunk_size=16 * 1024))
+
+    assert len(pieces) > 100
+    # A chunk of data plus at most one local header or data descriptor
+    assert max(len(piece) for piece in pieces) < 16 * 1024 + 1024
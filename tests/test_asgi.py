@@ -0,0 +1,207 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import wave
+from unittest.mock import patch
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app
+import asgi
+import converter
+
+
+@pytest.fixture
+def asgi_app(monkeypatch):
+    """A fresh ASGI app over temporary upload, output and task storage."""
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FOLDER', tempfile.mkdtemp())
+    monkeypatch.setitem(app.app.config, 'CONVERTED_FOLDER', tempfile.mkdtemp())
+    monkeypatch.setitem(app.app.config, 'TASK_DB', tempfile.mktemp(suffix='.db'))
+    monkeypatch.setitem(app.app.config, 'CACHE_MAX_MB', 0)
+    monkeypatch.setattr(app, '_expiry', app.ExpiryScheduler(lambda batch: None))
+    monkeypatch.setattr(app, '_async_scheduler', None)
+    return asgi.AsgiApp(app.app)
+
+
+async def request(asgi_app, method, path, body=b'', headers=(), query=b'', chunk_size=None):
+    """Send one request to the app; returns (status, headers, body)"""
+    chunk_size = chunk_size or max(len(body), 1)
+    messages = [{'type': 'http.request', 'body': body[i:i + chunk_size],
+                 'more_body': i + chunk_size < len(body)}
+                for i in range(0, max(len(body), 1), chunk_size)]
+    finished = asyncio.Event()
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+             'http_version': '1.1', 'scheme': 'http', 'root_path': '',
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+    await asgi_app(scope, receive, send)
+    finished.set()
+    start = sent[0]
+    return (start['status'], {name.decode(): value.decode() for name, value in start['headers']},
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+def multipart(filename, data, fields=()):
+    boundary = 'testboundary'
+    body = b''
+    for name, value in fields:
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                 f'{value}\r\n').encode()
+    body += (f'--{boundary}\r\nContent-Disposition: form-data; name="audiofile"; '
+             f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode()
+    body += data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, [('Content-Type', f'multipart/form-data; boundary={boundary}')]
+
+
+def test_upload_converts_in_a_thread(asgi_app):
+    """Test an upload is streamed in, converted by ``app.convert_audio``, then downloadable."""
+    pcm = os.urandom(32000)
+    # Stands in for ffmpeg: writes 2s of 8kHz audio to stdout
+    fake_ffmpeg = [sys.executable, '-c', f'import sys; sys.stdout.buffer.write(bytes.fromhex({pcm.hex()!r}))']
+    probe = {'format_name': 'mp3', 'sample_rate': '44100', 'channels': '2', 'duration': '2.0'}
+
+    async def run():
+        body, headers = multipart('prompt.mp3', os.urandom(100000))
+        with patch('app.mediainfo', return_value=probe) as mock_probe, \
+                patch('converter.pcm_command', return_value=fake_ffmpeg):
+            status, _, data = await request(asgi_app, 'POST', '/upload', body, headers, chunk_size=4096)
+            assert status == 200
+            task_id = json.loads(data)['task_id']
+            await asgi_app.scheduler.shutdown()
+        mock_probe.assert_called_once()
+
+        # Status goes through the Flask app
+        status, _, data = await request(asgi_app, 'GET', f'/status/{task_id}')
+        assert (status, json.loads(data)['status']) == (200, 'complete')
+        return task_id, await request(asgi_app, 'GET', f'/download/{task_id}')
+
+    task_id, (status, headers, data) = asyncio.run(run())
+    assert status == 200
+    assert headers['content-type'] == 'audio/wav'
+    assert headers['content-disposition'].endswith('_prompt_mono_8khz_16bit.wav')
+    with wave.open(app.get_task(task_id)['output_path'], 'rb') as wav:
+        assert wav.readframes(wav.getnframes()) == pcm
+    assert data[44:] == pcm
+
+
+def test_upload_errors_match_flask(asgi_app):
+    """Test missing, empty and unknown-profile uploads are rejected like the Flask route."""
+    async def run():
+        results = []
+        for filename, data, fields in [('', b'x', ()), ('a.mp3', b'', ()),
+                                       ('a.mp3', b'x', [('profiles', 'nope')])]:
+            body, headers = multipart(filename, data, fields)
+            status, _, response = await request(asgi_app, 'POST', '/upload', body, headers)
+            results.append((status, json.loads(response)['error']))
+        status, _, response = await request(asgi_app, 'POST', '/upload', b'{}',
+                                            [('Content-Type', 'application/json')])
+        results.append((status, json.loads(response)['error']))
+        return results
+
+    results = asyncio.run(run())
+    assert results[:2] == [(400, 'No selected file'), (400, 'Uploaded file is empty')]
+    assert results[2][0] == 400 and 'nope' in results[2][1]
+    assert results[3] == (400, 'No file part')
+    assert os.listdir(app.app.config['UPLOAD_FOLDER']) == []
+
+
+def test_upload_rejected_when_queue_full(asgi_app, monkeypatch):
+    """Test uploads beyond the subprocess limit and queue get a 429 with Retry-After."""
+    monkeypatch.setitem(app.app.config, 'ASYNC_MAX_SUBPROCESSES', 1)
+    monkeypatch.setitem(app.app.config, 'CONVERSION_QUEUE_SIZE', 0)
+
+    async def run():
+        release = threading.Event()
+
+        def slow_probe(path):
+            release.wait()
+            return {}
+
+        with patch('app.mediainfo', side_effect=slow_probe):
+            body, headers = multipart('a.mp3', b'first')
+            first = await request(asgi_app, 'POST', '/upload', body, headers)
+            body, headers = multipart('b.mp3', b'second')
+            second = await request(asgi_app, 'POST', '/upload', body, headers)
+            release.set()
+            await asgi_app.scheduler.shutdown()
+        return first, second
+
+    first, (status, headers, data) = asyncio.run(run())
+    assert first[0] == 200
+    assert status == 429
+    assert int(headers['retry-after']) >= 1
+    assert app.get_task(json.loads(first[2])['task_id'])['error'] == 'Invalid audio file format'
+
+
+def test_download_range_conditional_and_head(asgi_app):
+    """Test the event-loop download honours Range, If-None-Match and HEAD."""
+    output_path = os.path.join(app.app.config['CONVERTED_FOLDER'], 'out.wav')
+    with open(output_path, 'wb') as f:
+        f.write(bytes(range(100)))
+    app.save_task('range-task', {'status': 'complete', 'output_path': output_path, 'filename': 'out.wav',
+                                 'input_sha256': 'ab' * 32, 'timestamp': time.time()})
+
+    async def run():
+        full = await request(asgi_app, 'GET', '/download/range-task')
+        partial = await request(asgi_app, 'GET', '/download/range-task', headers=[('Range', 'bytes=10-19')])
+        unsatisfiable = await request(asgi_app, 'GET', '/download/range-task',
+                                      headers=[('Range', 'bytes=200-300')])
+        cached = await request(asgi_app, 'GET', '/download/range-task',
+                               headers=[('If-None-Match', full[1]['etag'])])
+        head = await request(asgi_app, 'HEAD', '/download/range-task')
+        return full, partial, unsatisfiable, cached, head
+
+    full, partial, unsatisfiable, cached, head = asyncio.run(run())
+    assert (full[0], full[2]) == (200, bytes(range(100)))
+    assert full[1]['etag'] == f'"{app.cache_key("ab" * 32, converter.DEFAULT_PROFILE)}"'
+    assert (partial[0], partial[2]) == (206, bytes(range(10, 20)))
+    assert partial[1]['content-range'] == 'bytes 10-19/100'
+    assert (unsatisfiable[0], unsatisfiable[1]['content-range']) == (416, 'bytes */100')
+    assert (cached[0], cached[2]) == (304, b'')
+    assert (head[0], head[1]['content-length'], head[2]) == (200, '100', b'')
+
+
+def test_delete_after_download_needs_full_transfer(asgi_app, monkeypatch):
+    """Test a range reaching the end of the file doesn't delete it, but a full download does."""
+    monkeypatch.setitem(app.app.config, 'DELETE_AFTER_DOWNLOAD', True)
+    output_path = os.path.join(app.app.config['CONVERTED_FOLDER'], 'out.wav')
+    with open(output_path, 'wb') as f:
+        f.write(bytes(range(100)))
+    app.save_task('delete-task', {'status': 'complete', 'output_path': output_path,
+                                  'filename': 'out.wav', 'timestamp': time.time()})
+
+    tail = asyncio.run(request(asgi_app, 'GET', '/download/delete-task', headers=[('Range', 'bytes=50-')]))
+    assert (tail[0], tail[2]) == (206, bytes(range(50, 100)))
+    assert os.path.exists(output_path)
+
+    full = asyncio.run(request(asgi_app, 'GET', '/download/delete-task'))
+    assert (full[0], full[2]) == (200, bytes(range(100)))
+    assert not os.path.exists(output_path)
+
+
+def test_wsgi_write_callable_is_sent_before_the_body(asgi_app):
+    """Test data passed to start_response's write() goes out ahead of the returned iterable."""
+    def legacy_app(environ, start_response):
+        write = start_response('200 OK', [('Content-Type', 'text/plain')])
+        write(b'written ')
+        return [b'returned']
+
+    status, _, body = asyncio.run(request(asgi.AsgiApp(legacy_app), 'GET', '/legacy'))
+    assert (status, body) == (200, b'written returned')
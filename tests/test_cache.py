@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cache import ConversionCache
+
+METADATA = {'original_format': {'channels': 2, 'sample_rate': 44100, 'bit_depth': 16}}
+
+
+def make_file(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+
+def test_store_and_lookup(tmp_path):
+    """Test a stored conversion can be found again and counts as a hit."""
+    cache = ConversionCache(str(tmp_path / 'cache'), max_bytes=10000)
+    assert cache.lookup('abc') is None
+
+    cache.store('abc', make_file(tmp_path, 'out.wav', 100), METADATA)
+    path, metadata = cache.lookup('abc')
+    assert os.path.getsize(path) == 100
+    assert metadata == METADATA
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (1, 1, 1, 100)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    """Test the size limit evicts the least recently used entry."""
+    cache = ConversionCache(str(tmp_path / 'cache'), max_bytes=250)
+    cache.store('a', make_file(tmp_path, 'a.wav', 100), METADATA)
+    cache.store('b', make_file(tmp_path, 'b.wav', 100), METADATA)
+    assert cache.lookup('a') is not None  # 'b' is now least recently used
+
+    cache.store('c', make_file(tmp_path, 'c.wav', 100), METADATA)
+    assert cache.lookup('b') is None
+    assert cache.lookup('a') is not None
+    assert cache.lookup('c') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_index_survives_restart(tmp_path):
+    """Test entries and their recency order are rebuilt from disk."""
+    folder = str(tmp_path / 'cache')
+    cache = ConversionCache(folder, max_bytes=1000)
+    cache.store('old', make_file(tmp_path, 'old.wav', 100), METADATA)
+    past = time.time() - 60
+    os.utime(os.path.join(folder, 'old.wav'), (past, past))
+    cache.store('new', make_file(tmp_path, 'new.wav', 100), METADATA)
+
+    # Reopen with room for only one entry: the older one goes
+    reopened = ConversionCache(folder, max_bytes=150)
+    assert reopened.lookup('old') is None
+    assert reopened.lookup('new') is not None
+
+
+def test_oversized_entries_are_not_cached(tmp_path):
+    """Test files larger than the whole cache are skipped."""
+    cache = ConversionCache(str(tmp_path / 'cache'), max_bytes=50)
+    cache.store('big', make_file(tmp_path, 'big.wav', 100), METADATA)
+    assert cache.lookup('big') is None
+
+
+def test_size_limit_is_shared_between_processes(tmp_path):
+    """Test caches in different processes sharing a folder stay within one limit and see each other's entries."""
+    folder = str(tmp_path / 'cache')
+    first = ConversionCache(folder, max_bytes=250)
+    second = ConversionCache(folder, max_bytes=250)
+    first.store('a', make_file(tmp_path, 'a.wav', 100), METADATA)
+    first.store('b', make_file(tmp_path, 'b.wav', 100), METADATA)
+    assert second.lookup('a') is not None  # Stored by the other process; 'b' is now least recently used
+
+    second.store('c', make_file(tmp_path, 'c.wav', 100), METADATA)
+
+    assert sorted(name for name in os.listdir(folder) if name.endswith('.wav')) == ['a.wav', 'c.wav']
+    assert second.stats()['bytes'] == 200
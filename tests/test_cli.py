@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import wave
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app
+import cli
+import converter
+
+pytestmark = pytest.mark.skipif(converter.np is None, reason="NumPy is not installed")
+
+
+@pytest.fixture(autouse=True)
+def restore_config(monkeypatch):
+    """The CLI sets the conversion mode and worker counts on the imported app, and METRICS_DIR."""
+    monkeypatch.setenv('METRICS_DIR', '')
+    for key in ('CONVERSION_MODE', 'CONVERSION_PROCESSES', 'SEGMENT_WORKERS'):
+        monkeypatch.setitem(app.app.config, key, app.app.config[key])
+
+
+def write_wav(path, frames, channels=2, rate=44100):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(range(256)) * (frames * channels * 2 // 256))
+
+
+def run(tmp_path, *args):
+    report = tmp_path / 'report.json'
+    status = cli.main([str(tmp_path / 'in'), '-o', str(tmp_path / 'out'), '-j', '2',
+                       '--mode', 'thread', '--report', str(report)] + list(args))
+    with open(report) as f:
+        return status, {os.path.relpath(entry['input'], tmp_path / 'in'): entry
+                        for entry in json.load(f)['files']}
+
+
+def test_converts_tree_and_skips_up_to_date(tmp_path):
+    """Test a directory tree is mirrored into the output folder and unchanged inputs are skipped."""
+    write_wav(tmp_path / 'in' / 'a.wav', 44100)
+    write_wav(tmp_path / 'in' / 'prompts' / 'b.wav', 8000, channels=1, rate=8000)
+    (tmp_path / 'in' / 'notes.txt').write_text('not audio')
+
+    status, files = run(tmp_path)
+    assert status == 0
+    assert sorted(files) == ['a.wav', os.path.join('prompts', 'b.wav')]
+    assert files['a.wav']['status'] == 'converted'
+    assert files['a.wav']['engine'] == 'numpy'
+    assert files[os.path.join('prompts', 'b.wav')]['fast_path'] == 'unchanged'
+    output = tmp_path / 'out' / 'prompts' / 'b_mono_8khz_16bit.wav'
+    assert output.exists()
+    assert not os.path.samefile(output, tmp_path / 'in' / 'prompts' / 'b.wav')
+    with wave.open(str(tmp_path / 'out' / 'a_mono_8khz_16bit.wav'), 'rb') as wav:
+        assert (wav.getnchannels(), wav.getframerate(), wav.getnframes()) == (1, 8000, 8000)
+
+    status, files = run(tmp_path)
+    assert {entry['status'] for entry in files.values()} == {'up_to_date'}
+
+    # A newer input is converted again, unless its content is what was converted last time
+    os.utime(tmp_path / 'in' / 'a.wav', (0, os.stat(output).st_mtime + 10))
+    _, files = run(tmp_path, '--check', 'hash')
+    assert files['a.wav']['status'] == 'up_to_date'
+    _, files = run(tmp_path)
+    assert files['a.wav']['status'] == 'converted'
+    assert files[os.path.join('prompts', 'b.wav')]['status'] == 'up_to_date'
+
+
+def test_failures_are_reported(tmp_path):
+    """Test a file that fails leaves no partial output and sets the exit status."""
+    write_wav(tmp_path / 'in' / 'good.wav', 4410)
+    (tmp_path / 'in' / 'bad.wav').write_bytes(b'RIFF' + b'\x00' * 40)
+    write_wav(tmp_path / 'in' / 'good.mp3', 4410)  # Same output name as good.wav, found first
+
+    status, files = run(tmp_path, '--profile', 'pcm8k,pcm16k')
+    assert status == 1
+    assert files['good.mp3']['status'] == 'converted'
+    assert files['bad.wav']['status'] == 'failed'
+    assert 'already written' in files['good.wav']['error']
+    assert sorted(os.listdir(tmp_path / 'out')) == [
+        '.wav-maker.json', 'good_mono_16khz_16bit.wav', 'good_mono_8khz_16bit.wav']
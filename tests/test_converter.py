@@ -0,0 +1,344 @@
+import os
+import sys
+import shutil
+import subprocess
+import wave
+import tracemalloc
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import converter
+
+requires_numpy = pytest.mark.skipif(converter.np is None, reason="NumPy is not installed")
+
+# 30 minutes of mono 8kHz 16-bit audio
+LONG_INPUT_SECONDS = 30 * 60
+LONG_INPUT_BYTES = LONG_INPUT_SECONDS * converter.TARGET_SAMPLE_RATE * converter.TARGET_SAMPLE_WIDTH
+
+# Stands in for ffmpeg: writes a long synthetic PCM stream to stdout
+FAKE_DECODER = (
+    "import sys\n"
+    "block = bytes(range(256)) * 256\n"
+    f"remaining = {LONG_INPUT_BYTES}\n"
+    "while remaining:\n"
+    "    n = min(remaining, len(block))\n"
+    "    sys.stdout.buffer.write(block[:n])\n"
+    "    remaining -= n\n"
+)
+
+
+def test_format_from_probe():
+    """Test original format is derived from probe output."""
+    assert converter.format_from_probe(
+        {'channels': '2', 'sample_rate': '44100', 'bits_per_sample': '24'}
+    ) == {'channels': 2, 'sample_rate': 44100, 'sample_width': 3}
+    # Compressed input has no bit depth and decodes to 16-bit
+    assert converter.format_from_probe(
+        {'channels': '2', 'sample_rate': '48000', 'bits_per_sample': '0'}
+    )['sample_width'] == 2
+
+
+def test_streaming_memory_is_bounded(tmp_path):
+    """Test streaming conversion memory doesn't grow with input length."""
+    output_path = str(tmp_path / 'out.wav')
+    progress = []
+
+    with patch('converter.pcm_command', return_value=[sys.executable, '-c', FAKE_DECODER]):
+        tracemalloc.start()
+        try:
+            frames = converter.transcode_streaming('long_input.mp3', output_path,
+                                                   progress=progress.append)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert frames == LONG_INPUT_SECONDS * converter.TARGET_SAMPLE_RATE
+    # The output is ~29MB; the conversion should only ever hold a few chunks
+    assert peak < 8 * converter.STREAM_CHUNK_SIZE
+    assert progress[-1] == LONG_INPUT_BYTES
+
+    with wave.open(output_path, 'rb') as wav:
+        assert wav.getnchannels() == 1
+        assert wav.getframerate() == 8000
+        assert wav.getsampwidth() == 2
+        assert wav.getnframes() == frames
+
+
+def test_streaming_reports_decoder_failure(tmp_path):
+    """Test a failing decoder surfaces its error output."""
+    failing = [sys.executable, '-c', "import sys; sys.stderr.write('Invalid data found'); sys.exit(1)"]
+    with patch('converter.pcm_command', return_value=failing):
+        with pytest.raises(Exception, match='Invalid data found'):
+            converter.transcode_streaming('bad.mp3', str(tmp_path / 'out.wav'))
+
+
+def write_wav(path, frames, channels=1, rate=8000, width=2):
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(width)
+        wav.setframerate(rate)
+        wav.writeframes(b'\x01' * frames * channels * width)
+
+
+def test_read_wav_header(tmp_path):
+    """Test header parsing reports format and data size."""
+    path = tmp_path / 'out.wav'
+    write_wav(path, 1000, channels=2, rate=44100)
+    header = converter.read_wav_header(str(path))
+    assert header['format_tag'] == 1
+    assert (header['channels'], header['sample_rate'], header['bits_per_sample']) == (2, 44100, 16)
+    assert header['data_size'] == 4000
+    assert header['data_offset'] == 44
+    assert header['file_size'] == 4044
+
+
+def test_read_wav_header_skips_extra_chunks(tmp_path):
+    """Test chunks between fmt and data are skipped."""
+    path = tmp_path / 'out.wav'
+    write_wav(path, 10)
+    data = path.read_bytes()
+    # Insert an odd-sized LIST chunk (padded to even length) before the data chunk
+    extra = b'LIST' + (3).to_bytes(4, 'little') + b'abc\x00'
+    path.write_bytes(data[:36] + extra + data[36:])
+    header = converter.read_wav_header(str(path))
+    assert header['data_offset'] == 44 + len(extra)
+    assert header['data_size'] == 20
+
+
+def test_read_wav_header_rejects_non_wav(tmp_path):
+    """Test files without a RIFF/WAVE header are rejected."""
+    path = tmp_path / 'out.wav'
+    path.write_bytes(b'ID3' + b'\x00' * 100)
+    with pytest.raises(converter.WavFormatError):
+        converter.read_wav_header(str(path))
+
+
+def test_pcm_command_decodes_once_for_all_profiles():
+    """Test extra profiles become outputs of the same ffmpeg run."""
+    command = converter.pcm_command('in.mp3', 'pcm8k', [('ulaw8k', 'a.wav'), ('pcm16k', 'b.wav')])
+    assert command.count('-i') == 1
+    assert command[-1] == 'b.wav'
+    assert command[command.index('pipe:1') - 1] == 's16le'
+    assert command[command.index('a.wav') - 4] == 'pcm_mulaw'
+
+
+def test_streaming_writes_companded_profile(tmp_path):
+    """Test the streaming engine writes a valid G.711 WAV header."""
+    output_path = str(tmp_path / 'out.wav')
+    fake = [sys.executable, '-c', "import sys; sys.stdout.buffer.write(b'\\xff' * 8001)"]
+    with patch('converter.pcm_command', return_value=fake):
+        frames = converter.transcode_streaming('in.mp3', output_path, profile='ulaw8k')
+
+    assert frames == 8001
+    header = converter.read_wav_header(output_path)
+    assert header['format_tag'] == 7
+    assert (header['sample_rate'], header['bits_per_sample'], header['block_align']) == (8000, 8, 1)
+    assert header['data_size'] == 8001
+    # Odd-sized data is padded so the RIFF size stays even
+    assert header['file_size'] == header['data_offset'] + 8002 == header['riff_size'] + 8
+
+
+def write_tone_wav(path, rate, seconds, tones, channels=2):
+    """Write a 16-bit WAV of summed ``(frequency, amplitude)`` sine tones"""
+    np = converter.np
+    t = np.arange(int(rate * seconds)) / rate
+    signal = sum(amplitude * np.sin(2 * np.pi * frequency * t) for frequency, amplitude in tones)
+    pcm = np.repeat((signal * 32767).astype('<i2')[:, None], channels, axis=1)
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+
+
+def read_samples(path):
+    with wave.open(str(path), 'rb') as wav:
+        return converter.np.frombuffer(wav.readframes(wav.getnframes()), '<i2') / 32768
+
+
+@requires_numpy
+def test_numpy_engine_filters_aliasing(tmp_path):
+    """Test the NumPy engine keeps in-band audio and removes content above 4kHz."""
+    np = converter.np
+    input_path = tmp_path / 'in.wav'
+    # The 6kHz tone would alias to 2kHz without the anti-aliasing filter
+    write_tone_wav(input_path, 44100, 2, [(1000, 0.5), (6000, 0.3)])
+
+    frames = converter.transcode_numpy(str(input_path), str(tmp_path / 'out.wav'))
+
+    assert frames == 16000
+    output = read_samples(tmp_path / 'out.wav')
+    expected = 0.5 * np.sin(2 * np.pi * 1000 * np.arange(frames) / 8000)
+    # Ignore the filter's edge effects
+    residual = output[400:-400] - expected[400:-400]
+    assert np.sqrt(np.mean(residual ** 2)) < 1e-3
+
+
+@requires_numpy
+@pytest.mark.parametrize('width', [1, 3])
+def test_numpy_engine_sample_widths(tmp_path, width):
+    """Test 8-bit unsigned and 24-bit input are scaled to 16-bit."""
+    np = converter.np
+    values = np.array([-0.5, 0.25, 0.0, 0.75])
+    if width == 1:
+        raw = (values * 128 + 128).astype('u1').tobytes()
+    else:
+        ints = (values * (1 << 23)).astype('<i4')
+        raw = b''.join(int(v).to_bytes(3, 'little', signed=True) for v in ints)
+    with wave.open(str(tmp_path / 'in.wav'), 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(width)
+        wav.setframerate(8000)
+        wav.writeframes(raw)
+
+    converter.transcode_numpy(str(tmp_path / 'in.wav'), str(tmp_path / 'out.wav'))
+
+    assert list(read_samples(tmp_path / 'out.wav')) == list(values)
+
+
+def test_numpy_engine_only_takes_pcm_wav(tmp_path):
+    """Test only PCM WAV input with PCM output profiles is eligible."""
+    path = tmp_path / 'in.wav'
+    write_wav(path, 100, channels=2, rate=44100)
+    mp3 = tmp_path / 'in.mp3'
+    mp3.write_bytes(b'ID3' + b'\x00' * 100)
+
+    if converter.np is None:
+        assert converter.numpy_wav_input(str(path)) is None
+    else:
+        assert converter.numpy_wav_input(str(path))['sample_rate'] == 44100
+    assert converter.numpy_wav_input(str(path), ['pcm8k', 'ulaw8k']) is None
+    assert converter.numpy_wav_input(str(mp3)) is None
+
+
+@requires_numpy
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is not installed")
+def test_numpy_engine_matches_ffmpeg(tmp_path):
+    """Test the NumPy engine's output is within tolerance of ffmpeg's."""
+    np = converter.np
+    input_path = str(tmp_path / 'in.wav')
+    write_tone_wav(input_path, 48000, 3, [(440, 0.4), (1800, 0.2), (3100, 0.1)])
+
+    converter.transcode_numpy(input_path, str(tmp_path / 'numpy.wav'))
+    converter.transcode_streaming(input_path, str(tmp_path / 'ffmpeg.wav'))
+
+    ours = read_samples(tmp_path / 'numpy.wav')
+    theirs = read_samples(tmp_path / 'ffmpeg.wav')
+    assert abs(len(ours) - len(theirs)) <= 2
+    length = min(len(ours), len(theirs))
+    difference = ours[400:length - 400] - theirs[400:length - 400]
+    # Both are band-limited resamplers; they differ only in filter details
+    assert np.sqrt(np.mean(difference ** 2)) < 0.005
+
+
+
+def wav_data(path):
+    header = converter.read_wav_header(str(path))
+    with open(path, 'rb') as f:
+        f.seek(header['data_offset'])
+        return header, f.read(header['data_size'])
+
+
+@requires_numpy
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is not installed")
+def test_segmented_matches_single_pass(tmp_path):
+    """Test joined segments match a single ffmpeg pass, with no clicks at the joins."""
+    wav_path = tmp_path / 'tone.wav'
+    write_tone_wav(wav_path, 44100, 95, [(440, 0.4), (1800, 0.2), (3100, 0.1)])
+    # MP3 frames depend on earlier ones, so the overlap has to prime the decoder too
+    input_path = str(tmp_path / 'in.mp3')
+    subprocess.run([converter.AudioSegment.converter, '-v', 'error', '-i', str(wav_path), input_path],
+                   check=True)
+    extra = [('ulaw8k', str(tmp_path / 'single_ulaw.wav'))]
+    single_frames = converter.transcode_streaming(input_path, str(tmp_path / 'single.wav'),
+                                                  extra_outputs=extra)
+
+    reported = []
+    frames = converter.transcode_segmented(
+        input_path, str(tmp_path / 'segmented.wav'), 95, 3, progress=reported.append,
+        extra_outputs=[('ulaw8k', str(tmp_path / 'segmented_ulaw.wav'))])
+
+    assert converter.segment_bounds(95, 3) == [(0, 32), (32, 64), (64, None)]
+    assert frames == single_frames
+    assert max(reported) == frames * 2
+    for single, segmented in [('single.wav', 'segmented.wav'),
+                              ('single_ulaw.wav', 'segmented_ulaw.wav')]:
+        single_header, single_data = wav_data(tmp_path / single)
+        segmented_header, segmented_data = wav_data(tmp_path / segmented)
+        assert segmented_header['format_tag'] == single_header['format_tag']
+        assert segmented_data == single_data
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.raw')]
+
+
+def test_segmented_reports_decoder_failure(tmp_path):
+    """Test a failing segment stops the conversion with ffmpeg's error."""
+    failing = [sys.executable, '-c', "import sys; sys.stderr.write('bad input'); sys.exit(1)"]
+    with patch('converter.segment_command', return_value=failing):
+        with pytest.raises(Exception, match='bad input'):
+            converter.transcode_segmented('in.mp3', str(tmp_path / 'out.wav'), 600, 4)
+    assert os.listdir(tmp_path) == []
+
+def test_passthrough_mode(tmp_path):
+    """Test already-compliant files are detected from the header alone."""
+    canonical = tmp_path / 'canonical.wav'
+    write_wav(canonical, 100)
+    assert converter.passthrough_mode(str(canonical)) == 'link'
+    assert converter.passthrough_mode(str(canonical), 'pcm16k') is None
+    assert converter.passthrough_mode(str(canonical), 'ulaw8k') is None
+
+    stereo = tmp_path / 'stereo.wav'
+    write_wav(stereo, 100, channels=2)
+    assert converter.passthrough_mode(str(stereo)) is None
+
+    # Same audio format, but with an extra chunk before the data
+    with_list = tmp_path / 'with_list.wav'
+    data = canonical.read_bytes()
+    extra = b'LIST' + (4).to_bytes(4, 'little') + b'INFO'
+    with_list.write_bytes(data[:36] + extra + data[36:])
+    assert converter.passthrough_mode(str(with_list)) == 'rewrite'
+
+
+def test_rewrite_header(tmp_path):
+    """Test a header rewrite keeps the audio and produces the canonical layout."""
+    source = tmp_path / 'source.wav'
+    write_wav(source, 100)
+    data = source.read_bytes()
+    extra = b'LIST' + (4).to_bytes(4, 'little') + b'INFO'
+    source.write_bytes(data[:36] + extra + data[36:] + b'trailing junk')
+
+    frames = converter.rewrite_header(str(source), str(tmp_path / 'out.wav'))
+
+    assert frames == 100
+    assert (tmp_path / 'out.wav').read_bytes() == data
+    assert converter.passthrough_mode(str(tmp_path / 'out.wav')) == 'link'
+
+
+def test_estimate_cost_from_wav_header(tmp_path):
+    """Test WAV cost is frames x channels, and unknown formats have no estimate."""
+    path = tmp_path / 'in.wav'
+    write_wav(path, 1000, channels=2, rate=44100)
+    assert converter.estimate_cost(str(path)) == 2000
+
+    other = tmp_path / 'in.ogg'
+    other.write_bytes(b'OggS' + b'\x00' * 100)
+    assert converter.estimate_cost(str(other)) is None
+    assert converter.estimate_cost(str(tmp_path / 'missing.wav')) is None
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is not installed")
+@pytest.mark.parametrize('options', [
+    ['-ac', '1', '-ar', '22050', '-f', 'flac'],
+    ['-ac', '2', '-ar', '44100', '-b:a', '128k', '-f', 'mp3'],  # Info frame
+    ['-ac', '1', '-ar', '48000', '-q:a', '4', '-f', 'mp3'],  # VBR, Xing frame
+    ['-ac', '2', '-ar', '16000', '-b:a', '32k', '-write_xing', '0', '-f', 'mp3'],  # Bitrate only
+])
+def test_estimate_cost_from_compressed_header(tmp_path, options):
+    """Test FLAC and MP3 cost estimates are within a frame or two of the real sample count."""
+    path = str(tmp_path / 'in')
+    subprocess.run([converter.AudioSegment.converter, '-v', 'error', '-f', 'lavfi',
+                    '-i', 'sine=d=37.5'] + options + [path], check=True)
+    channels, rate = int(options[1]), int(options[3])
+    expected = 37.5 * rate * channels
+    assert abs(converter.estimate_cost(path) - expected) < 2 * 1152 * channels
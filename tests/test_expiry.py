@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from expiry import ExpiryScheduler
+
+
+def test_due_entries_expire_in_one_batch():
+    """Test every entry due by now is handed over together, earliest first."""
+    batches = []
+    expiry = ExpiryScheduler(batches.append)
+    expiry.schedule('c', 300, ['c.wav'])
+    expiry.schedule('a', 100, ['a.mp3', 'a.wav'])
+    expiry.schedule('b', 200)
+
+    assert expiry.run_due(now=50) == []
+    expiry.run_due(now=250)
+
+    assert batches == [[('a', ['a.mp3', 'a.wav']), ('b', [])]]
+    assert expiry.pending() == 1
+
+
+def test_reschedule_and_cancel():
+    """Test rescheduled entries expire once at their new deadline, and cancelled ones never."""
+    batches = []
+    expiry = ExpiryScheduler(batches.append)
+    expiry.schedule('a', 100, ['upload.mp3'])
+    expiry.schedule('a', 500, ['output.wav'])
+    expiry.schedule('b', 100)
+    expiry.cancel('b')
+
+    assert expiry.run_due(now=200) == []
+    assert expiry.run_due(now=600) == [('a', ['output.wav', 'upload.mp3'])]
+    assert expiry.pending() == 0
+
+
+def test_shorten_only_keeps_earlier_deadline():
+    """Test shorten_only brings deadlines forward but never pushes them back."""
+    expiry = ExpiryScheduler(lambda batch: None)
+    expiry.schedule('a', 100)
+    expiry.schedule('a', 500, shorten_only=True)
+    assert expiry.deadline('a') == 100
+    expiry.schedule('a', 50, shorten_only=True)
+    assert expiry.deadline('a') == 50
+
+
+def test_stale_heap_entries_are_compacted():
+    """Test repeated rescheduling doesn't grow the heap without bound."""
+    expiry = ExpiryScheduler(lambda batch: None)
+    for deadline in range(1000):
+        expiry.schedule('a', deadline)
+    assert len(expiry._heap) < 100
+
+
+def test_thread_expires_near_deadline():
+    """Test the thread wakes for a newly scheduled earlier deadline."""
+    expired = threading.Event()
+    batches = []
+
+    def expire(batch):
+        batches.append(batch)
+        expired.set()
+
+    expiry = ExpiryScheduler(expire, batch_window=0.05)
+    expiry.start()
+    try:
+        expiry.schedule('late', time.time() + 3600)
+        expiry.schedule('soon', time.time() + 0.1)
+        assert expired.wait(5)
+    finally:
+        expiry.stop()
+    assert batches == [[('soon', [])]]
+    assert expiry.pending() == 1
@@ -0,0 +1,131 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from job_queue import LeaseDispatcher, SqliteJobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = SqliteJobQueue(str(tmp_path / 'tasks.db'))
+    yield queue
+    queue.close()
+
+
+def test_claims_in_fifo_order_with_positions(queue):
+    """Test jobs are claimed oldest first and positions count waiting jobs."""
+    assert queue.enqueue('a', {'n': 1}, now=100) == 1
+    assert queue.enqueue('b', {'n': 2}, now=101) == 2
+    assert queue.position('b', now=102) == 2
+    
+    job, failed = queue.claim('worker-1', 60, now=102)
+    
+    assert job == ('a', {'n': 1}, 1)
+    assert failed == []
+    assert queue.position('a', now=102) is None
+    assert queue.position('b', now=102) == 1
+    assert queue.stats(now=102) == {'waiting': 1, 'leased': 1}
+
+
+def test_enqueue_limit(queue):
+    """Test enqueue refuses new jobs once ``limit`` are waiting."""
+    assert queue.enqueue('a', {}, limit=1, now=100) == 1
+    assert queue.enqueue('b', {}, limit=1, now=100) is None
+    queue.claim('worker-1', 60, now=100)
+    assert queue.enqueue('b', {}, limit=1, now=100) == 1
+
+
+def test_expired_lease_is_reclaimed(queue):
+    """Test a job whose owner stopped heartbeating goes to another worker."""
+    queue.enqueue('a', {}, now=100)
+    queue.claim('dead-worker', 60, now=100)
+    assert queue.claim('worker-2', 60, now=150) == (None, [])
+    
+    job, _ = queue.claim('worker-2', 60, now=161)
+    
+    assert job == ('a', {}, 2)
+    assert queue.heartbeat('dead-worker', ['a'], 60, now=162) == set()
+    assert not queue.complete('a', 'dead-worker')
+    assert queue.complete('a', 'worker-2')
+    assert queue.stats() == {'waiting': 0, 'leased': 0}
+
+
+def test_heartbeat_extends_lease(queue):
+    """Test heartbeats keep a long job from being reclaimed."""
+    queue.enqueue('a', {}, now=100)
+    queue.claim('worker-1', 60, now=100)
+    assert queue.heartbeat('worker-1', ['a'], 60, now=150) == {'a'}
+    assert queue.claim('worker-2', 60, now=200) == (None, [])
+
+
+def test_gives_up_after_max_attempts(queue):
+    """Test a job that keeps losing its lease is dropped and reported."""
+    queue.enqueue('a', {}, now=0)
+    for attempt in range(2):
+        queue.claim(f'worker-{attempt}', 10, max_attempts=2, now=attempt * 100)
+    
+    assert queue.claim('worker-3', 10, max_attempts=2, now=300) == (None, ['a'])
+    assert queue.stats() == {'waiting': 0, 'leased': 0}
+
+
+def test_release_requeues_without_using_an_attempt(queue):
+    """Test released jobs can be claimed again straight away."""
+    queue.enqueue('a', {}, now=100)
+    queue.claim('worker-1', 60, now=100)
+    assert queue.release('worker-1') == 1
+    assert queue.claim('worker-2', 60, now=101)[0] == ('a', {}, 1)
+
+
+def test_update_merges_into_payload(queue):
+    """Test update changes a queued job's payload and reports jobs that are gone."""
+    queue.enqueue('a', {'input_path': 'a.mp3', 'size': None}, now=100)
+    assert queue.update('a', {'size': 10})
+    assert queue.claim('worker-1', 60, now=100)[0] == ('a', {'input_path': 'a.mp3', 'size': 10}, 1)
+    assert not queue.update('b', {'size': 10})
+
+
+def test_dispatcher_claims_only_with_capacity(queue):
+    """Test the dispatcher hands jobs off while it has capacity and renews their leases."""
+    started = []
+    capacity = [True]
+    dispatcher = LeaseDispatcher(queue, lambda *job: started.append(job) or True,
+                                 lambda: capacity[0], lease_seconds=60, owner='me')
+    queue.enqueue('a', {'n': 1})
+    queue.enqueue('b', {'n': 2})
+    
+    assert dispatcher.claim_once()
+    capacity[0] = False
+    assert not dispatcher.claim_once()
+    
+    assert started == [('a', {'n': 1}, 1)]
+    assert dispatcher.held() == {'a'}
+    dispatcher.heartbeat_once()
+    assert dispatcher.held() == {'a'}
+    dispatcher.done('a')
+    assert dispatcher.held() == set()
+    assert queue.stats()['waiting'] == 1
+
+
+def test_dispatcher_releases_jobs_it_cannot_start(queue):
+    """Test a job is put back if the local pool refuses it."""
+    dispatcher = LeaseDispatcher(queue, lambda *job: False, lambda: True, owner='me')
+    queue.enqueue('a', {})
+    
+    assert not dispatcher.claim_once()
+    assert dispatcher.held() == set()
+    assert queue.claim('other', 60)[0] == ('a', {}, 1)
+
+
+def test_dispatcher_renew_reports_lost_lease(queue):
+    """Test renewing a job another worker has taken over fails and drops it."""
+    dispatcher = LeaseDispatcher(queue, lambda *job: True, lambda: True, owner='me')
+    queue.enqueue('a', {})
+    assert dispatcher.claim_once()
+    assert dispatcher.renew('a')
+    
+    queue.release('me', ['a'])
+    queue.claim('other', 60)
+    assert not dispatcher.renew('a')
+    assert dispatcher.held() == set()
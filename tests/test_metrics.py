@@ -0,0 +1,88 @@
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import metrics
+from metrics import Registry
+
+
+def dead_pid():
+    """PID of a process that has already exited"""
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_process_file(directory, pid, registry):
+    with open(os.path.join(directory, f"{pid}.json"), 'w') as f:
+        json.dump({'pid': pid, 'metrics': registry.snapshot()}, f)
+
+
+def make_registry(directory=None):
+    registry = Registry(directory)
+    registry.counter('jobs_total', 'Jobs', ['result'])
+    registry.gauge('queue_depth', 'Queue depth')
+    registry.histogram('job_seconds', 'Job time', buckets=(0.1, 1.0))
+    return registry
+
+
+def test_render_histogram_and_labels():
+    """Test the text format has cumulative buckets and escaped labels."""
+    registry = make_registry()
+    jobs, queue, seconds = (registry._metrics[name] for name in ('jobs_total', 'queue_depth', 'job_seconds'))
+    jobs.labels('o"k').inc(2)
+    queue.set(3)
+    for value in (0.05, 0.5, 5):
+        seconds.observe(value)
+    
+    text = registry.render()
+    
+    assert '# TYPE jobs_total counter' in text
+    assert 'jobs_total{result="o\\"k"} 2' in text
+    assert 'queue_depth 3' in text
+    assert 'job_seconds_bucket{le="0.1"} 1' in text
+    assert 'job_seconds_bucket{le="1.0"} 2' in text
+    assert 'job_seconds_bucket{le="+Inf"} 3' in text
+    assert 'job_seconds_sum 5.55' in text
+    assert 'job_seconds_count 3' in text
+
+
+def test_render_merges_processes(tmp_path):
+    """Test counters and histograms sum across processes; gauges only from live ones."""
+    directory = str(tmp_path)
+    live, dead = make_registry(), make_registry()
+    for registry, count in ((live, 2), (dead, 5)):
+        registry._metrics['jobs_total'].labels('ok').inc(count)
+        registry._metrics['queue_depth'].set(count)
+        registry._metrics['job_seconds'].observe(0.5)
+    write_process_file(directory, os.getppid(), live)
+    dead_id = dead_pid()
+    write_process_file(directory, dead_id, dead)
+    
+    registry = make_registry(directory)
+    registry._metrics['jobs_total'].labels('ok').inc()
+    text = registry.render()
+    
+    assert 'jobs_total{result="ok"} 8' in text
+    assert 'queue_depth 2' in text
+    assert 'job_seconds_count 2' in text
+    # The dead process's file was folded into the archive, which keeps its counts
+    assert not os.path.exists(os.path.join(directory, f"{dead_id}.json"))
+    assert os.path.exists(os.path.join(directory, metrics.ARCHIVE_FILE))
+    assert 'jobs_total{result="ok"} 8' in registry.render()
+
+
+def test_flush_writes_process_file(tmp_path):
+    """Test flush runs collectors and writes this process's file."""
+    registry = make_registry(str(tmp_path))
+    registry.add_collector(lambda: registry._metrics['queue_depth'].set(7))
+    
+    registry.flush()
+    
+    with open(tmp_path / f"{os.getpid()}.json") as f:
+        data = json.load(f)
+    assert data['pid'] == os.getpid()
+    assert data['metrics']['queue_depth']['values'] == [[[], 7]]
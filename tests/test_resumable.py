@@ -0,0 +1,73 @@
+import base64
+import hashlib
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import resumable
+
+
+def test_parse_metadata_and_checksum():
+    """Test Upload-Metadata and Upload-Checksum headers are decoded."""
+    header = f"filename {base64.b64encode('prompt.mp3'.encode()).decode()},is_confidential"
+    assert resumable.parse_metadata(header) == {'filename': 'prompt.mp3', 'is_confidential': ''}
+    assert resumable.parse_metadata(None) == {}
+    with pytest.raises(ValueError):
+        resumable.parse_metadata('filename not-base64!')
+
+    digest = hashlib.sha256(b'data').digest()
+    assert resumable.parse_checksum(f"sha256 {base64.b64encode(digest).decode()}") == ('sha256', digest)
+    assert resumable.parse_checksum('') is None
+    with pytest.raises(ValueError):
+        resumable.parse_checksum('crc32 AAAA')
+
+
+def test_chunks_written_in_place_out_of_order():
+    """Test chunks land at their offsets in a sparse upload file, in any order."""
+    data = os.urandom(3000)
+    path = os.path.join(tempfile.mkdtemp(), 'upload')
+    resumable.create_upload_file(path, len(data))
+    assert os.path.getsize(path) == len(data)
+
+    ranges = []
+    for start, end in [(2000, 3000), (0, 1000), (1000, 2000)]:
+        chunk = data[start:end]
+        checksum = ('sha1', hashlib.sha1(chunk).digest())
+        assert resumable.write_chunk(io.BytesIO(chunk), path, start, len(chunk), checksum, chunk_size=256) == 1000
+        ranges = resumable.add_range(ranges, start, end)
+        if start == 2000:
+            assert (resumable.contiguous(ranges), resumable.format_ranges(ranges)) == (0, '2000-2999')
+    assert ranges == [[0, 3000]]
+    assert resumable.received(ranges) == resumable.contiguous(ranges) == 3000
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert resumable.sha256_file(path) == hashlib.sha256(data).hexdigest()
+
+
+def test_write_chunk_rejects_checksum_mismatch():
+    """Test a chunk whose bytes don't match its checksum raises ChecksumMismatch."""
+    path = os.path.join(tempfile.mkdtemp(), 'upload')
+    resumable.create_upload_file(path, 10)
+    with pytest.raises(resumable.ChecksumMismatch):
+        resumable.write_chunk(io.BytesIO(b'corrupted!'), path, 0, 10, ('md5', hashlib.md5(b'0123456789').digest()))
+    # Nothing reaches the file before the chunk is verified
+    with open(path, 'rb') as f:
+        assert f.read() == bytes(10)
+
+
+def test_write_chunk_keeps_bytes_already_received():
+    """Test a chunk overlapping received ranges only fills the gaps."""
+    path = os.path.join(tempfile.mkdtemp(), 'upload')
+    resumable.create_upload_file(path, 10)
+    assert resumable.write_chunk(io.BytesIO(b'abc'), path, 2, 3) == 3
+    assert resumable.write_chunk(io.BytesIO(b'0123456789'), path, 0, 10, received=[[2, 5]],
+                                 chunk_size=2) == 10
+    with open(path, 'rb') as f:
+        assert f.read() == b'01abc56789'
+    assert resumable.gaps([[2, 5], [7, 8]], 0, 10) == [[0, 2], [5, 7], [8, 10]]
+    assert resumable.gaps([[0, 10]], 3, 6) == []
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from scheduler import (AsyncScheduler, ConversionScheduler, ProcessPool, QueueFull, QuotaExceeded,
+                       WorkerCrashed)
+
+
+@pytest.fixture
+def blocked_scheduler():
+    """A single-worker scheduler whose first job blocks until released."""
+    scheduler = ConversionScheduler(workers=1, max_queue=2)
+    scheduler.start()
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocker():
+        started.set()
+        release.wait(5)
+
+    scheduler.submit('blocker', blocker)
+    assert started.wait(5)
+    yield scheduler
+    release.set()
+    scheduler.shutdown()
+
+
+def test_jobs_run_in_fifo_order():
+    """Test queued jobs run in submission order."""
+    scheduler = ConversionScheduler(workers=1, max_queue=10)
+    order = []
+    for i in range(5):
+        scheduler.submit(f"task-{i}", order.append, i)
+    scheduler.start()
+    scheduler.shutdown()
+    assert order == [0, 1, 2, 3, 4]
+    assert scheduler.stats()['completed'] == 5
+
+
+def test_queue_positions(blocked_scheduler):
+    """Test queued jobs report their 1-based position."""
+    assert blocked_scheduler.submit('a', lambda: None) == 1
+    assert blocked_scheduler.submit('b', lambda: None) == 2
+    assert blocked_scheduler.position('a') == 1
+    assert blocked_scheduler.position('b') == 2
+    assert blocked_scheduler.position('blocker') is None
+    assert blocked_scheduler.stats()['active'] == 1
+
+
+def test_full_queue_raises(blocked_scheduler):
+    """Test submissions beyond the queue bound are rejected."""
+    blocked_scheduler.submit('a', lambda: None)
+    blocked_scheduler.submit('b', lambda: None)
+    with pytest.raises(QueueFull) as exc_info:
+        blocked_scheduler.submit('c', lambda: None)
+    assert exc_info.value.retry_after >= 1
+
+
+def test_failing_job_does_not_kill_worker():
+    """Test a worker keeps running after a job raises."""
+    scheduler = ConversionScheduler(workers=1, max_queue=10)
+    results = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    scheduler.submit('bad', fail)
+    scheduler.submit('good', results.append, 'ok')
+    scheduler.start()
+    scheduler.shutdown()
+    assert results == ['ok']
+
+
+def crash():
+    """Kill the worker process without cleanup."""
+    os._exit(1)
+
+
+def test_process_pool_recovers_from_crash():
+    """Test the process pool rebuilds itself after a child dies."""
+    pool = ProcessPool(processes=1, retries=1)
+    try:
+        with pytest.raises(WorkerCrashed):
+            pool.run(crash)
+        child_pid = pool.run(os.getpid)
+        assert child_pid != os.getpid()
+    finally:
+        pool.shutdown()
+
+
+def test_free_slots(blocked_scheduler):
+    """Test free slots count down as jobs are queued."""
+    assert blocked_scheduler.free_slots() == 2
+    blocked_scheduler.submit('a', lambda: None)
+    assert blocked_scheduler.free_slots() == 1
+    blocked_scheduler.submit('b', lambda: None)
+    assert blocked_scheduler.free_slots() == 0
+
+
+def test_small_job_overtakes_another_clients_backlog():
+    """Test fair queuing runs a short job ahead of another client's long ones, keeping each client's order."""
+    scheduler = ConversionScheduler(workers=1, max_queue=10)
+    order = []
+    for i in range(4):
+        scheduler.submit(f"long-{i}", order.append, f"long-{i}", client='bulk', cost=1000)
+    assert scheduler.submit('short', order.append, 'short', client='prompt', cost=10) == 1
+    assert scheduler.position('long-0') == 2
+    scheduler.start()
+    scheduler.shutdown()
+    assert order == ['short', 'long-0', 'long-1', 'long-2', 'long-3']
+
+
+def test_client_quotas():
+    """Test per-client job and cost quotas reject only that client's submissions."""
+    scheduler = ConversionScheduler(workers=1, max_queue=10, client_max_jobs=2, client_max_cost=100)
+    # A client's first job is admitted whatever it costs
+    scheduler.submit('a-0', lambda: None, client='a', cost=150)
+    with pytest.raises(QuotaExceeded) as exc_info:
+        scheduler.submit('a-1', lambda: None, client='a', cost=1)
+    assert exc_info.value.reason == 'client_cost'
+    assert exc_info.value.retry_after >= 1
+
+    scheduler.submit('b-0', lambda: None, client='b', cost=10)
+    scheduler.submit('b-1', lambda: None, client='b', cost=10)
+    with pytest.raises(QueueFull) as exc_info:
+        scheduler.submit('b-2', lambda: None, client='b', cost=10)
+    assert exc_info.value.reason == 'client_jobs'
+
+    # A batch is checked as if its jobs were submitted one after another
+    scheduler.check_quota('c', [50, 50])
+    with pytest.raises(QuotaExceeded):
+        scheduler.check_quota('c', [50, 60])
+    scheduler.submit('c-0', lambda: None, client='c', cost=10)
+    assert scheduler.stats()['clients'] == 3
+    scheduler.start()
+    scheduler.shutdown()
+    assert scheduler.stats()['clients'] == 0
+
+
+def test_client_jobs_deferred_while_its_other_job_runs():
+    """Test a client at its active-job limit gives way to other clients but never idles a worker."""
+    scheduler = ConversionScheduler(workers=3, max_queue=10, client_max_active=1)
+    releases = {name: threading.Event() for name in ('a', 'b', 'c')}
+    started = {name: threading.Event() for name in ('a-0', 'a-1', 'b-0', 'c-0')}
+    done = []
+
+    def job(task_id, release):
+        started[task_id].set()
+        release.wait(5)
+        done.append(task_id)
+
+    # With nobody else waiting, a client's second job uses a free worker
+    scheduler.submit('a-0', job, 'a-0', releases['a'], client='a', cost=10)
+    scheduler.submit('a-1', job, 'a-1', releases['a'], client='a', cost=10)
+    scheduler.start()
+    assert started['a-0'].wait(5) and started['a-1'].wait(5)
+
+    # Once another client is waiting, its job goes first even though a's is older
+    scheduler.submit('b-0', job, 'b-0', releases['b'], client='b', cost=10)
+    assert started['b-0'].wait(5)
+    scheduler.submit('a-2', done.append, 'a-2', client='a', cost=1)
+    scheduler.submit('c-0', job, 'c-0', releases['c'], client='c', cost=100)
+    assert scheduler.deferred('a-2')
+    assert not scheduler.deferred('c-0')
+    releases['b'].set()
+    assert started['c-0'].wait(5)
+    assert 'a-2' not in done
+
+    # The queue then holds only a's job, so it may take the worker b-0 freed
+    releases['c'].set()
+    for _ in range(100):
+        if 'a-2' in done:
+            break
+        time.sleep(0.01)
+    assert done == ['b-0', 'c-0', 'a-2']
+
+    releases['a'].set()
+    scheduler.shutdown()
+    assert sorted(done) == ['a-0', 'a-1', 'a-2', 'b-0', 'c-0']
+
+
+def test_jobs_without_client_are_exempt_from_client_limits():
+    """Test jobs claimed from a shared queue (no client) aren't throttled as one client."""
+    scheduler = ConversionScheduler(workers=2, max_queue=10, client_max_jobs=1,
+                                    client_max_cost=10, client_max_active=1)
+    release = threading.Event()
+    started = [threading.Event() for _ in range(3)]
+
+    def blocker(index):
+        started[index].set()
+        release.wait(5)
+
+    for index in range(3):
+        scheduler.submit(f"job-{index}", blocker, index, cost=100)
+    scheduler.start()
+    assert started[0].wait(5) and started[1].wait(5)
+    release.set()
+    scheduler.shutdown()
+    assert started[2].is_set()
+
+
+def test_async_scheduler_limits_concurrency():
+    """Test coroutine jobs run at most ``workers`` at a time and overflow is rejected."""
+    scheduler = AsyncScheduler(workers=2, max_queue=1)
+    running, peak = [], []
+
+    async def job(release):
+        running.append(1)
+        peak.append(len(running))
+        await release.wait()
+        running.pop()
+
+    async def run():
+        release = asyncio.Event()
+        positions = [scheduler.submit(f"task-{i}", job, release) for i in range(3)]
+        await asyncio.sleep(0)
+        assert scheduler.stats()['active'] == 2
+        assert scheduler.position('task-2') == 1
+        with pytest.raises(QueueFull):
+            scheduler.submit('task-3', job, release)
+        release.set()
+        await scheduler.shutdown()
+        return positions
+
+    assert asyncio.run(run()) == [1, 1, 1]
+    assert max(peak) == 2
+    assert scheduler.stats()['completed'] == 3
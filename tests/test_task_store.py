@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import threading
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import metrics
+from task_store import create_task_store, JsonFileTaskStore, ProgressTracker
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def store(request, tmp_path):
+    """Create a task store for each backend."""
+    store = create_task_store(request.param, str(tmp_path / 'tasks'))
+    yield store
+    store.close()
+
+
+def test_put_get_delete(store):
+    """Test basic task round trip."""
+    assert store.get('a') is None
+    store.put('a', {'status': 'pending', 'progress': 0})
+    store.put('b', {'status': 'complete', 'progress': 100})
+    assert store.get('a') == {'status': 'pending', 'progress': 0}
+    assert set(store.all()) == {'a', 'b'}
+
+    store.delete('a')
+    assert store.get('a') is None
+    store.delete_many(['b', 'missing'])
+    assert store.all() == {}
+
+
+def test_delete_many_where_keeps_tasks(store):
+    """Test a conditional delete only removes the tasks the condition accepts."""
+    store.put('old', {'expires': 100})
+    store.put('extended', {'expires': 300})
+    
+    kept = store.delete_many(['old', 'extended', 'missing'], where=lambda task: task['expires'] <= 200)
+    
+    assert kept == {'extended': {'expires': 300}}
+    assert store.all() == {'extended': {'expires': 300}}
+
+
+def test_update_is_atomic(store):
+    """Test concurrent read-modify-write updates don't lose increments."""
+    store.put('counter', {'value': 0})
+
+    def increment(current):
+        return {'value': current['value'] + 1}
+
+    def worker():
+        for _ in range(25):
+            store.update('counter', increment)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert store.get('counter') == {'value': 200}
+
+
+def test_update_returning_none_deletes(store):
+    """Test update can delete a task."""
+    store.put('a', {'status': 'pending'})
+    assert store.update('a', lambda current: None) is None
+    assert store.get('a') is None
+
+
+
+def test_lock_wait_is_measured(store):
+    """Test waiting for the store's lock is recorded per backend."""
+    backend = 'json' if isinstance(store, JsonFileTaskStore) else 'sqlite'
+    before = lock_wait_count(backend)
+    store.update('a', lambda current: {'status': 'pending'})
+    assert lock_wait_count(backend) == before + 1
+
+
+def lock_wait_count(backend):
+    prefix = f'wavmaker_task_store_lock_wait_seconds_count{{backend="{backend}"}} '
+    for line in metrics.REGISTRY.render().splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0
+
+def test_json_store_recovers_from_corrupt_file(tmp_path):
+    """Test the JSON backend resets an unreadable file."""
+    path = tmp_path / 'tasks.json'
+    path.write_text('{not json')
+    store = JsonFileTaskStore(str(path))
+    assert store.all() == {}
+
+    store.put('a', {'status': 'pending'})
+    assert json.loads(path.read_text()) == {'a': {'status': 'pending'}}
+
+
+def test_unknown_backend():
+    """Test an unknown backend name is rejected."""
+    with pytest.raises(ValueError):
+        create_task_store('redis', 'unused')
+
+
+def test_progress_tracker_limits_flushes():
+    """Test progress updates are kept in memory and flushed at a limited rate."""
+    saved = []
+    tracker = ProgressTracker(lambda task_id, data: saved.append((task_id, data['progress'])),
+                              flush_interval=60)
+    for progress in range(10, 100, 10):
+        tracker.update('a', {'status': 'processing', 'progress': progress})
+
+    # Only the first update is written through; the rest stay in memory
+    assert saved == [('a', 10)]
+    assert tracker.get('a')['progress'] == 90
+
+    tracker.clear('a')
+    assert tracker.get('a') is None
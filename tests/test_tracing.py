@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import tracing
+
+
+def test_span_without_trace_is_a_no_op():
+    """Test spans outside a traced task record nothing."""
+    with tracing.span('idle'):
+        pass
+    tracing.add('idle', duration=1.0)
+    assert tracing.current() is None
+
+
+def test_trace_follows_task_across_threads(tmp_path):
+    """Test spans from any thread that activates the task land in one record."""
+    tracing.start('task-1')
+    with tracing.activate('task-1'):
+        with tracing.span('upload.save', size=10):
+            pass
+    
+    def worker():
+        with tracing.activate('task-1'):
+            with tracing.span('convert'):
+                tracing.add('resample', duration=0.25)
+    thread = threading.Thread(target=worker, name='worker')
+    thread.start()
+    thread.join()
+    
+    record = tracing.finish('task-1', str(tmp_path / 'trace.json'))
+    
+    assert tracing.get('task-1') is None
+    assert tracing.read(str(tmp_path / 'trace.json')) == record
+    assert record['complete'] is True
+    spans = {span['name']: span for span in record['spans']}
+    assert spans['upload.save']['start'] <= spans['convert']['start']
+    assert spans['upload.save']['attributes'] == {'size': 10}
+    assert spans['convert']['thread'] == spans['resample']['thread'] == 'worker'
+    assert record['totals']['resample'] == 0.25
+
+
+def test_add_takes_start_then_duration(tmp_path):
+    """Test ``tracing.add`` records the same span as ``Trace.add`` given the same arguments."""
+    trace = tracing.start('task-3')
+    with tracing.activate('task-3'):
+        tracing.add('queue_wait', start=trace.origin + 1.0, duration=0.5)
+    trace.add('queue_wait', start=trace.origin + 1.0, duration=0.5)
+    record = tracing.finish('task-3', str(tmp_path / 'trace.json'))
+    
+    first, second = [(span['start'], span['duration']) for span in record['spans']]
+    assert first == second == (1.0, 0.5)
+
+
+def test_profiled_dumps_stats(tmp_path):
+    """Test a profiled block writes cProfile stats and notes them on the trace."""
+    path = str(tmp_path / 'profile.pstats')
+    tracing.start('task-2')
+    with tracing.activate('task-2'):
+        with tracing.profiled(path):
+            sum(range(1000))
+    record = tracing.finish('task-2', str(tmp_path / 'trace.json'))
+    
+    assert record['profile'] == 'profile.pstats'
+    assert 'function calls' in tracing.profile_summary(path)
@@ -0,0 +1,183 @@
+"""
+Opt-in per-task traces.
+
+A ``Trace`` is a list of timed spans for one task. It is started when the
+upload arrives and activated in whichever thread is working on the task
+(the request thread, then a conversion worker). Code anywhere can wrap a phase
+in ``span(name)``; when no trace is active in the current context that costs a
+single context-variable lookup, so untraced tasks pay almost nothing.
+
+When the task finishes, ``finish`` writes the trace as a JSON record. A
+sampled task can also be run under cProfile, with the stats dumped next to it.
+"""
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+_current = contextvars.ContextVar('trace', default=None)
+_active = {}
+_active_lock = threading.Lock()
+
+
+class Trace:
+    """Timed spans recorded for one task, relative to when it started"""
+
+    def __init__(self, task_id, started=None):
+        self.task_id = task_id
+        self.origin = time.perf_counter() if started is None else started
+        # Wall clock time of the origin, for the record
+        self.started_at = time.time() - (time.perf_counter() - self.origin)
+        self.spans = []
+        self.attributes = {}
+        self.profile_path = None
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration, **attributes):
+        """Record a span that began at ``start`` (a ``perf_counter`` value)"""
+        span = {'name': name, 'start': round(start - self.origin, 6), 'duration': round(duration, 6),
+                'thread': threading.current_thread().name}
+        if attributes:
+            span['attributes'] = attributes
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self, complete=False):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        totals = {}
+        for span in spans:
+            totals[span['name']] = round(totals.get(span['name'], 0) + span['duration'], 6)
+        return {
+            'task_id': self.task_id,
+            'started_at': self.started_at,
+            'elapsed': round(time.perf_counter() - self.origin, 6),
+            'complete': complete,
+            'attributes': dict(self.attributes),
+            'totals': totals,
+            'spans': spans,
+            'profile': os.path.basename(self.profile_path) if self.profile_path else None,
+        }
+
+
+def start(task_id, started=None):
+    """Start tracing task_id; ``started`` backdates it to a ``perf_counter`` value"""
+    trace = Trace(task_id, started)
+    with _active_lock:
+        _active[task_id] = trace
+    return trace
+
+
+def get(task_id):
+    """Return the in-progress trace of task_id, or None"""
+    with _active_lock:
+        return _active.get(task_id)
+
+
+def current():
+    """Return the trace active in this context, or None"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def activate(task_id):
+    """Make task_id's trace (if it is being traced) current for the block"""
+    trace = get(task_id)
+    if trace is None:
+        yield None
+        return
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Record the block as a span of the current trace, if there is one"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start=start_time, duration=time.perf_counter() - start_time, **attributes)
+
+
+def add(name, *, start=None, duration, **attributes):
+    """Record an already measured span; without ``start`` it is taken to end now
+
+    Arguments are in the same order as ``Trace.add``, and keyword-only.
+    """
+    trace = _current.get()
+    if trace is not None:
+        if start is None:
+            start = time.perf_counter() - duration
+        trace.add(name, start=start, duration=duration, **attributes)
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """Run the block under cProfile and dump the stats to path
+
+    Only one profiler can run at a time, so while another task is being
+    profiled the block just runs.
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        trace = _current.get()
+        if trace is not None:
+            trace.profile_path = path
+
+
+def finish(task_id, path):
+    """Stop tracing task_id and write its record to path; returns the record"""
+    with _active_lock:
+        trace = _active.pop(task_id, None)
+    if trace is None:
+        return None
+    record = trace.to_dict(complete=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(temp_path, path)
+    return record
+
+
+def discard(task_id):
+    """Stop tracing task_id without writing anything"""
+    with _active_lock:
+        _active.pop(task_id, None)
+
+
+def read(path):
+    """Load a trace record written by ``finish``, or None"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def profile_summary(path, limit=25):
+    """Top functions by cumulative time from a cProfile dump, as text"""
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()